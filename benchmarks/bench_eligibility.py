@@ -0,0 +1,64 @@
+"""
+Compare NodePool.nodes_for with the per-node Node.can_be_used_by loop.
+
+    python benchmarks/bench_eligibility.py --nodes 2000 --users 20000
+"""
+import argparse
+import random
+import time
+
+from walless_utils.objects import Node, NodePool
+
+TAGS = ['A', 'B', 'C', 'D', 'edu', 'gfw', 'cn', 'hk', 'jp', 'us', 'premium', 'beta']
+
+
+class FakeDB:
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.servers_timing = dict()
+
+    def load_servers(self, *args, **kwargs):
+        return self.nodes, [], []
+
+
+def make_node(i, rng):
+    tag = ':'.join(rng.sample(TAGS, rng.randint(1, 3)))
+    ipv6 = None if rng.random() < 0.5 else f'2001:db8::{i:x}'
+    return Node(
+        i, f'uuid-{i}', False, False, f'node-{i}', 1.0, tag, f'10.0.{i // 256 % 256}.{i % 256}', ipv6,
+        443, None, None, None, 0, 0, 1, None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    nodes = [make_node(i, rng) for i in range(args.nodes)]
+    user_tags = [tuple(rng.sample(TAGS, rng.randint(2, 6))) for _ in range(args.users)]
+    protocols = [rng.choice([None, 4, 6]) for _ in range(args.users)]
+    pool = NodePool(db=FakeDB(nodes), relay=False)
+    pool.pull(force=True)
+
+    since = time.time()
+    expected = [
+        [n for n in nodes if n.can_be_used_by(tag, proto)] for tag, proto in zip(user_tags, protocols)
+    ]
+    loop_time = time.time() - since
+
+    since = time.time()
+    got = [pool.nodes_for(tag, proto, pull=False) for tag, proto in zip(user_tags, protocols)]
+    index_time = time.time() - since
+
+    assert all(list(a) == b for a, b in zip(got, expected))
+    print(f'{args.nodes} nodes, {args.users} users')
+    print(f'per-node loop: {loop_time:.3f}s')
+    print(f'nodes_for:     {index_time:.3f}s ({loop_time / index_time:.1f}x)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark RelayGraph on a synthetic fleet.
+
+    python benchmarks/bench_routing.py --nodes 10000 --relays 100000
+"""
+import argparse
+import random
+import time
+from collections import deque
+
+from walless_utils.objects import Node, Relay, link_relays, link_mixes
+from walless_utils.objects.routing import RelayGraph
+
+TAGS = ['A', 'B', 'C', 'edu', 'gfw', 'cn', 'premium']
+
+
+def make_fleet(n_nodes, n_relays, rng):
+    nodes = [
+        Node(
+            i, f'uuid-{i}', rng.random() < 0.02, False, f'node-{i}', 1.0, rng.choice(TAGS), f'10.{i // 65536}.{i // 256 % 256}.{i % 256}',
+            None, 443, None, None, None, 0, 0, 1, None,
+        ) for i in range(n_nodes)
+    ]
+    relays = [
+        Relay(
+            i, f'relay-{i}', None, rng.choice([None, 'A', 'premium']), None, False,
+            f'uuid-{rng.randrange(n_nodes)}', f'uuid-{rng.randrange(n_nodes)}', 4400 + i % 100,
+        ) for i in range(n_relays)
+    ]
+    link_relays(nodes, relays)
+    link_mixes(nodes, [])
+    return nodes, relays
+
+
+def naive_hops(entry, user_tag):
+    # plain BFS over the linked objects with can_be_used_by
+    if entry.deleted or not entry.can_be_used_by(user_tag):
+        return dict()
+    hops, queue = {entry.uuid: 0}, deque([entry])
+    while queue:
+        u = queue.popleft()
+        for relay in u.relay_out:
+            v = relay.target
+            if v.uuid in hops or v.deleted or not relay.can_be_used_by(user_tag) or not v.can_be_used_by(user_tag):
+                continue
+            hops[v.uuid] = hops[u.uuid] + 1
+            queue.append(v)
+    return hops
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--relays', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    since = time.time()
+    nodes, relays = make_fleet(args.nodes, args.relays, rng)
+    print(f'{args.nodes} nodes, {args.relays} relays built in {time.time() - since:.2f}s')
+
+    since = time.time()
+    graph = RelayGraph(nodes)
+    print(f'adjacency arrays:  {time.time() - since:.3f}s')
+
+    queries = [(rng.choice(nodes).uuid, tuple(rng.sample(TAGS, 4))) for _ in range(args.queries)]
+    since = time.time()
+    for entry, tag in queries:
+        graph.reachable(entry, tag, max_hops=3)
+    cold = time.time() - since
+    since = time.time()
+    for entry, tag in queries:
+        graph.reachable(entry, tag, max_hops=3)
+    warm = time.time() - since
+    print(f'cold search:       {cold / len(queries) * 1000:.2f}ms per query')
+    print(f'cached search:     {warm / len(queries) * 1000:.3f}ms per query')
+
+    uuid2node = {n.uuid: n for n in nodes}
+    since = time.time()
+    for entry, tag in queries[:20]:
+        assert {k: v[0] for k, v in graph.search(entry, tag).items()} == naive_hops(uuid2node[entry], tag)
+    print(f'naive BFS (check): {(time.time() - since) / 20 * 1000:.2f}ms per query')
+
+    # change one relay and rebuild with the touched nodes only
+    relay = relays[0]
+    since = time.time()
+    graph.rebuild(nodes, touched={relay.source_id, relay.target_id})
+    kept = len(graph.cache)
+    print(f'incremental rebuild: {time.time() - since:.3f}s, {kept}/{len(queries)} cached searches kept')
+
+    # change the columns of one node only; the adjacency arrays are kept
+    since = time.time()
+    graph.rebuild(nodes, touched={nodes[1].uuid}, relays_changed=False)
+    print(f'node-only rebuild:   {time.time() - since:.3f}s, {len(graph.cache)}/{kept} cached searches kept')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+import pytest
+
+from walless_utils.objects.node import Node, Relay
+
+
+@pytest.fixture
+def make_node():
+    def make(node_id, tag=None, deleted=False, ipv6=None, upload=0, download=0, reset_day=1, limit=None):
+        return Node(
+            node_id, f'uuid-{node_id}', deleted, False, f'node-{node_id}', 1.0, tag, f'10.0.0.{node_id}', ipv6,
+            443, None, None, None, upload, download, reset_day, limit,
+        )
+    return make
+
+
+@pytest.fixture
+def make_relay():
+    def make(relay_id, source, target, tag=None):
+        return Relay(relay_id, f'relay-{relay_id}', None, tag, None, False, f'uuid-{source}', f'uuid-{target}', 4400)
+    return make
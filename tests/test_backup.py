@@ -0,0 +1,70 @@
+import struct
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+from walless_utils.backup import encode_chunk, decode_chunk, export_cursor, read_backup
+
+ROWS = [
+    (1, True, 1.5, None, date(2026, 1, 2), datetime(2026, 1, 2, 3, 4, 5, 6), b'ab', Decimal('1.20'), 'x'),
+    (None, False, None, None, None, None, None, None, ''),
+    (-2**63, True, -0.25, None, date(1, 1, 1), datetime(1970, 1, 1), b'', Decimal('-3'), 'ünï'),
+]
+
+
+class Cursor:
+    def __init__(self, rows, names):
+        self.rows = list(rows)
+        self.description = [(name, None) for name in names]
+
+    def fetchmany(self, n):
+        rows, self.rows = self.rows[:n], self.rows[n:]
+        return rows
+
+
+def test_chunk_round_trip():
+    assert decode_chunk(encode_chunk(ROWS), len(ROWS), len(ROWS[0])) == ROWS
+
+
+def test_bools_in_an_int_column_stay_ints():
+    rows = [(True,), (2,), (None,), (0,)]
+    assert decode_chunk(encode_chunk(rows), 4, 1) == [(1,), (2,), (None,), (0,)]
+
+
+def test_decimals_keep_their_digits():
+    rows = [(Decimal('12345678901234567890.123456789'),), (Decimal('0.10'),)]
+    assert decode_chunk(encode_chunk(rows), 2, 1) == rows
+    assert str(decode_chunk(encode_chunk(rows), 2, 1)[1][0]) == '0.10'
+
+
+@pytest.mark.parametrize('values', [[1, 'a'], [object()], [2**64], [datetime.now().astimezone()]])
+def test_unsupported_columns_are_refused(values):
+    with pytest.raises(TypeError):
+        encode_chunk([(v,) for v in values])
+
+
+def test_unknown_kinds_are_refused():
+    # a version 1 chunk with a pickled column (kind 8)
+    data = zlib.compress(bytes([8, 1]) + struct.pack('<Q', 1) + b'.')
+    with pytest.raises(ValueError):
+        decode_chunk(data, 1, 1)
+
+
+def test_export_and_read_back(tmp_path):
+    path = str(tmp_path / 'user.bak')
+    names = [f'c{i}' for i in range(len(ROWS[0]))]
+    result = export_cursor(Cursor(ROWS * 5, names), path, 'main_user', fetch_size=4)
+    assert (result.rows, result.chunks) == (15, 4)
+    table, columns, chunks = read_backup(path)
+    assert (table, columns) == ('main_user', names)
+    assert [row for chunk in chunks for row in chunk] == ROWS * 5
+
+
+def test_truncated_backups_raise(tmp_path):
+    path = tmp_path / 'user.bak'
+    export_cursor(Cursor(ROWS, ['a'] * len(ROWS[0])), str(path), 'main_user')
+    path.write_bytes(path.read_bytes()[:-8])
+    with pytest.raises(ValueError):
+        list(read_backup(str(path))[2])
@@ -0,0 +1,41 @@
+import random
+from dataclasses import replace
+
+from walless_utils.objects.eligibility import EligibilityIndex
+
+TAGS = ['a', 'b', 'edu', 'gfw', 'cn']
+
+
+def brute_force(nodes, user_tag, protocol=None):
+    return tuple(n.uuid for n in sorted(nodes, key=lambda n: n.node_id) if n.can_be_used_by(user_tag, protocol))
+
+
+def test_lookup_matches_can_be_used_by(make_node):
+    rng = random.Random(0)
+    nodes = [
+        make_node(i, ':'.join(rng.sample(TAGS, rng.randrange(3))) or None, ipv6='::1' if i % 3 else None)
+        for i in range(200)
+    ]
+    index = EligibilityIndex()
+    index.rebuild(nodes)
+    for _ in range(50):
+        user_tag = rng.sample(TAGS + ['unknown'], rng.randrange(5))
+        for protocol in (None, 4, 6):
+            assert index.lookup(user_tag, protocol) == brute_force(nodes, user_tag, protocol)
+            # cached
+            assert index.lookup(user_tag, protocol) == brute_force(nodes, user_tag, protocol)
+
+
+def test_update_drops_the_affected_results(make_node):
+    nodes = [make_node(1, 'a'), make_node(2, 'b'), make_node(3)]
+    index = EligibilityIndex()
+    index.rebuild(nodes)
+    assert index.lookup(['a']) == ('uuid-1', 'uuid-3')
+    assert index.lookup(['b']) == ('uuid-2', 'uuid-3')
+    # node 3 now needs tag b
+    nodes[2] = replace(nodes[2], tag=('b',))
+    index.update([nodes[2]])
+    assert index.lookup(['a']) == ('uuid-1',)
+    assert index.lookup(['b']) == ('uuid-2', 'uuid-3')
+    index.update([make_node(4, 'edu')])
+    assert index.lookup(['edu', 'a']) == ('uuid-1', 'uuid-4')
@@ -0,0 +1,32 @@
+from datetime import date
+
+from walless_utils.objects.node_limits import NodeLimitEvaluator
+
+GB = 2**30
+
+
+def test_over_near_and_reset(make_node):
+    nodes = [
+        make_node(1, upload=60 * GB, download=50 * GB, limit=100),
+        make_node(2, upload=95 * GB, limit=100),
+        # on pace to exceed its limit: 40% used 10 of 30 days into the cycle
+        make_node(3, upload=40 * GB, reset_day=9, limit=100),
+        make_node(4, upload=GB, reset_day=18, limit=100),
+        make_node(5, upload=10**15),
+    ]
+    report = NodeLimitEvaluator(unit=GB).evaluate(nodes, version=1, day=date(2026, 10, 18))
+    assert report.over == {'uuid-1'}
+    assert report.near == {'uuid-2', 'uuid-3'}
+    assert report.reset_today == {'uuid-4'}
+    # nodes without a limit have no ratio
+    assert set(report.ratio) == {'uuid-1', 'uuid-2', 'uuid-3', 'uuid-4'}
+    assert report.ratio['uuid-2'] == 0.95
+
+
+def test_columns_are_kept_for_the_same_version(make_node):
+    evaluator = NodeLimitEvaluator(unit=GB)
+    day = date(2026, 10, 18)
+    assert evaluator.evaluate([make_node(1, upload=2 * GB, limit=1)], version=1, day=day).over == {'uuid-1'}
+    # same version: the nodes passed are not looked at again
+    assert evaluator.evaluate([make_node(1, limit=1)], version=1, day=day).over == {'uuid-1'}
+    assert evaluator.evaluate([make_node(1, limit=1)], version=2, day=day).over == set()
@@ -0,0 +1,106 @@
+import time
+from dataclasses import replace
+
+from walless_utils.objects.node import Node, Relay, Mix
+from walless_utils.objects.node_pool import NodePool
+
+
+class FakeDB:
+    # the node, relay and mix tables, with the `last_change` of every node and relay row
+    def __init__(self, nodes, relays, mixes):
+        self.nodes = {n.uuid: (n, 0) for n in nodes}
+        self.relays = {r.relay_id: (r, 0) for r in relays}
+        self.mixes = list(mixes)
+        self.servers_timing = dict()
+        self.pulls = []
+
+    def set_node(self, node, change):
+        self.nodes[node.uuid] = node, change
+
+    def set_relay(self, relay, change):
+        self.relays[relay.relay_id] = relay, change
+
+    def load_servers(self, get_relays=True, after=None):
+        self.pulls.append(after)
+        after = -1 if after is None else after
+        # fresh objects on every read, as from pyodbc rows
+        return (
+            [Node.from_list(n.to_list()) for n, change in self.nodes.values() if change > after],
+            [Relay.from_list(r.to_list()) for r, change in self.relays.values() if change > after],
+            [Mix(*m) for m in self.mixes],
+        )
+
+    def all_relay_ids(self):
+        return list(self.relays)
+
+
+def graph(pool):
+    # the links of the current snapshot, by uuid and relay id
+    return {
+        n.uuid: (
+            n.port, n.hidden,
+            sorted(r.relay_id for r in n.relay_in), sorted(r.relay_id for r in n.relay_out),
+            {scope: sorted(t.uuid for t in targets) for scope, targets in n.mix.items()},
+        ) for n in pool.all_nodes(pull=False)
+    }
+
+
+def full_graph(db):
+    pool = NodePool(db)
+    pool.pull()
+    return graph(pool)
+
+
+def delta_pool(make_node, make_relay):
+    db = FakeDB(
+        [make_node(i) for i in range(1, 5)],
+        [make_relay(1, 1, 2), make_relay(2, 2, 3), make_relay(3, 5, 1)],
+        [('uuid-1', 'uuid-2', 'default_view')],
+    )
+    pool = NodePool(db, delta=True)
+    pool.pull()
+    return db, pool
+
+
+def test_delta_pulls_match_a_full_pull(make_node, make_relay):
+    db, pool = delta_pool(make_node, make_relay)
+    old = pool.all_nodes(pull=False)
+    old_graph = graph(pool)
+    # a changed node, a new node that a waiting relay points to, a moved relay, a removed relay and a new mix
+    now = int(time.time())
+    db.set_node(replace(make_node(2), port=80), now)
+    db.set_node(make_node(5), now)
+    db.set_relay(make_relay(2, 3, 4), now)
+    del db.relays[1]
+    db.mixes.append(('uuid-3', 'uuid-5', 'edu'))
+    pool.pull(force=True)
+    assert db.pulls[-1] is not None
+    assert graph(pool) == full_graph(db)
+    assert graph(pool)['uuid-5'][2:4] == ([], [3])
+    # the published snapshot was patched on a copy
+    assert pool.all_nodes(pull=False).version == old.version + 1
+    assert graph(pool) != old_graph
+    assert {n.uuid: (n.port, sorted(r.relay_id for r in n.relay_out)) for n in old} == {
+        uuid: (port, out) for uuid, (port, _, _, out, _) in old_graph.items()
+    }
+    old_ids = {id(n) for n in old}
+    assert all(id(r.target) in old_ids for n in old for r in n.relay_out)
+
+
+def test_unchanged_delta_pulls_keep_the_snapshot(make_node, make_relay):
+    db, pool = delta_pool(make_node, make_relay)
+    version = pool.all_nodes(pull=False).version
+    pool.pull(force=True)
+    assert pool.all_nodes(pull=False).version == version
+
+
+def test_a_full_pull_replaces_the_delta_pull_every_full_gap(make_node, make_relay):
+    db, pool = delta_pool(make_node, make_relay)
+    # deleted rows are not seen by delta pulls
+    del db.nodes['uuid-4']
+    pool.pull(force=True)
+    assert 'uuid-4' in graph(pool)
+    pool.last_full -= pool.full_gap
+    pool.pull(force=True)
+    assert db.pulls[-1] is None
+    assert 'uuid-4' not in graph(pool)
@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+import pytest
+
+from walless_utils.global_obj.config_setup import BALANCE_CONFIG
+from walless_utils.objects.quota import QuotaEngine
+from walless_utils.objects.user import User
+from walless_utils.utils import today
+
+GB = 2**30
+
+
+@pytest.fixture(autouse=True)
+def balance(monkeypatch):
+    monkeypatch.setitem(BALANCE_CONFIG, 'daily', {'a': 1, 'b': 2})
+    monkeypatch.setitem(BALANCE_CONFIG, 'total', {'a': 10, 'b': 20})
+
+
+def user(user_id, tag, used=0, enabled=True):
+    return User(user_id, enabled, False, 'u', 'p', f'e{user_id}', tag, 0, 0, used, 0, 0, 'x', 0)
+
+
+def test_grade_is_the_best_single_letter_tag():
+    assert user(1, 'b:edu:a').grade == 'a'
+    assert user(2, 'edu').grade is None
+    assert user(2, 'edu').daily_data == user(2, 'edu').total_data == 0
+
+
+def test_load_treats_a_missing_grade_as_no_limit():
+    engine = QuotaEngine()
+    engine.load([user(1, 'a'), user(2, 'edu'), user(3, '')])
+    engine.add(2, 100 * GB)
+    engine.add(3, 100 * GB)
+    assert not engine.over_quota(2) and not engine.over_quota(3)
+    assert engine.stats() == {'users': 3, 'over_quota': 0, 'blocked': 0}
+
+
+def test_daily_and_total_limits():
+    engine = QuotaEngine()
+    engine.load([user(1, 'a', used=9 * GB), user(2, 'b')])
+    engine.add(2, GB)
+    assert not engine.over_quota(1) and not engine.over_quota(2)
+    engine.add(1, GB + 1)
+    assert engine.over_quota(1)
+    assert engine.usage_of(1) == GB + 1
+    # unknown users are never over quota
+    assert not engine.over_quota(99)
+
+
+def test_sweep_disables_and_enables_again_on_a_new_day():
+    engine = QuotaEngine()
+    engine.load([user(1, 'a'), user(2, 'b')])
+    engine.add(1, 2 * GB)
+    assert engine.sweep() == ([1], [])
+    # already disabled
+    assert engine.sweep() == ([], [])
+    engine._roll(today() + timedelta(days=1))
+    assert engine.sweep() == ([], [1])
@@ -0,0 +1,83 @@
+import copy
+import random
+from collections import deque
+
+from walless_utils.objects.node import link_mixes, link_relays, Mix
+from walless_utils.objects.routing import RelayGraph
+
+TAGS = ['a', 'b', 'edu']
+
+
+def naive_hops(entry, user_tag):
+    if entry.deleted or not entry.can_be_used_by(user_tag):
+        return dict()
+    hops, queue = {entry.uuid: 0}, deque([entry])
+    while queue:
+        u = queue.popleft()
+        for relay in u.relay_out:
+            v = relay.target
+            if v.uuid in hops or v.deleted or not relay.can_be_used_by(user_tag) or not v.can_be_used_by(user_tag):
+                continue
+            hops[v.uuid] = hops[u.uuid] + 1
+            queue.append(v)
+    return hops
+
+
+def fleet(make_node, make_relay, seed=0, n_nodes=60, n_relays=200):
+    rng = random.Random(seed)
+    nodes = [make_node(i, rng.choice([None, None] + TAGS), deleted=rng.random() < 0.05) for i in range(n_nodes)]
+    relays = [
+        make_relay(i, rng.randrange(n_nodes), rng.randrange(n_nodes), rng.choice([None, None, 'a']))
+        for i in range(n_relays)
+    ]
+    link_relays(nodes, relays)
+    link_mixes(nodes, [])
+    return nodes, rng
+
+
+def test_search_matches_a_plain_bfs(make_node, make_relay):
+    nodes, rng = fleet(make_node, make_relay)
+    graph = RelayGraph(nodes)
+    for node in nodes:
+        user_tag = rng.sample(TAGS, rng.randrange(4))
+        assert {k: v[0] for k, v in graph.search(node.uuid, user_tag).items()} == naive_hops(node, user_tag)
+    assert graph.search('missing', TAGS) == dict()
+
+
+def test_shortest_path_follows_the_relays(make_node, make_relay):
+    nodes = [make_node(i) for i in range(4)]
+    relays = [make_relay(1, 0, 1), make_relay(2, 1, 2, 'a'), make_relay(3, 2, 3), make_relay(4, 0, 3, 'b')]
+    link_relays(nodes, relays)
+    link_mixes(nodes, [])
+    graph = RelayGraph(nodes)
+    assert [r.relay_id for r in graph.shortest_path('uuid-0', 'uuid-3', ['a', 'b'])] == [4]
+    assert [r.relay_id for r in graph.shortest_path('uuid-0', 'uuid-3', ['a'])] == [1, 2, 3]
+    assert graph.shortest_path('uuid-0', 'uuid-3', []) is None
+    assert graph.shortest_path('uuid-0', 'uuid-0', []) == []
+    assert graph.reachable('uuid-0', ['a'], max_hops=2) == [(nodes[0], 0), (nodes[1], 1), (nodes[2], 2)]
+
+
+def test_searches_start_from_the_mixes_of_the_entry(make_node, make_relay):
+    nodes = [make_node(i) for i in range(3)]
+    link_relays(nodes, [make_relay(1, 1, 2)])
+    link_mixes(nodes, [Mix('uuid-0', 'uuid-1', 'edu')])
+    graph = RelayGraph(nodes)
+    assert graph.search('uuid-0', [], scope='edu') == {'uuid-1': (0, None), 'uuid-2': (1, 1)}
+    assert graph.search('uuid-0', []) == {'uuid-0': (0, None)}
+
+
+def test_node_only_rebuild_matches_a_full_one(make_node, make_relay):
+    nodes, rng = fleet(make_node, make_relay, seed=1)
+    graph = RelayGraph(nodes)
+    queries = [(rng.choice(nodes).uuid, tuple(rng.sample(TAGS, rng.randrange(4)))) for _ in range(40)]
+    for entry, user_tag in queries:
+        graph.search(entry, user_tag)
+    # the columns of a few nodes change, the relays do not
+    changed = [copy.copy(n) for n in nodes]
+    for i in (3, 10, 20):
+        object.__setattr__(changed[i], 'tag', ('edu',))
+        object.__setattr__(changed[i], 'deleted', not changed[i].deleted)
+    graph.rebuild(changed, touched={changed[i].uuid for i in (3, 10, 20)}, relays_changed=False)
+    fresh = RelayGraph(changed)
+    for entry, user_tag in queries:
+        assert graph.search(entry, user_tag) == fresh.search(entry, user_tag)
@@ -0,0 +1,15 @@
+from walless_utils.objects.node import Node, Relay, Mix
+from walless_utils.objects.node_pool import NODE_SCHEMA, RELAY_SCHEMA, MIX_SCHEMA
+from walless_utils.objects.user_pool import USER_COLUMNS, USER_SCHEMA
+
+
+def test_node_schemas_follow_the_columns():
+    assert NODE_SCHEMA.names == Node.columns()
+    assert RELAY_SCHEMA.names == Relay.columns()
+    assert MIX_SCHEMA.names == ['source_uuid', 'target_uuid', 'scope']
+    assert len(Mix('a', 'b', 'edu').__dict__) == len(MIX_SCHEMA.columns)
+
+
+def test_user_schema_follows_the_columns():
+    assert USER_SCHEMA.names == USER_COLUMNS
+    assert set(USER_SCHEMA.indexes) <= set(USER_COLUMNS)
@@ -0,0 +1,48 @@
+from dataclasses import FrozenInstanceError, replace
+
+import pytest
+
+from walless_utils.objects.node import freeze_links, link_mixes, link_relays
+from walless_utils.objects.snapshot import Snapshot
+
+
+def test_items_are_copied_from_mutable_sequences():
+    items = [1, 2, 3]
+    snapshot = Snapshot(items, version=4)
+    items.append(4)
+    assert list(snapshot) == [1, 2, 3]
+    assert (len(snapshot), snapshot[-1], snapshot[:2], snapshot.version) == (3, 3, (1, 2), 4)
+
+
+def test_immutable_sequences_are_kept():
+    items = (1, 2)
+    assert Snapshot(items)._items is items
+
+
+def test_mutable_copy_is_deep():
+    snapshot = Snapshot([[1], [2]])
+    copy = snapshot.mutable_copy()
+    copy[0].append(3)
+    assert snapshot[0] == [1]
+
+
+def test_published_nodes_cannot_be_changed(make_node, make_relay):
+    nodes = [make_node(1, 'a'), make_node(2)]
+    relay = make_relay(1, 1, 2)
+    link_relays(nodes, [relay])
+    link_mixes(nodes, [])
+    freeze_links(nodes)
+    snapshot = Snapshot(nodes, version=1)
+    node = snapshot[0]
+    with pytest.raises(FrozenInstanceError):
+        node.port = 1
+    with pytest.raises(FrozenInstanceError):
+        relay.port = 1
+    with pytest.raises(AttributeError):
+        node.relay_out.append(relay)
+    with pytest.raises(TypeError):
+        node.mix['default_view'][0] = nodes[1]
+    # ip() returns a changed copy
+    changed = node.ip(4, '10.9.9.9')
+    assert (changed.ipv4, node.ipv4) == ('10.9.9.9', '10.0.0.1')
+    assert replace(node, port=80).port == 80 and node.port == 443
@@ -0,0 +1,78 @@
+from walless_utils.objects.spill_journal import SpillJournal
+
+
+def test_round_trip_and_resume(tmp_path):
+    path = tmp_path / 'journal'
+    journal = SpillJournal(str(path))
+    first = journal.append([(1, 'a')])
+    second = journal.append([(2, 'b'), (3, None)])
+    assert [rows for _, rows in journal.records()] == [[(1, 'a')], [(2, 'b'), (3, None)]]
+    journal.mark_done(first)
+    journal.close()
+
+    # a reopened journal only replays what is not done yet
+    journal = SpillJournal(str(path))
+    assert journal.pending
+    assert list(journal.records()) == [(second, [(2, 'b'), (3, None)])]
+    journal.mark_done(second)
+    assert not journal.pending
+    assert path.stat().st_size == 0
+    journal.close()
+
+
+def test_offsets_keep_increasing_after_truncation(tmp_path):
+    journal = SpillJournal(str(tmp_path / 'journal'))
+    first = journal.append([(1,)])
+    journal.mark_done(first)
+    second = journal.append([(2,)])
+    assert second > first
+    # a stale offset does not mark the new record as done
+    journal.mark_done(first)
+    assert [rows for _, rows in journal.records()] == [[(2,)]]
+    journal.close()
+
+
+def test_torn_tail_is_dropped(tmp_path):
+    path = tmp_path / 'journal'
+    journal = SpillJournal(str(path))
+    end = journal.append([(1,)])
+    journal.append([(2,)])
+    journal.close()
+    path.write_bytes(path.read_bytes()[:-3])
+
+    journal = SpillJournal(str(path))
+    assert journal.end == end
+    assert [rows for _, rows in journal.records()] == [[(1,)]]
+    # appends continue after the last intact record
+    journal.append([(3,)])
+    assert [rows for _, rows in journal.records()] == [[(1,)], [(3,)]]
+    journal.close()
+
+
+def test_corrupted_record_ends_the_journal(tmp_path):
+    path = tmp_path / 'journal'
+    journal = SpillJournal(str(path))
+    end = journal.append([(1, 'a')])
+    journal.append([(2, 'b')])
+    journal.close()
+    data = bytearray(path.read_bytes())
+    # flip a byte of the payload of the second record, so its CRC does not match
+    data[-2] ^= 0xff
+    path.write_bytes(bytes(data))
+
+    journal = SpillJournal(str(path))
+    assert journal.end == end
+    assert [rows for _, rows in journal.records()] == [[(1, 'a')]]
+    journal.close()
+
+
+def test_done_offset_past_the_end_is_clamped(tmp_path):
+    path = tmp_path / 'journal'
+    journal = SpillJournal(str(path))
+    journal.append([(1,)])
+    journal.close()
+    (tmp_path / 'journal.done').write_text('1000')
+    journal = SpillJournal(str(path))
+    assert journal.done_offset == journal.end
+    assert list(journal.records()) == []
+    journal.close()
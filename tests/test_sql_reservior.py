@@ -0,0 +1,168 @@
+import time
+from threading import Event, Timer
+
+import pytest
+
+from walless_utils.objects.sql_reservior import EditReservior
+
+SQL = 'UPDATE t SET v = v + ? WHERE k = ?'
+
+
+class FakeDB:
+    def __init__(self, fail=False, gate=None):
+        self.batches = list()
+        self.fail = fail
+        # commits wait for the gate, to keep the writer busy
+        self.gate = gate
+
+    def execute(self, sql, query=True, func_to_apply=None, args=None, bulk=False):
+        if self.gate is not None:
+            self.gate.wait(5)
+        if self.fail:
+            raise RuntimeError('db down')
+        self.batches.append(list(args))
+
+
+class FakeCursor:
+    def __init__(self, fail=False):
+        self.rows = list()
+        self.fail = fail
+        self.fast_executemany = False
+
+    def execute(self, sql, args):
+        self.executemany(sql, [args])
+
+    def executemany(self, sql, args):
+        if self.fail:
+            raise RuntimeError('db down')
+        self.rows.extend(args)
+
+
+def wait_for(cond, timeout=5):
+    since = time.time()
+    while not cond():
+        assert time.time() - since < timeout
+        time.sleep(0.01)
+
+
+def test_writer_commits_the_flushed_batches():
+    db = FakeDB()
+    reservoir = EditReservior(SQL, db, cache_size=2)
+    for i in range(5):
+        reservoir.add((1, i))
+    reservoir.close(5)
+    assert sorted(row for batch in db.batches for row in batch) == [(1, i) for i in range(5)]
+    assert reservoir.stats()['committed_rows'] == 5
+
+
+def test_writer_coalesces_waiting_batches_and_applies_backpressure():
+    gate = Event()
+    db = FakeDB(gate=gate)
+    reservoir = EditReservior(SQL, db, cache_size=1, max_pending=2)
+    reservoir.add((1, 0))
+    # the writer is stuck on the first batch; two more fill the queue, the fourth waits for room
+    wait_for(lambda: reservoir.queue.empty())
+    reservoir.add((1, 1))
+    reservoir.add((1, 2))
+    gate.set()
+    reservoir.add((1, 3))
+    reservoir.close(5)
+    assert len(db.batches[0]) == 1
+    assert sum(len(batch) for batch in db.batches) == 4
+    # the queued batches were committed together
+    assert len(db.batches) < 4
+
+
+def test_backpressure_waits_instead_of_dropping():
+    gate = Event()
+    db = FakeDB(gate=gate)
+    reservoir = EditReservior(SQL, db, cache_size=1, max_pending=1)
+    reservoir.add((1, 0))
+    wait_for(lambda: reservoir.queue.empty())
+    reservoir.add((1, 1))
+    since = time.time()
+    # opens the gate while add waits for room in the queue
+    Timer(0.2, gate.set).start()
+    reservoir.add((1, 2))
+    assert time.time() - since >= 0.15
+    reservoir.close(5)
+    assert reservoir.stats()['backpressure_time'] > 0
+    assert sum(len(batch) for batch in db.batches) == 3
+
+
+def test_writer_logs_and_drops_failed_commits():
+    db = FakeDB(fail=True)
+    reservoir = EditReservior(SQL, db, cache_size=1)
+    reservoir.add((1, 0))
+    reservoir.close(5)
+    assert reservoir.stats()['dropped_rows'] == 1
+
+
+def test_blocking_commits_raise_to_the_caller():
+    reservoir = EditReservior(SQL, FakeDB(fail=True), cache_size=1, block=True)
+    with pytest.raises(RuntimeError):
+        reservoir.add((1, 0))
+    db = FakeDB()
+    reservoir = EditReservior(SQL, db, cache_size=2, block=True)
+    reservoir.add((1, 0))
+    assert db.batches == []
+    reservoir.add((1, 1))
+    assert db.batches == [[(1, 0), (1, 1)]]
+    assert reservoir.writer is None
+
+
+def test_cursor_commits_run_in_the_caller_and_raise():
+    cursor = FakeCursor()
+    reservoir = EditReservior(SQL, cursor=cursor, cache_size=1)
+    reservoir.add((1, 0))
+    assert cursor.rows == [(1, 0)] and reservoir.writer is None
+    reservoir = EditReservior(SQL, cursor=FakeCursor(fail=True), cache_size=1)
+    with pytest.raises(RuntimeError):
+        reservoir.add((1, 0))
+
+
+def test_journal_needs_the_writer(tmp_path):
+    with pytest.raises(ValueError):
+        EditReservior(SQL, cursor=FakeCursor(), journal_path=str(tmp_path / 'journal'))
+    with pytest.raises(ValueError):
+        EditReservior(SQL, FakeDB(), block=True, journal_path=str(tmp_path / 'journal'))
+
+
+def test_rows_with_the_same_key_are_combined():
+    db = FakeDB()
+    reservoir = EditReservior(
+        'UPDATE t SET a = a + ?, b = ?, c = ?, d = ? WHERE k = ?', db, cache_size=10, block=True,
+        key=lambda row: row[-1], combine=('sum', 'max', 'first', lambda old, new: old + [new], 'last'),
+    )
+    reservoir.add((1, 5, 'x', [], 'k1'))
+    reservoir.add((2, 3, 'y', 'n', 'k1'))
+    reservoir.add((4, 1, 'z', [], 'k2'))
+    reservoir.flush()
+    assert db.batches == [[(3, 5, 'x', ['n'], 'k1'), (4, 1, 'z', [], 'k2')]]
+    assert reservoir.stats()['coalesced_rows'] == 1
+
+
+def test_cache_size_counts_keys():
+    db = FakeDB()
+    reservoir = EditReservior(SQL, db, cache_size=2, block=True, key=lambda row: row[-1], combine=('sum', 'last'))
+    for _ in range(5):
+        reservoir.add((1, 'k1'))
+    assert db.batches == []
+    reservoir.add((1, 'k2'))
+    assert db.batches == [[(5, 'k1'), (1, 'k2')]]
+
+
+def test_combine_spec_must_match_the_row_width():
+    with pytest.raises(ValueError):
+        EditReservior(SQL, FakeDB(), key=lambda row: row[-1], combine=('sum',))
+    with pytest.raises(ValueError):
+        EditReservior(SQL, FakeDB(), key=lambda row: row[-1])
+    seen = list()
+    reservoir = EditReservior(SQL, FakeDB(), block=True, key=lambda row: row[-1], combine=('sum', 'last'))
+    reservoir.subscribe(seen.append)
+    with pytest.raises(ValueError):
+        reservoir.add((1, 2, 'k1'))
+    # the rejected row was not seen by the subscribers
+    assert seen == []
+    reservoir.add((1, 'k1'))
+    assert seen == [(1, 'k1')]
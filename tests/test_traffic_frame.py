@@ -0,0 +1,63 @@
+from datetime import date
+
+import numpy as np
+
+from walless_utils.objects import TrafficFrame
+
+NAMES = ['ut_date', 'user_id', 'upload', 'download']
+ROWS = [
+    (date(2026, 9, 1), 1, 10, 1),
+    (date(2026, 9, 1), 2, 20, 2),
+    (date(2026, 9, 2), 1, 30, 3),
+    (date(2026, 9, 8), 3, 40, 4),
+    (date(2026, 10, 1), 2, 50, 5),
+]
+
+
+class Cursor:
+    def __init__(self, rows, types=(date, int, int, int)):
+        self.rows = list(rows)
+        self.description = [(name.upper(), t) for name, t in zip(NAMES, types)]
+
+    def fetchmany(self, n):
+        rows, self.rows = self.rows[:n], self.rows[n:]
+        return rows
+
+
+def test_group_sum_top_and_bucket():
+    frame = TrafficFrame.from_rows(ROWS, NAMES)
+    assert frame.group_sum('user_id').rows() == [(1, 40, 4), (2, 70, 7), (3, 40, 4)]
+    assert frame.top(2, 'user_id').rows(['user_id', 'total']) == [(2, 77), (1, 44)]
+    assert frame.bucket('week').rows(['ut_date', 'upload']) == [
+        (date(2026, 8, 31), 60), (date(2026, 9, 7), 40), (date(2026, 9, 28), 50),
+    ]
+    assert frame.bucket('month').rows(['ut_date', 'download']) == [(date(2026, 9, 1), 10), (date(2026, 10, 1), 5)]
+    assert len(frame.between(date(2026, 9, 2), date(2026, 9, 9))) == 2
+
+
+def test_chunks_keep_the_dtype_of_the_column():
+    # the second chunk has only NULL dates and ids, which must not turn the columns into object arrays
+    rows = ROWS[:2] + [(None, None, 5, None)] * 2
+    frame = TrafficFrame.from_cursor(Cursor(rows), fetch_size=2)
+    assert frame['ut_date'].dtype == np.dtype('datetime64[D]')
+    assert frame['user_id'].dtype == frame['download'].dtype == np.int64
+    assert frame.isnull('user_id').tolist() == [False, False, True, True]
+    assert frame.isnull('ut_date').tolist() == [False, False, True, True]
+    assert 'upload' not in frame.nulls
+    assert frame.rows()[2:] == [(None, None, 5, None)] * 2
+    # sums treat NULL as 0
+    assert frame['download'].sum() == 3
+
+
+def test_filter_keeps_the_null_masks():
+    frame = TrafficFrame.from_rows(ROWS + [(date(2026, 9, 3), None, 1, 1)], NAMES)
+    kept = frame.filter(frame['upload'] < 25)
+    assert kept.rows(['user_id']) == [(1,), (2,), (None,)]
+
+
+def test_empty_frames_are_typed():
+    frame = TrafficFrame.from_cursor(Cursor([]))
+    assert len(frame) == 0
+    assert frame['ut_date'].dtype == np.dtype('datetime64[D]')
+    assert len(frame.group_sum('user_id')) == 0
+    assert TrafficFrame.from_rows([], NAMES)['ut_date'].dtype == np.dtype('datetime64[D]')
@@ -0,0 +1,47 @@
+from walless_utils.objects.user import User
+from walless_utils.objects.user_pool import UserPool
+
+
+def user(user_id, enabled=True, balance=0):
+    return User(user_id, enabled, False, 'u', 'p', f'e{user_id}', 'a', 0, 0, 0, 0, balance, 'x', 0)
+
+
+class FakeDB:
+    # serves the change feed in pages; `on_page` runs before every page is returned
+    def __init__(self, pages, on_page=None):
+        self.pages = list(pages)
+        self.on_page = on_page
+
+    def changes_since(self, version, limit):
+        if self.on_page is not None:
+            self.on_page(version)
+        if version >= len(self.pages):
+            return [], version
+        return self.pages[version], version + 1
+
+    def get_one_user_by_email(self, email):
+        return user(int(email[1:]), balance=1)
+
+
+def test_readers_never_see_half_of_a_pull():
+    seen = []
+    pages = [[user(1), user(2)], [user(3), user(2, enabled=False)], []]
+    pool = UserPool(db=FakeDB(pages), change_feed=True, feed_batch=2)
+    pool.db.on_page = lambda version: seen.append(sorted(u.user_id for u in pool.snapshot))
+    pool.pull()
+    # only the empty snapshot is published while the pages are applied
+    assert seen == [[], [], []]
+    assert sorted(u.user_id for u in pool.all_users(pull=False)) == [1, 3]
+    assert pool.all_users(pull=False).version == 1
+
+
+def test_single_updates_are_published():
+    pool = UserPool(db=FakeDB([[user(1)]]), change_feed=True)
+    pool.pull()
+    old = pool.all_users(pull=False)
+    pool.pull_one_user('e1', force=True)
+    assert pool.by_email('e1').balance == 1
+    assert pool.all_users(pull=False).version == old.version + 1
+    assert old[0].balance == 0
+    pool.add_or_update_user(user(1, enabled=False))
+    assert len(pool.all_users(pull=False)) == 0 and pool.by_id(1) is None
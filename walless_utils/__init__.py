@@ -6,5 +6,10 @@ from .global_obj.logger_setup import logger_setup
 from .global_obj.config_setup import config_setup, cfg
 from .global_obj.db_setup import db_setup, db
 from .global_obj.pool_setup import pool_setup, user_pool, node_pool
+from .global_obj.refresh_setup import refresh_setup, refresh_scheduler
 from .global_obj.global_setup import setup_everything
 from .whoami import whoami
+from .traffic_log import TrafficLogDrain
+from .backup import TableBackup
+from .retention import RetentionEngine
+from .async_database import AsyncDBCommunicator
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+from .database import DBCommunicator, UpsertResult
+from .objects import User, Node, Relay, Mix, Traffic, TrafficFrame
+
+logger = logging.getLogger('walless')
+
+
+class AsyncDBCommunicator:
+    """
+    asyncio front end of DBCommunicator.
+    The query methods of DBCommunicator (`all_users`, `all_servers`, `get_one_user_by_email`, ...) are
+    available as coroutines with the same arguments, plus an optional `timeout` in seconds.
+    Calls run on a dedicated thread pool, bounded by the size of the connection pool of `db`, so
+    concurrent calls fan out over pooled connections.
+    A call that times out stops being awaited, and its statements are cancelled by the driver, as they
+    run with the timeout as their query timeout (rounded up to whole seconds).
+    """
+    def __init__(self, db: DBCommunicator, max_workers: Optional[int] = None, timeout: Optional[float] = None):
+        self.db = db
+        self.max_workers = max_workers
+        self.timeout = timeout
+        # created on first use, as the pool size is only known after db_setup
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.max_workers or self.db.pool.max_size, thread_name_prefix='walless-db',
+            )
+        return self._executor
+
+    def _call_blocking(self, func: Callable, timeout: Optional[float], args: tuple, kwargs: dict) -> Any:
+        with self.db.pool.statement_timeout(timeout):
+            return func(*args, **kwargs)
+
+    async def call(self, func: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        # run any blocking callable on the DB executor, with `timeout` as the query timeout of its statements
+        timeout = self.timeout if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(self.executor, partial(self._call_blocking, func, timeout, args, kwargs))
+        return await asyncio.wait_for(fut, timeout)
+
+    async def gather(self, *calls, return_exceptions: bool = False) -> list:
+        # e.g. `users, nodes = await adb.gather(adb.all_users(), adb.all_servers())`
+        return await asyncio.gather(*calls, return_exceptions=return_exceptions)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    # the methods of DBCommunicator; connection-level helpers are left to the blocking DBCommunicator
+
+    async def execute(
+        self, sql, query=True, func_to_apply=None, args=None, bulk=False, timeout: Optional[float] = None,
+    ) -> Optional[list]:
+        return await self.call(self.db.execute, sql, query, func_to_apply, args, bulk, timeout=timeout)
+
+    async def run(
+        self, name: str, args=None, query=True, func_to_apply=None, timeout: Optional[float] = None,
+    ) -> Optional[list]:
+        return await self.call(self.db.run, name, args, query, func_to_apply, timeout=timeout)
+
+    async def upsert_traffic(
+        self, rows: Iterable[Tuple], batch_size: int = 1000, timeout: Optional[float] = None,
+    ) -> UpsertResult:
+        return await self.call(self.db.upsert_traffic, rows, batch_size, timeout=timeout)
+
+    async def all_users(self, enable_only=True, after=-1, timeout: Optional[float] = None) -> List[User]:
+        return await self.call(self.db.all_users, enable_only, after, timeout=timeout)
+
+    async def changes_since(
+        self, version: int, limit: int = 50000, timeout: Optional[float] = None,
+    ) -> Tuple[List[User], int]:
+        return await self.call(self.db.changes_since, version, limit, timeout=timeout)
+
+    async def get_one_user_by_email(self, email: str, timeout: Optional[float] = None) -> Optional[User]:
+        return await self.call(self.db.get_one_user_by_email, email, timeout=timeout)
+
+    async def get_users_by_emails(self, emails: Iterable[str], timeout: Optional[float] = None) -> List[User]:
+        return await self.call(self.db.get_users_by_emails, emails, timeout=timeout)
+
+    async def get_users_by_ids(self, user_ids: Iterable[int], timeout: Optional[float] = None) -> List[User]:
+        return await self.call(self.db.get_users_by_ids, user_ids, timeout=timeout)
+
+    async def reset_user(self, user_id, password, uuid, timeout: Optional[float] = None):
+        return await self.call(self.db.reset_user, user_id, password, uuid, timeout=timeout)
+
+    async def new_registration(
+        self, email_header: str, sender: str, receiver: str, status: str, timeout: Optional[float] = None,
+    ):
+        return await self.call(self.db.new_registration, email_header, sender, receiver, status, timeout=timeout)
+
+    async def enable_user(self, user_id: int, enable: bool, timeout: Optional[float] = None):
+        return await self.call(self.db.enable_user, user_id, enable, timeout=timeout)
+
+    async def load_servers(
+        self, get_relays: bool = True, include_delete: bool = True, get_mix: bool = True,
+        exclude_tail: bool = True, after: Optional[int] = None, timeout: Optional[float] = None,
+    ) -> Tuple[List[Node], List[Relay], List[Mix]]:
+        return await self.call(
+            self.db.load_servers, get_relays, include_delete, get_mix, exclude_tail, after, timeout=timeout,
+        )
+
+    async def all_servers(
+        self, get_relays: bool = True, include_delete: bool = True, get_mix: bool = True,
+        exclude_tail: bool = True, timeout: Optional[float] = None,
+    ) -> List[Node]:
+        return await self.call(
+            self.db.all_servers, get_relays, include_delete, get_mix, exclude_tail, timeout=timeout,
+        )
+
+    async def all_relay_ids(self, timeout: Optional[float] = None) -> List[int]:
+        return await self.call(self.db.all_relay_ids, timeout=timeout)
+
+    async def get_node_by_ip(self, ipv4: str, timeout: Optional[float] = None) -> Node:
+        return await self.call(self.db.get_node_by_ip, ipv4, timeout=timeout)
+
+    async def get_node_by_uuid(self, uuid: str, timeout: Optional[float] = None) -> Node:
+        return await self.call(self.db.get_node_by_uuid, uuid, timeout=timeout)
+
+    async def check_node_port(self, node_uuid: int, timeout: Optional[float] = None):
+        return await self.call(self.db.check_node_port, node_uuid, timeout=timeout)
+
+    async def change_node_port(self, node_uuid: str, port: int, timeout: Optional[float] = None):
+        return await self.call(self.db.change_node_port, node_uuid, port, timeout=timeout)
+
+    async def hide_node(self, node_uuid: str, hide_flag: bool, timeout: Optional[float] = None):
+        return await self.call(self.db.hide_node, node_uuid, hide_flag, timeout=timeout)
+
+    async def get_traffic_after(self, user_id, after, timeout: Optional[float] = None) -> List[Traffic]:
+        return await self.call(self.db.get_traffic_after, user_id, after, timeout=timeout)
+
+    async def traffic_frame(
+        self, start, end, table: str = 'user', fetch_size: int = 50000, timeout: Optional[float] = None,
+    ) -> TrafficFrame:
+        return await self.call(self.db.traffic_frame, start, end, table, fetch_size, timeout=timeout)
+
+    async def user_traffic_on(self, day, timeout: Optional[float] = None) -> List[Tuple[int, int]]:
+        return await self.call(self.db.user_traffic_on, day, timeout=timeout)
+
+    async def get_probe_after(self, after: int, timeout: Optional[float] = None) -> List[Tuple]:
+        return await self.call(self.db.get_probe_after, after, timeout=timeout)
+
+    async def report_abuse_event(self, node_id: str, user_id: int, reason: str, timeout: Optional[float] = None):
+        return await self.call(self.db.report_abuse_event, node_id, user_id, reason, timeout=timeout)
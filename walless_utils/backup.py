@@ -0,0 +1,309 @@
+import io
+import os
+import csv
+import gzip
+import json
+import zlib
+import struct
+import time
+import logging
+from array import array
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .database import DBCommunicator
+from .utils import (
+    USER_COLUMNS, NODE_COLUMNS, TRAFFIC_COLUMNS, SUBLOG_COLUMNS, REGISTRATION_COLUMNS, tn,
+)
+
+logger = logging.getLogger('walless')
+
+MAGIC = b'WLBK'
+FORMAT_VERSION = 2
+# versions that can be restored; version 1 files may hold pickled columns, which are refused
+READ_VERSIONS = (1, 2)
+# magic, format version, length of the json metadata that follows
+_HEADER = struct.Struct('<4sBI')
+# length of the compressed chunk, number of rows; a chunk of 0 rows ends the file
+_CHUNK = struct.Struct('<II')
+# length of a section of a column
+_SECTION = struct.Struct('<Q')
+_EPOCH = datetime(1970, 1, 1)
+_US = timedelta(microseconds=1)
+# kind of a column in a chunk -> code; 8 was pickle
+_KINDS = {'null': 0, 'int': 1, 'float': 2, 'bool': 3, 'date': 4, 'datetime': 5, 'str': 6, 'bytes': 7, 'decimal': 9}
+_KIND_NAMES = {code: kind for kind, code in _KINDS.items()}
+# python type -> kind
+_TYPE_KINDS = {
+    bool: 'bool', int: 'int', float: 'float', datetime: 'datetime', date: 'date', str: 'str', bytes: 'bytes',
+    bytearray: 'bytes', Decimal: 'decimal',
+}
+
+# name -> (table, columns, select statement of DBCommunicator)
+BACKUP_TABLES: Dict[str, Tuple[str, Sequence[str], str]] = {
+    'user': (tn.user, USER_COLUMNS, DBCommunicator.backup_user_sql),
+    'node': (tn.node, NODE_COLUMNS, DBCommunicator.backup_node_sql),
+    'traffic': (tn.traffic, TRAFFIC_COLUMNS, DBCommunicator.backup_traffic_sql),
+    'sublog': (tn.sublog, SUBLOG_COLUMNS, DBCommunicator.backup_sublog_sql),
+    'registration': (tn.reg, REGISTRATION_COLUMNS, DBCommunicator.backup_registration_sql),
+}
+
+
+@dataclass
+class BackupResult:
+    table: str
+    path: str
+    rows: int = 0
+    chunks: int = 0
+    # size of the file
+    size: int = 0
+    elapsed: float = 0.0
+
+
+def _kind(values: Sequence) -> str:
+    # the kind of all the values of a column; bools in an int column (e.g. from a driver that maps BIT) are ints
+    kinds = {_TYPE_KINDS.get(type(v)) for v in values if v is not None}
+    if not kinds:
+        return 'null'
+    if kinds == {'bool', 'int'}:
+        return 'int'
+    if len(kinds) == 1 and None not in kinds:
+        return kinds.pop()
+    types = sorted({type(v).__name__ for v in values if v is not None})
+    raise TypeError(f'Cannot back up a column of {", ".join(types)} values.')
+
+
+def _encode_column(kind: str, values: Sequence) -> List[bytes]:
+    # sections of a column: a null mask, then the values (and an arena for str, bytes and decimal)
+    nulls = bytes(v is None for v in values)
+    if kind == 'null':
+        return []
+    if kind in ('str', 'bytes', 'decimal'):
+        arena, offsets = bytearray(), array('q', [0])
+        for v in values:
+            if v is not None:
+                arena += v if kind == 'bytes' else str(v).encode()
+            offsets.append(len(arena))
+        return [nulls, offsets.tobytes(), bytes(arena)]
+    if kind == 'float':
+        return [nulls, array('d', [0. if v is None else v for v in values]).tobytes()]
+    if kind == 'datetime':
+        if any(v is not None and v.tzinfo is not None for v in values):
+            raise TypeError('aware datetimes are not supported')
+        encoded = [0 if v is None else (v - _EPOCH) // _US for v in values]
+    elif kind == 'date':
+        encoded = [0 if v is None else v.toordinal() for v in values]
+    else:
+        encoded = [0 if v is None else int(v) for v in values]
+    return [nulls, array('q', encoded).tobytes()]
+
+
+def _decode_column(kind: str, sections: List[bytes], n: int) -> List[Any]:
+    if kind == 'null':
+        return [None] * n
+    nulls = sections[0]
+    if kind in ('str', 'bytes', 'decimal'):
+        offsets, arena = array('q'), sections[2]
+        offsets.frombytes(sections[1])
+        values = [arena[offsets[i]:offsets[i + 1]] for i in range(n)]
+        if kind == 'str':
+            values = [v.decode() for v in values]
+        elif kind == 'decimal':
+            values = [Decimal(v.decode()) if v else None for v in values]
+    else:
+        values = array('d' if kind == 'float' else 'q')
+        values.frombytes(sections[1])
+        if kind == 'bool':
+            values = [v != 0 for v in values]
+        elif kind == 'date':
+            values = [date.fromordinal(v) if v else None for v in values]
+        elif kind == 'datetime':
+            values = [_EPOCH + timedelta(microseconds=v) for v in values]
+    return [None if null else v for v, null in zip(values, nulls)]
+
+
+def encode_chunk(rows: Sequence[Sequence], level: int = 6) -> bytes:
+    out = io.BytesIO()
+    columns = list(zip(*rows))
+    for i, values in enumerate(columns):
+        try:
+            kind = _kind(values)
+            sections = _encode_column(kind, values)
+        except (TypeError, OverflowError) as e:
+            # e.g. a type without a kind, or an int beyond 64 bits; nothing is executed on restore, so
+            # such columns have to be cast in the backup statement
+            raise TypeError(f'Column {i}: {e}') from e
+        out.write(bytes([_KINDS[kind], len(sections)]))
+        for section in sections:
+            out.write(_SECTION.pack(len(section)))
+            out.write(section)
+    return zlib.compress(out.getvalue(), level)
+
+
+def decode_chunk(data: bytes, n_rows: int, n_columns: int) -> List[tuple]:
+    view, pos, columns = memoryview(zlib.decompress(data)), 0, list()
+    for _ in range(n_columns):
+        kind, n_sections = _KIND_NAMES.get(view[pos]), view[pos + 1]
+        if kind is None:
+            raise ValueError(f'Unknown column kind {view[pos]} in a backup chunk.')
+        pos += 2
+        sections = list()
+        for _ in range(n_sections):
+            (length,) = _SECTION.unpack_from(view, pos)
+            pos += _SECTION.size
+            sections.append(bytes(view[pos:pos + length]))
+            pos += length
+        columns.append(_decode_column(kind, sections, n_rows))
+    return list(zip(*columns))
+
+
+def export_cursor(
+    cursor, path: str, table: str, fetch_size: int = 10000, fmt: str = 'chunks', level: int = 6,
+) -> BackupResult:
+    """
+    Write the result of an executed query to `path`, one `fetch_size` chunk of rows at a time.
+    `chunks` files hold zlib-compressed column-typed chunks after a header with the table and columns;
+    `csv` files are gzipped CSV with a header row, which loses the types and does not tell NULL from ''.
+    The file is replaced atomically, so a partial backup never overwrites a complete one.
+    """
+    since = time.time()
+    columns = [d[0] for d in cursor.description]
+    result = BackupResult(table=table, path=path)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        if fmt == 'chunks':
+            with open(tmp, 'wb') as fp:
+                meta = json.dumps({'table': table, 'columns': columns, 'created': time.time()}).encode()
+                fp.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(meta)))
+                fp.write(meta)
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    data = encode_chunk(rows, level)
+                    fp.write(_CHUNK.pack(len(data), len(rows)))
+                    fp.write(data)
+                    result.rows += len(rows)
+                    result.chunks += 1
+                fp.write(_CHUNK.pack(0, 0))
+                fp.flush()
+                os.fsync(fp.fileno())
+        elif fmt == 'csv':
+            with gzip.open(tmp, 'wt', newline='', compresslevel=level) as fp:
+                writer = csv.writer(fp)
+                writer.writerow(columns)
+                while True:
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    writer.writerows(rows)
+                    result.rows += len(rows)
+                    result.chunks += 1
+        else:
+            raise ValueError(f'Unknown backup format: {fmt}')
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    result.size = os.path.getsize(path)
+    result.elapsed = time.time() - since
+    return result
+
+
+def read_backup(path: str) -> Tuple[Optional[str], List[str], Iterator[List[tuple]]]:
+    # table (None for CSV), columns, and an iterator over the chunks of rows of a backup file of either format
+    with open(path, 'rb') as fp:
+        is_chunks = fp.read(len(MAGIC)) == MAGIC
+    if not is_chunks:
+        text = gzip.open(path, 'rt', newline='')
+        reader = csv.reader(text)
+        return None, next(reader), _csv_chunks(text, reader)
+    fp = open(path, 'rb')
+    _, version, meta_len = _HEADER.unpack(fp.read(_HEADER.size))
+    if version not in READ_VERSIONS:
+        fp.close()
+        raise ValueError(f'Unknown format version {version} of backup {path}.')
+    meta = json.loads(fp.read(meta_len))
+    return meta['table'], meta['columns'], _chunks(fp, path, len(meta['columns']))
+
+
+def _chunks(fp, path: str, n_columns: int) -> Iterator[List[tuple]]:
+    with fp:
+        while True:
+            header = fp.read(_CHUNK.size)
+            if len(header) < _CHUNK.size:
+                raise ValueError(f'Backup {path} is truncated.')
+            length, n_rows = _CHUNK.unpack(header)
+            if n_rows == 0:
+                return
+            yield decode_chunk(fp.read(length), n_rows, n_columns)
+
+
+def _csv_chunks(fp, reader, size: int = 10000) -> Iterator[List[tuple]]:
+    with fp:
+        chunk = list()
+        for row in reader:
+            chunk.append(tuple(None if v == '' else v for v in row))
+            if len(chunk) >= size:
+                yield chunk
+                chunk = list()
+        if chunk:
+            yield chunk
+
+
+class TableBackup:
+    """
+    Streaming backups of the tables of BACKUP_TABLES, with the `backup_*_sql` statements of DBCommunicator.
+    Only one chunk of rows is in memory at a time, both when exporting and when restoring; restores insert
+    with fast_executemany and commit every batch, so a failed restore leaves the batches before it.
+    """
+    def __init__(self, db: DBCommunicator, fetch_size: int = 10000, batch_size: int = 10000):
+        self.db = db
+        self.fetch_size, self.batch_size = fetch_size, batch_size
+
+    def export(self, name: str, path: str, args=None, fmt: str = 'chunks', level: int = 6) -> BackupResult:
+        # args of the statement: a ut_date for traffic, (start, end) timestamps for sublog and registration
+        table, _, sql = BACKUP_TABLES[name]
+        with self.db.pool.connection() as conn:
+            with conn.cursor() as cur:
+                if args is None:
+                    cur.execute(sql)
+                else:
+                    cur.execute(sql, args)
+                result = export_cursor(cur, path, table, self.fetch_size, fmt, level)
+            conn.commit()
+        logger.info(
+            f'Backed up {result.rows} rows of {table} to {path} ({result.size} bytes) in {result.elapsed:.2f}s.'
+        )
+        return result
+
+    def restore(self, path: str, table: Optional[str] = None, identity_insert: bool = False) -> BackupResult:
+        # `identity_insert` keeps the ids of the rows in MSSQL tables with an identity column
+        since = time.time()
+        file_table, columns, chunks = read_backup(path)
+        table = table or file_table
+        if table is None:
+            raise ValueError(f'The table of backup {path} has to be given, as CSV backups do not record it.')
+        result = BackupResult(table=table, path=path, size=os.path.getsize(path))
+        sql = f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({", ".join(["?"] * len(columns))})'
+        identity_insert = identity_insert and self.db.dialect == 'mssql'
+        with self.db.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.fast_executemany = True
+                if identity_insert:
+                    cur.execute(f'SET IDENTITY_INSERT {table} ON')
+                try:
+                    for rows in chunks:
+                        for start in range(0, len(rows), self.batch_size):
+                            cur.executemany(sql, rows[start:start + self.batch_size])
+                            conn.commit()
+                        result.rows += len(rows)
+                        result.chunks += 1
+                finally:
+                    if identity_insert:
+                        cur.execute(f'SET IDENTITY_INSERT {table} OFF')
+        result.elapsed = time.time() - since
+        logger.info(f'Restored {result.rows} rows of {table} from {path} in {result.elapsed:.2f}s.')
+        return result
@@ -0,0 +1,256 @@
+import math
+import time
+import logging
+from contextlib import contextmanager
+from threading import Condition, local
+from typing import Callable, List, Dict, Any, Optional
+
+logger = logging.getLogger('walless')
+
+
+class PooledConnection:
+    """
+    A raw DB connection plus the bookkeeping needed by ConnectionPool.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.created = time.time()
+        self.last_used = self.created
+        # number of times this connection has been handed out
+        self.uses = 0
+        # if set as True, the connection is closed instead of returned to the pool
+        self.broken = False
+        # query timeout in seconds of the cursors created from now on, 0 for none
+        self.timeout = 0
+        # a cursor per registered statement and query timeout, see statement_cursor
+        self.cursors: Dict[tuple, Any] = dict()
+        # statement name -> positions of its projection in the result set, checked once per connection
+        self.projectors: Dict[str, Optional[List[int]]] = dict()
+
+    @property
+    def reused(self) -> bool:
+        return self.uses > 1
+
+    def set_timeout(self, seconds: int):
+        # pyodbc sets the query timeout of a cursor when creating it, and the driver cancels
+        # a statement of the cursor that runs longer
+        if seconds != self.timeout:
+            self.conn.timeout = self.timeout = seconds
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def statement_cursor(self, name: str):
+        # pyodbc only prepares a statement when it differs from the last one run on the cursor,
+        # so a statement that keeps its own cursor stays prepared on this connection
+        key = (name, self.timeout)
+        cur = self.cursors.get(key)
+        if cur is None:
+            cur = self.cursors[key] = self.conn.cursor()
+        return cur
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        for cur in self.cursors.values():
+            try:
+                cur.close()
+            except Exception:
+                pass
+        self.cursors.clear()
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    A bounded, thread-safe pool of DB connections.
+    Idle connections are reused in LIFO order. A connection is evicted if it stays idle longer
+    than `max_idle` or lives longer than `max_lifetime` (in seconds), and is pinged before reuse
+    if it has been idle longer than `ping_after`.
+    Statements run on an acquired connection are cancelled by the driver after `query_timeout` seconds
+    (0 for no limit), or after the limit of the innermost `statement_timeout` block of the thread.
+    """
+    def __init__(
+        self, connect: Callable, max_size: int = 8, max_idle: float = 300, max_lifetime: float = 3600,
+        ping_after: float = 30, timeout: float = 30, ping_sql: str = 'SELECT 1', query_timeout: float = 0,
+    ):
+        self._connect = connect
+        self.max_size = max_size
+        self.max_idle, self.max_lifetime = max_idle, max_lifetime
+        self.ping_after, self.ping_sql = ping_after, ping_sql
+        # how long to wait for a free connection before raising TimeoutError
+        self.timeout = timeout
+        self.query_timeout = query_timeout
+        self._local = local()
+        self._idle: List[PooledConnection] = list()
+        # number of open connections, idle or in use
+        self._size = 0
+        self._cond = Condition()
+        self._closed = False
+        # metrics
+        self.created = self.evicted = self.failed_pings = 0
+        self.acquired = self.waits = 0
+        self.wait_time = self.max_wait_time = 0.0
+
+    def current_timeout(self) -> float:
+        # the query timeout of the statements of this thread
+        return getattr(self._local, 'query_timeout', self.query_timeout)
+
+    @contextmanager
+    def statement_timeout(self, seconds: Optional[float]):
+        # cancel the statements run by this thread in the block after `seconds`; None keeps the current limit
+        previous = self.current_timeout()
+        self._local.query_timeout = previous if seconds is None else seconds
+        try:
+            yield
+        finally:
+            self._local.query_timeout = previous
+
+    def _expired(self, pc: PooledConnection, now: float) -> bool:
+        return now - pc.last_used > self.max_idle or now - pc.created > self.max_lifetime
+
+    def _discard(self, pc: PooledConnection):
+        # the caller must hold self._cond
+        self._size -= 1
+        self.evicted += 1
+        self._cond.notify()
+
+    def _ping(self, pc: PooledConnection) -> bool:
+        try:
+            with pc.cursor() as cur:
+                cur.execute(self.ping_sql)
+                cur.fetchall()
+            pc.commit()
+            return True
+        except Exception as e:
+            logger.debug(f'Connection ping failed: {e}')
+            self.failed_pings += 1
+            return False
+
+    def acquire(self, timeout: float = None) -> PooledConnection:
+        since = time.time()
+        deadline = since + (self.timeout if timeout is None else timeout)
+        while True:
+            pc, create, stale = None, False, list()
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError('Connection pool is closed.')
+                    now = time.time()
+                    while self._idle:
+                        candidate = self._idle.pop()
+                        if self._expired(candidate, now):
+                            self._discard(candidate)
+                            stale.append(candidate)
+                            continue
+                        pc = candidate
+                        break
+                    if pc is not None:
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        create = True
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise TimeoutError(f'No DB connection available after {time.time() - since:.2f}s.')
+                    self.waits += 1
+                    self._cond.wait(remaining)
+            for s in stale:
+                s.close()
+
+            if create:
+                try:
+                    pc = PooledConnection(self._connect())
+                except BaseException:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self.created += 1
+            elif time.time() - pc.last_used > self.ping_after and not self._ping(pc):
+                # stale connection, e.g. killed by the server or a middlebox; reconnect
+                with self._cond:
+                    self._discard(pc)
+                pc.close()
+                continue
+
+            waited = time.time() - since
+            with self._cond:
+                self.acquired += 1
+                self.wait_time += waited
+                self.max_wait_time = max(self.max_wait_time, waited)
+            pc.uses += 1
+            # ODBC query timeouts are whole seconds
+            pc.set_timeout(math.ceil(self.current_timeout()))
+            return pc
+
+    def release(self, pc: PooledConnection):
+        pc.last_used = time.time()
+        with self._cond:
+            if pc.broken or self._closed or self._expired(pc, pc.last_used):
+                self._discard(pc)
+            else:
+                self._idle.append(pc)
+                self._cond.notify()
+                return
+        pc.close()
+
+    @contextmanager
+    def connection(self, timeout: float = None):
+        pc = self.acquire(timeout)
+        try:
+            yield pc
+        except BaseException:
+            try:
+                pc.rollback()
+            except Exception:
+                pc.broken = True
+            raise
+        finally:
+            self.release(pc)
+
+    def prune(self):
+        # close idle connections that are past max_idle or max_lifetime
+        with self._cond:
+            now = time.time()
+            stale = [pc for pc in self._idle if self._expired(pc, now)]
+            self._idle = [pc for pc in self._idle if not self._expired(pc, now)]
+            for pc in stale:
+                self._discard(pc)
+        for pc in stale:
+            pc.close()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, list()
+            for pc in idle:
+                self._discard(pc)
+            self._cond.notify_all()
+        for pc in idle:
+            pc.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'max_size': self.max_size,
+                'created': self.created,
+                'evicted': self.evicted,
+                'failed_pings': self.failed_pings,
+                'acquired': self.acquired,
+                'waits': self.waits,
+                'avg_wait_time': self.wait_time / self.acquired if self.acquired else 0.0,
+                'max_wait_time': self.max_wait_time,
+            }
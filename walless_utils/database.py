@@ -1,10 +1,15 @@
 import time
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Dict, Any, Iterable, Callable
+from dataclasses import dataclass
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 import pyodbc
 
-from .objects import User, Node, Traffic, Relay, link_relays, Mix, link_mixes
+from .connection_pool import ConnectionPool, PooledConnection
+from .statements import statements, Statement, IN_CHUNK, MIGRATIONS
+from .objects import User, Node, Traffic, TrafficFrame, Relay, link_relays, Mix, link_mixes
 from .utils import (
     USER_COLUMNS, NODE_COLUMNS, TRAFFIC_COLUMNS, MIX_COLUMNS,
     RELAY_COLUMNS, tn, SUBLOG_COLUMNS, REGISTRATION_COLUMNS,
@@ -14,11 +19,35 @@ from .utils import (
 logger = logging.getLogger('walless')
 
 
+@dataclass
+class UpsertResult:
+    # number of input rows, and of distinct keys they were grouped into
+    rows: int = 0
+    keys: int = 0
+    # as reported by the DB; MySQL counts an updated row twice
+    affected: int = 0
+    batches: int = 0
+    elapsed: float = 0.0
+
+
+def group_traffic(rows: Iterable[Tuple]) -> Dict[Tuple, List[int]]:
+    # (ut_date, user_id, node_id, upload, download) rows -> {(ut_date, user_id, node_id): [upload, download]}
+    ret: Dict[Tuple, List[int]] = dict()
+    for ut_date, user_id, node_id, upload, download in rows:
+        acc = ret.get((ut_date, user_id, node_id))
+        if acc is None:
+            ret[(ut_date, user_id, node_id)] = [upload, download]
+        else:
+            acc[0] += upload
+            acc[1] += download
+    return ret
+
+
 class DBCommunicator:
     insert_sublog_sql = f'INSERT INTO {tn.sublog} (ts, ip, remarks, proxy_group, user_id) VALUES (?, ?, ?, ?, ?)'
     update_user_sql = f"UPDATE {tn.user} SET balance = balance + (?), upload = upload + (?), download = download + (?), last_change = ?, last_activity = ? WHERE user_id = ?"
     update_user_balance_sql = f"UPDATE {tn.user} SET balance = ?, last_change = ? WHERE user_id = ?"
-    update_node_sql = f"UPDATE {tn.node} SET upload = upload + (?), download = download + (?) WHERE uuid = ?"
+    update_node_sql = f"UPDATE {tn.node} SET upload = upload + (?), download = download + (?), last_change = ? WHERE uuid = ?"
     get_log_sql = f'SELECT TOP 20000 log_id, user_id, node_id, upload, download, ts FROM {tn.traffic_log} ORDER BY log_id ASC'
     delete_log_sql = f'DELETE FROM {tn.traffic_log} WHERE log_id <= ?'
     upload_log_sql = f'INSERT INTO {tn.traffic_log} (user_id, node_id, upload, download, ts) VALUES (?, ?, ?, ?, ?)'
@@ -33,6 +62,25 @@ BEGIN
    INSERT INTO {tn.traffic}(ut_date, upload, download, node_id, user_id) VALUES(?, ?, ?, ?, ?)
 END
 """ # need 3 + 5 + 5 = 13 args
+    # set-based version of the above, used by upsert_traffic
+    create_traffic_delta_sql = f"""
+IF OBJECT_ID('tempdb..#traffic_delta') IS NOT NULL DROP TABLE #traffic_delta;
+SELECT TOP 0 ut_date, user_id, node_id, upload, download INTO #traffic_delta FROM {tn.traffic};
+"""
+    insert_traffic_delta_sql = 'INSERT INTO #traffic_delta (ut_date, user_id, node_id, upload, download) VALUES (?, ?, ?, ?, ?)'
+    merge_traffic_delta_sql = f"""
+MERGE {tn.traffic} WITH (HOLDLOCK) AS t
+USING #traffic_delta AS s
+ON t.ut_date = s.ut_date AND t.user_id = s.user_id AND t.node_id = s.node_id
+WHEN MATCHED THEN UPDATE SET upload = t.upload + s.upload, download = t.download + s.download
+WHEN NOT MATCHED THEN INSERT (ut_date, upload, download, node_id, user_id)
+    VALUES (s.ut_date, s.upload, s.download, s.node_id, s.user_id);
+"""
+    # needs a unique key on (ut_date, user_id, node_id)
+    upsert_traffic_mysql_sql = (
+        f'INSERT INTO {tn.traffic} (ut_date, user_id, node_id, upload, download) VALUES {{values}} '
+        'ON DUPLICATE KEY UPDATE upload = upload + VALUES(upload), download = download + VALUES(download)'
+    )
 
     # used for backup script
     backup_user_sql = f'SELECT {",".join(USER_COLUMNS)} FROM {tn.user}'
@@ -48,6 +96,57 @@ END
 
     def __init__(self, conn_cfgs):
         self.conn_cfgs = conn_cfgs
+        self._pool: Optional[ConnectionPool] = None
+        self._pool_lock = Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        # seconds spent on each query of the last load_servers ('db' is the wall time of all of them)
+        # and on linking them ('link')
+        self.servers_timing: Dict[str, float] = dict()
+
+    @property
+    def pool(self) -> ConnectionPool:
+        # created lazily, as conn_cfgs is usually filled in by db_setup after construction
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    self._pool = ConnectionPool(self.connection, **self.conn_cfgs.get('pool', {}))
+        return self._pool
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # runs independent queries concurrently
+        if self._executor is None:
+            with self._pool_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix='walless-query')
+        return self._executor
+
+    def pool_stats(self) -> Dict[str, Any]:
+        return self.pool.stats()
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool = None
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+    @property
+    def dialect(self) -> str:
+        return self.conn_cfgs['type']
+
+    @staticmethod
+    def is_disconnect(e: Exception) -> bool:
+        # SQLSTATE class 08 is "connection exception"; HYT00/HYT01 are query timeouts, see
+        # ConnectionPool.statement_timeout, and must not be retried
+        state = str(e.args[0]) if e.args else ''
+        if state in ('HYT00', 'HYT01'):
+            return False
+        if isinstance(e, (pyodbc.OperationalError, pyodbc.InterfaceError)):
+            return True
+        return state.startswith('08')
 
     def connection(self):
         if self.conn_cfgs['type'] == 'mysql':
@@ -95,30 +194,183 @@ END
     def execute(
         self, sql, query=True, func_to_apply=None, args=None, bulk=False
     ) -> Optional[list]:
-        conn = self.connection()
-        with conn.cursor() as cur:
-            ret = self.execute_cursor(cur, sql, query, func_to_apply, args, bulk)
+        def work(conn: PooledConnection):
+            with conn.cursor() as cur:
+                return self.execute_cursor(cur, sql, query, func_to_apply, args, bulk)
+        return self._retrying(work)
+
+    def run(self, name: str, args=None, query=True, func_to_apply=None) -> Optional[list]:
+        # execute a statement of the registry (see statements.py) by name
+        return self._retrying(lambda conn: self.run_statement(conn, self.statement(name), args, query, func_to_apply))
+
+    def statement(self, name: str) -> Statement:
+        return statements.get(name, self.dialect)
+
+    @staticmethod
+    def run_statement(
+        conn: PooledConnection, st: Statement, args=None, query=True, func_to_apply=None,
+    ) -> Optional[list]:
+        """
+        Execute a registered statement on its own cursor of the connection, which keeps it prepared.
+        The rows of a query are reordered to the projection of the statement if the result set has its
+        columns in another order, and an error is raised if any of them is missing.
+        """
+        logger.debug(f'Executing statement {st.name}: {st.sql}')
+        cur = conn.statement_cursor(st.name)
+        if args is None:
+            cur.execute(st.sql)
+        else:
+            cur.execute(st.sql, args)
         if not query:
+            return None
+        rows = cur.fetchall()
+        if st.name not in conn.projectors:
+            conn.projectors[st.name] = st.projector(cur.description)
+        positions = conn.projectors[st.name]
+        if positions is not None:
+            rows = [[row[i] for i in positions] for row in rows]
+        if func_to_apply is None:
+            return list(rows)
+        return list(map(func_to_apply, rows))
+
+    def migrate(self, name: str):
+        # apply a schema migration of statements.MIGRATIONS; the steps are not idempotent, so run it once
+        with self.pool.connection() as conn:
+            for step in MIGRATIONS[name]:
+                try:
+                    st = self.statement(step)
+                except ValueError:
+                    # not needed on this dialect
+                    continue
+                logger.info(f'Migration {name}: {step}')
+                with conn.cursor() as cur:
+                    cur.execute(st.sql)
+                conn.commit()
+
+    def _retrying(self, work: Callable[[PooledConnection], Any]) -> Any:
+        while True:
+            with self.pool.connection() as conn:
+                try:
+                    ret = work(conn)
+                except pyodbc.Error as e:
+                    # nothing is committed yet, so it is safe to retry once on a fresh connection
+                    if not (conn.reused and self.is_disconnect(e)):
+                        raise
+                    logger.warning(f'Stale DB connection ({e}). Reconnecting.')
+                    conn.broken = True
+                    continue
+                # also ends the implicit transaction opened by a query
+                conn.commit()
+                return ret
+
+    # traffic table
+
+    @classmethod
+    def upsert_traffic_cursor(
+        cls, cursor, rows: Iterable[Tuple], dialect: str, batch_size: int = 1000,
+    ) -> UpsertResult:
+        """
+        Add (ut_date, user_id, node_id, upload, download) rows to the traffic table.
+        Rows are grouped by (ut_date, user_id, node_id) first, then applied with one set-based
+        statement per batch. It does not commit.
+        """
+        since = time.time()
+        rows = list(rows)
+        grouped = [(*key, upload, download) for key, (upload, download) in group_traffic(rows).items()]
+        ret = UpsertResult(rows=len(rows), keys=len(grouped))
+        if dialect == 'mssql':
+            cursor.execute(cls.create_traffic_delta_sql)
+        for start in range(0, len(grouped), batch_size):
+            batch = grouped[start:start+batch_size]
+            if dialect == 'mssql':
+                cursor.fast_executemany = True
+                cursor.executemany(cls.insert_traffic_delta_sql, batch)
+                cursor.execute(cls.merge_traffic_delta_sql)
+                ret.affected += cursor.rowcount
+                cursor.execute('TRUNCATE TABLE #traffic_delta')
+            elif dialect == 'mysql':
+                values = ', '.join(['(?, ?, ?, ?, ?)'] * len(batch))
+                cursor.execute(cls.upsert_traffic_mysql_sql.format(values=values), [v for row in batch for v in row])
+                ret.affected += cursor.rowcount
+            else:
+                raise ValueError(f'Unsupported DB type: {dialect}')
+            ret.batches += 1
+        if dialect == 'mssql':
+            cursor.execute('DROP TABLE #traffic_delta')
+        ret.elapsed = time.time() - since
+        return ret
+
+    def upsert_traffic(self, rows: Iterable[Tuple], batch_size: int = 1000) -> UpsertResult:
+        with self.pool.connection() as conn:
+            with conn.cursor() as cur:
+                ret = self.upsert_traffic_cursor(cur, rows, self.dialect, batch_size)
             conn.commit()
-        conn.close()
+        logger.debug(
+            f'Upserted {ret.rows} traffic rows as {ret.keys} keys in {ret.batches} batches, '
+            f'{ret.affected} rows affected, {ret.elapsed:.2f}s.'
+        )
         return ret
 
     # user table
     def all_users(self, enable_only=True, after=-1) -> List[User]:
-        sql = f"SELECT {','.join(USER_COLUMNS)} FROM {tn.user} WHERE last_change > {after}"
-        if enable_only:
-            sql += ' AND enabled != 0'
-        return self.execute(sql, query=True, func_to_apply=User.from_list)
+        return self.run(
+            'all_enabled_users' if enable_only else 'all_users', args=[after], func_to_apply=User.from_list,
+        )
+
+    def changes_since(self, version: int, limit: int = 50000) -> Tuple[List[User], int]:
+        """
+        Users changed after `version`, in the order of their changes, and the version to pass next time.
+        Disabled users are included, so consumers can drop them. Every change is returned exactly once:
+        On MSSQL, `row_version` is a ROWVERSION column, and rows are only read below
+        MIN_ACTIVE_ROWVERSION(), so a version is never skipped because its transaction commits late.
+        On MySQL, `row_version` is a BIGINT set by the insert and update triggers of the table from a
+        counter row (`UPDATE ... SET v = LAST_INSERT_ID(v + 1)`), whose row lock makes versions commit in order.
+        At most `limit` users are returned; call it again with the returned version if that many were.
+        The column (and the MySQL triggers) are added by `migrate('user_row_version')`.
+        """
+        def work(conn: PooledConnection):
+            if self.dialect == 'mssql':
+                bound = self.run_statement(conn, self.statement('min_active_rowversion'))[0][0]
+                return bound, self.run_statement(conn, self.statement('user_changes'), [limit, version, bound])
+            elif self.dialect == 'mysql':
+                return None, self.run_statement(conn, self.statement('user_changes'), [version, limit])
+            raise ValueError(f'Unsupported DB type: {self.dialect}')
+        bound, rows = self._retrying(work)
+        users = [User.from_list(row[:-1]) for row in rows]
+        if len(rows) == limit or bound is None:
+            # more rows may follow; continue after the last one
+            return users, rows[-1][-1] if rows else version
+        # everything below the bound has been read
+        return users, max(version, bound - 1)
 
     def get_one_user_by_email(self, email: str) -> Optional[User]:
-        ret = self.execute(
-            f"SELECT {','.join(USER_COLUMNS)} FROM {tn.user} WHERE email=?",
-            query=True, func_to_apply=User.from_list, args=[email],
-        )
+        ret = self.run('user_by_email', args=[email], func_to_apply=User.from_list)
         if len(ret) == 0:
             return None
         return ret[0]
 
+    def get_users_by_emails(self, emails: Iterable[str]) -> List[User]:
+        return self._run_in('users_by_emails', emails, User.from_list)
+
+    def get_users_by_ids(self, user_ids: Iterable[int]) -> List[User]:
+        return self._run_in('users_by_ids', user_ids, User.from_list)
+
+    def _run_in(self, name: str, values: Iterable, func_to_apply=None) -> list:
+        # run an `IN (...)` statement over distinct values in chunks of IN_CHUNK, all on one connection
+        values = list(dict.fromkeys(values))
+        if len(values) == 0:
+            return []
+
+        def work(conn: PooledConnection):
+            st, ret = self.statement(name), list()
+            for start in range(0, len(values), IN_CHUNK):
+                chunk = values[start:start+IN_CHUNK]
+                # pad with the last value, which does not change the result
+                chunk += [chunk[-1]] * (IN_CHUNK - len(chunk))
+                ret += self.run_statement(conn, st, chunk, func_to_apply=func_to_apply)
+            return ret
+        return self._retrying(work)
+
     def reset_user(self, user_id, password, uuid):
         try:
             change = int(time.time())
@@ -145,82 +397,141 @@ END
 
     # node table
 
-    def all_servers(
+    def load_servers(
             self,
             get_relays: bool = True,
             include_delete: bool = True,
             get_mix: bool = True,
             exclude_tail: bool = True,
-        ) -> List[Node]:
+            after: Optional[int] = None,
+        ) -> Tuple[List[Node], List[Relay], List[Mix]]:
+        """
+        Read nodes, relays and mixes without linking them.
+        If `after` is set, only nodes and relays with `last_change > after` are read; the columns are added by
+        `migrate('node_last_change')`, and every writer of the node and relay tables must move them.
+        Mixes are always read in full, as the mix table has no key to track changes with.
+        """
         sql = f"SELECT {' , '.join(NODE_COLUMNS)} FROM {tn.node} "
-        conditions = []
+        conditions, args = [], []
         if not include_delete:
             conditions += ['deleted = 0']
         if exclude_tail:
             conditions += ['node_id < 10000']
+        if after is not None:
+            conditions += ['last_change > ?']
+            args += [after]
         if conditions:
             sql += ' WHERE ' + ' AND '.join(conditions)
-        nodes = self.execute(sql, query=True, func_to_apply=Node.from_list)
+        queries = {'nodes': (sql, Node.from_list, args or None)}
+        if get_relays:
+            sql = f"SELECT {' , '.join(RELAY_COLUMNS)} FROM {tn.relay}"
+            if after is not None:
+                queries['relays'] = (sql + ' WHERE last_change > ?', Relay.from_list, [after])
+            else:
+                queries['relays'] = (sql, Relay.from_list, None)
+        if get_mix:
+            queries['mixes'] = (f'SELECT {",".join(MIX_COLUMNS)} from {tn.mix}', Mix.from_list, None)
+
+        # the worker threads keep the query timeout of the caller
+        query_timeout = self.pool.current_timeout()
+
+        def timed(name, sql, func, args):
+            since = time.time()
+            with self.pool.statement_timeout(query_timeout):
+                ret = self.execute(sql, query=True, func_to_apply=func, args=args)
+            timing[name] = time.time() - since
+            return ret
+
+        # the queries run concurrently, each on its own pooled connection
+        since, timing = time.time(), dict()
+        futures = {
+            name: self.executor.submit(timed, name, *query) for name, query in queries.items()
+        }
+        ret = {name: fut.result() for name, fut in futures.items()}
+        timing['db'] = time.time() - since
+        self.servers_timing = timing
+        return ret['nodes'], ret.get('relays', []), ret.get('mixes', [])
+
+    def all_servers(
+            self,
+            get_relays: bool = True,
+            include_delete: bool = True,
+            get_mix: bool = True,
+            exclude_tail: bool = True,
+        ) -> List[Node]:
+        nodes, relays, mixes = self.load_servers(get_relays, include_delete, get_mix, exclude_tail)
+        since = time.time()
+        uuid2node = {n.uuid: n for n in nodes}
         if get_relays:
-            relays = self.execute(f"SELECT {' , '.join(RELAY_COLUMNS)} FROM {tn.relay}", True, Relay.from_list)
-            link_relays(nodes, relays)
+            link_relays(nodes, relays, uuid2node)
         if get_mix:
-            mixes = self.execute(f'SELECT {",".join(MIX_COLUMNS)} from {tn.mix}', query=True, func_to_apply=Mix.from_list)
-            link_mixes(nodes, mixes)
+            link_mixes(nodes, mixes, uuid2node)
         nodes.sort(key=lambda x: x.node_id)
+        self.servers_timing['link'] = time.time() - since
         return nodes
 
+    def all_relay_ids(self) -> List[int]:
+        return [row[0] for row in self.run('all_relay_ids')]
+
     def get_node_by_ip(self, ipv4: str) -> Node:
-        ret = self.execute(
-            f"SELECT * FROM {tn.node} WHERE ipv4=? AND deleted = 0",
-            query=True, func_to_apply=Node.from_list, args=[ipv4]
-        )
+        ret = self.run('node_by_ip', args=[ipv4], func_to_apply=Node.from_list)
         if len(ret) == 1:
             return ret[0]
         return None
 
     def get_node_by_uuid(self, uuid: str) -> Node:
         # this retrieves deleted node as well
-        ret = self.execute(
-            f"SELECT {','.join(NODE_COLUMNS)} FROM {tn.node} WHERE uuid=?",
-            query=True, func_to_apply=Node.from_list, args=[uuid]
-        )
+        ret = self.run('node_by_uuid', args=[uuid], func_to_apply=Node.from_list)
         if len(ret) == 1:
             return ret[0]
         return None
 
     def check_node_port(self, node_uuid: int):
-        return self.execute(
-            f'SELECT port FROM {tn.node} WHERE node_uuid = ?', args=[node_uuid], query=True
-        )[0][0]
+        return self.run('node_port', args=[node_uuid])[0][0]
 
     def change_node_port(self, node_uuid: str, port: int):
         self.execute(
-            f'UPDATE {tn.node} SET port = ? WHERE uuid = ?',
-            args=[port, node_uuid], query=False,
+            f'UPDATE {tn.node} SET port = ?, last_change = ? WHERE uuid = ?',
+            args=[port, int(time.time()), node_uuid], query=False,
         )
 
     def hide_node(self, node_uuid: str, hide_flag: bool):
         self.execute(
-            f'UPDATE {tn.node} SET hidden = ? WHERE uuid = ?',
-            args=[bool(hide_flag), node_uuid], query=False,
+            f'UPDATE {tn.node} SET hidden = ?, last_change = ? WHERE uuid = ?',
+            args=[bool(hide_flag), int(time.time()), node_uuid], query=False,
         )
 
     # user traffic table
 
     def get_traffic_after(self, user_id, after) -> List[Traffic]:
-        return self.execute(
-            f'SELECT {",".join(USER_TRAFFIC_COLUMNS)} FROM {tn.user_traffic} WHERE ut_date > ? AND user_id = ?',
-            args=(after, user_id), func_to_apply=Traffic.from_list_user, query=True,
-        )
+        return self.run('user_traffic_after', args=[after, user_id], func_to_apply=Traffic.from_list_user)
+
+    def traffic_frame(self, start, end, table: str = 'user', fetch_size: int = 50000) -> TrafficFrame:
+        """
+        Traffic with start <= ut_date < end as NumPy columns, from the `traffic`, `user` or `node` traffic
+        table. Rows are streamed with fetchmany, so only `fetch_size` of them exist as Python objects at once.
+        """
+        names = {'traffic': 'traffic_between', 'user': 'user_traffic_between', 'node': 'node_traffic_between'}
+        if table not in names:
+            raise ValueError(f'Unknown traffic table: {table}')
+
+        def work(conn: PooledConnection) -> TrafficFrame:
+            st = self.statement(names[table])
+            cur = conn.statement_cursor(st.name)
+            cur.execute(st.sql, [start, end])
+            # raises if a column is missing; the frame is keyed by name, so the order does not matter
+            st.projector(cur.description)
+            return TrafficFrame.from_cursor(cur, fetch_size=fetch_size)
+        return self._retrying(work)
+
+    def user_traffic_on(self, day) -> List[Tuple[int, int]]:
+        # (user_id, upload + download) of every user with traffic on the day
+        return [(row[0], row[1] + row[2]) for row in self.run('user_traffic_on', args=[day])]
 
     # probe table
 
     def get_probe_after(self, after: int) -> List[Tuple]:
-        return self.execute(
-            f'SELECT ip, port, probe_result, ts from {tn.probe} WHERE ts > ?',
-            args=[after], query=True,
-        )
+        return self.run('probe_after', args=[after])
 
     # abuse event
 
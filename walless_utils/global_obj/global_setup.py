@@ -5,6 +5,7 @@ from .logger_setup import logger_setup
 from .config_setup import config_setup
 from .db_setup import db_setup
 from .pool_setup import pool_setup, node_pool, user_pool
+from .refresh_setup import refresh_setup
 from .abs_setup import AbstractSetup
 
 logger = logging.getLogger('walless')
@@ -18,7 +19,7 @@ class EverythingSetup(AbstractSetup):
 
     def setup(
         self, log_paths=None, user_pool_kwargs=None, node_pool_kwargs=None,
-        pull_node=False, pull_user=False, add_notifier=False,
+        pull_node=False, pull_user=False, add_notifier=False, refresh=False, refresh_kwargs=None,
     ):
         logger_setup(log_paths=log_paths)
         config_setup()
@@ -34,6 +35,9 @@ class EverythingSetup(AbstractSetup):
             since = time.time()
             user_pool.pull(force=True)
             logger.info(f'User pool pull finished in {time.time()-since:.2f}s.')
+        if refresh:
+            # keep the pools up to date in the background
+            refresh_setup(**(refresh_kwargs or {}))
         if add_notifier:
             logger_setup.add_notifier()
 
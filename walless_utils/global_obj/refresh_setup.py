@@ -0,0 +1,186 @@
+import logging
+import random
+import time
+from dataclasses import dataclass, field
+from threading import Condition, Thread
+from typing import Callable, Dict, List, Optional
+
+from .abs_setup import AbstractSetup
+from .pool_setup import pool_setup, user_pool, node_pool
+
+logger = logging.getLogger('walless')
+
+
+@dataclass
+class RefreshJob:
+    name: str
+    func: Callable[[], None]
+    interval: float
+    # the delay between runs is randomized by +-jitter (a fraction of it), so hosts do not pull in lockstep
+    jitter: float = 0.1
+    max_backoff: float = 600
+    # staleness SLA in seconds; defaults to three intervals
+    max_staleness: Optional[float] = None
+    next_run: float = 0.
+    last_run: float = 0.
+    last_success: float = 0.
+    failures: int = 0
+    runs: int = 0
+    last_error: Optional[str] = None
+    # set while the job is over its SLA, so the error is logged once
+    alerted: bool = field(default=False, repr=False)
+
+    def __post_init__(self):
+        if self.max_staleness is None:
+            self.max_staleness = 3 * self.interval
+
+    def staleness(self, now: Optional[float] = None) -> float:
+        # seconds since the last successful run
+        if not self.last_success:
+            return float('inf')
+        return (time.time() if now is None else now) - self.last_success
+
+
+class RefreshScheduler:
+    """
+    Runs periodic refreshes (e.g. UserPool.refresh and NodePool.refresh) on one daemon thread.
+    After a failure, a job is retried with exponential backoff (`interval * 2**failures`, capped by
+    `max_backoff`). `staleness()` tells how long ago a job last succeeded, and an error is logged when
+    it exceeds the SLA of the job.
+    """
+    def __init__(self):
+        self.cond = Condition()
+        self.jobs: Dict[str, RefreshJob] = dict()
+        self.thread: Optional[Thread] = None
+        self.stopped = False
+
+    def add(
+        self, name: str, func: Callable[[], None], interval: float, jitter: float = 0.1,
+        max_backoff: float = 600, max_staleness: Optional[float] = None, delay: float = 0.,
+    ) -> RefreshJob:
+        job = RefreshJob(name, func, interval, jitter, max_backoff, max_staleness, next_run=time.time() + delay)
+        with self.cond:
+            self.jobs[name] = job
+            self.cond.notify()
+        return job
+
+    def remove(self, name: str):
+        with self.cond:
+            self.jobs.pop(name, None)
+            self.cond.notify()
+
+    def trigger(self, name: str):
+        # run the job as soon as possible
+        with self.cond:
+            self.jobs[name].next_run = time.time()
+            self.cond.notify()
+
+    def start(self):
+        with self.cond:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.stopped = False
+            self.thread = Thread(target=self._loop, name='walless-refresh', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def _next(self) -> Optional[RefreshJob]:
+        # wait for the next due job; returns None once stopped
+        with self.cond:
+            while not self.stopped:
+                due = min(self.jobs.values(), key=lambda j: j.next_run, default=None)
+                wait = None if due is None else due.next_run - time.time()
+                if wait is not None and wait <= 0:
+                    return due
+                self.cond.wait(wait)
+        return None
+
+    def _loop(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            try:
+                self._run(job)
+            except Exception:
+                # keep the thread alive for the other jobs
+                logger.exception(f'Scheduling refresh job {job.name} failed.')
+                job.next_run = time.time() + job.interval
+
+    def _run(self, job: RefreshJob):
+        job.last_run = time.time()
+        job.runs += 1
+        try:
+            job.func()
+        except Exception as e:
+            job.failures += 1
+            job.last_error = repr(e)
+            delay = min(job.interval * 2 ** job.failures, job.max_backoff)
+            logger.warning(f'Refreshing {job.name} failed {job.failures} time(s) ({e}). Retrying in {delay:.0f}s.')
+        else:
+            job.failures = 0
+            job.last_error = None
+            job.last_success = time.time()
+            delay = job.interval
+        job.next_run = time.time() + delay * (1 + random.uniform(-job.jitter, job.jitter))
+        # the job object is used even if it was removed meanwhile
+        staleness = job.staleness()
+        overdue = staleness > job.max_staleness
+        if overdue and not job.alerted:
+            logger.error(f'{job.name} is stale for {staleness:.0f}s, over its SLA of {job.max_staleness:.0f}s.')
+        job.alerted = overdue
+
+    def staleness(self, name: Optional[str] = None) -> float:
+        # seconds since the last successful refresh of the job, or of the stalest job if name is None
+        with self.cond:
+            jobs: List[RefreshJob] = list(self.jobs.values()) if name is None else [self.jobs[name]]
+        now = time.time()
+        return max((j.staleness(now) for j in jobs), default=0.)
+
+    def overdue(self) -> List[str]:
+        # names of the jobs over their staleness SLA
+        with self.cond:
+            jobs = list(self.jobs.values())
+        return [job.name for job in jobs if job.staleness() > job.max_staleness]
+
+    def stats(self) -> Dict[str, Dict[str, object]]:
+        with self.cond:
+            jobs = list(self.jobs.values())
+        return {
+            job.name: {
+                'staleness': job.staleness(), 'runs': job.runs, 'failures': job.failures,
+                'next_run': job.next_run, 'last_error': job.last_error,
+            }
+            for job in jobs
+        }
+
+
+refresh_scheduler = RefreshScheduler()
+
+
+class RefreshSetup(AbstractSetup):
+    def __init__(self):
+        super().__init__()
+        self.name = 'refresh'
+        self.log_level = 1
+
+    def setup(self, user_interval=None, node_interval=None, refresh_user=True, refresh_node=True, **job_kwargs):
+        # intervals default to the min_gap of the pools
+        pool_setup()
+        if refresh_user:
+            user_pool.scheduled = True
+            refresh_scheduler.add('user_pool', user_pool.refresh, user_interval or user_pool.min_gap, **job_kwargs)
+        if refresh_node:
+            node_pool.scheduled = True
+            refresh_scheduler.add('node_pool', node_pool.refresh, node_interval or node_pool.min_gap, **job_kwargs)
+        refresh_scheduler.start()
+
+
+refresh_setup = RefreshSetup()
@@ -1,5 +1,6 @@
-from .node import Node, Relay, link_relays, Mix, link_mixes
+from .node import Node, Relay, link_relays, unlink_relay, Mix, link_mixes
 from .traffic import Traffic
+from .traffic_frame import TrafficFrame
 from .user import User
 from .user_pool import UserPool
 from .node_pool import NodePool
@@ -0,0 +1,103 @@
+from threading import Lock
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from .node import Node
+
+# node uuid -> (tag mask, has ipv4, has ipv6, tagged with gfw or cn, node id)
+NodeInfo = Tuple[int, bool, bool, bool, int]
+
+
+class EligibilityIndex:
+    """
+    Answer "which nodes can be used by a user with these tags" without looping over all nodes.
+    Tags are interned to bits, so a node can be used by a user iff the tag mask of the node is a subset of
+    the tag mask of the user (see AbstractNode.can_be_used_by). Nodes are grouped by their tag mask and
+    results are cached per (user tag mask, protocol). The index holds node uuids; callers resolve them
+    to the node objects of their current snapshot.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.bits: Dict[str, int] = dict()
+        self.info: Dict[str, NodeInfo] = dict()
+        # tag mask -> uuids of the nodes with that mask
+        self.groups: Dict[int, Set[str]] = defaultdict(set)
+        self.cache: Dict[Tuple[int, Optional[int]], Tuple[str, ...]] = dict()
+
+    def node_mask(self, tags: Iterable[str]) -> int:
+        mask = 0
+        for tag in tags:
+            if tag not in self.bits:
+                self.bits[tag] = 1 << len(self.bits)
+            mask |= self.bits[tag]
+        return mask
+
+    def user_mask(self, tags: Iterable[str]) -> int:
+        # tags that no node has are irrelevant
+        mask = 0
+        for tag in tags:
+            mask |= self.bits.get(tag, 0)
+        return mask
+
+    def _add(self, node: Node):
+        info = (
+            self.node_mask(node.tag), node.ipv4 is not None, node.ipv6 is not None,
+            any(tag in node.tag for tag in ['gfw', 'cn']), node.node_id,
+        )
+        self.info[node.uuid] = info
+        self.groups[info[0]].add(node.uuid)
+
+    def _remove(self, uuid: str) -> Optional[int]:
+        info = self.info.pop(uuid, None)
+        if info is None:
+            return None
+        group = self.groups[info[0]]
+        group.discard(uuid)
+        if not group:
+            del self.groups[info[0]]
+        return info[0]
+
+    def rebuild(self, nodes: Iterable[Node]):
+        # the tag bits are kept, so masks of known users stay valid
+        self.info, self.groups, self.cache = dict(), defaultdict(set), dict()
+        for node in nodes:
+            self._add(node)
+
+    def update(self, nodes: Iterable[Node]):
+        # re-index changed nodes and drop only the cached results they may affect
+        masks = set()
+        for node in nodes:
+            old = self._remove(node.uuid)
+            if old is not None:
+                masks.add(old)
+            self._add(node)
+            masks.add(self.info[node.uuid][0])
+        self.cache = {
+            key: value for key, value in self.cache.items()
+            if not any(mask & ~key[0] == 0 for mask in masks)
+        }
+
+    def lookup(self, user_tag: Iterable[str], protocol: Optional[int] = None) -> Tuple[str, ...]:
+        # uuids of the usable nodes, ordered by node id; the caller must hold self.lock
+        user_mask = self.user_mask(user_tag)
+        key = (user_mask, protocol)
+        ret = self.cache.get(key)
+        if ret is not None:
+            return ret
+        candidates: List[str] = list()
+        for mask, uuids in self.groups.items():
+            if mask & ~user_mask == 0:
+                candidates.extend(uuids)
+        if protocol is not None:
+            candidates = [u for u in candidates if self._usable_with(self.info[u], protocol)]
+        candidates.sort(key=lambda u: self.info[u][4])
+        ret = self.cache[key] = tuple(candidates)
+        return ret
+
+    @staticmethod
+    def _usable_with(info: NodeInfo, protocol: int) -> bool:
+        if protocol == 4 and not info[1]:
+            return False
+        if protocol == 6 and not info[2]:
+            return False
+        return info[3]
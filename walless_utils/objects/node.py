@@ -1,22 +1,41 @@
 from typing import List, Optional, Tuple, Dict, Any
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, fields, replace
 from datetime import date, timedelta
 from collections import defaultdict
+from functools import lru_cache
 
 from ..global_obj.config_setup import URL_TEMPLATE
 from ..utils import HUAWEI_LINES
 
+# nodes and relays are frozen; the functions that build the graph set their fields through object.__setattr__
+_set = object.__setattr__
 
-@dataclass
+
+# nodes and relays are shared by all readers of a NodePool; use dataclasses.replace to modify them
+@dataclass(frozen=True)
 class AbstractNode:
+    # fields that link to other objects instead of holding a column
+    _links = ()
+
     def __post_init__(self):
-        self.tag = tuple() if self.tag is None else tuple(self.tag.split(':'))
-        self.properties = tuple() if self.properties is None else tuple(self.properties.split(':'))
+        # tag and properties are already tuples if the object is built from to_list()
+        if not isinstance(self.tag, tuple):
+            _set(self, 'tag', tuple() if self.tag is None else tuple(self.tag.split(':')))
+        if not isinstance(self.properties, tuple):
+            _set(self, 'properties', tuple() if self.properties is None else tuple(self.properties.split(':')))
 
     @classmethod
     def from_list(cls, items):
         return cls(*items)
 
+    @classmethod
+    def columns(cls) -> List[str]:
+        return [f.name for f in fields(cls) if f.name not in cls._links]
+
+    def to_list(self) -> list:
+        # the inverse of from_list, without the links
+        return [getattr(self, name) for name in self.columns()]
+
     def can_be_used_by(self, user_tag, protocol: Optional[int] = None) -> bool:
         if protocol is not None:
             if protocol == 4 and self.ipv4 is None:
@@ -30,7 +49,7 @@ class AbstractNode:
         return True
 
 
-@dataclass
+@dataclass(frozen=True)
 class Relay(AbstractNode):
     relay_id: int
     name: str
@@ -43,6 +62,7 @@ class Relay(AbstractNode):
     port: int
     source: "Node" = None
     target: "Node" = None
+    _links = ('source', 'target')
 
     def __repr__(self):
         return f'<Relay from {self.source} to {self.target}>'
@@ -71,7 +91,7 @@ class DNSRecord:
         self.cname: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
 
 
-@dataclass
+@dataclass(frozen=True)
 class Node(AbstractNode):
     node_id: int
     uuid: str
@@ -90,23 +110,27 @@ class Node(AbstractNode):
     download: int
     traffic_reset_day: int
     traffic_limit: Optional[int]
+    # lists while the graph is built, tuples once it is published (see freeze_links)
     relay_in: List[Relay] = field(default_factory=list)
     relay_out: List[Relay] = field(default_factory=list)
     # a map from scope ("edu" or "default") to target node
     # if the scope is missing (default), no mix is applied
     mix: Dict[str, List["Node"]] = field(default_factory=lambda: defaultdict(list))
+    _links = ('relay_in', 'relay_out', 'mix')
 
     def __post_init__(self):
         super().__post_init__()
-        self.weight: float = float(self.weight)
-        # self.dns should be retrieved from API (cloudflare and huaweicloud)
-        self.dns: Dict[int, DNSRecord] = {4: DNSRecord(), 6: DNSRecord()}
+        _set(self, 'weight', float(self.weight))
+        # self.dns should be retrieved from API (cloudflare and huaweicloud); as it is filled in place,
+        # pass the API nodes from NodePool.all_nodes().mutable_copy()
+        _set(self, 'dns', {4: DNSRecord(), 6: DNSRecord()})
 
     def ip(self, proto, value=None):
+        # with a value, returns a copy of the node with that IP
         assert proto in [4, 6]
         if value is None:
             return getattr(self, 'ipv'+str(proto))
-        setattr(self, 'ipv'+str(proto), value)
+        return replace(self, **{'ipv'+str(proto): value})
 
     def urls(self, proto):
         # proto is 4 or 6
@@ -125,50 +149,84 @@ class Node(AbstractNode):
     def __hash__(self):
         return hash(self.uuid)
 
+    def update_from(self, other: "Node"):
+        # copy the columns of `other` into this node, keeping its relays, mixes and DNS records
+        for name in self.columns():
+            _set(self, name, getattr(other, name))
+
     def last_reset_day(self) -> date:
-        day = self.traffic_reset_day if self.traffic_reset_day is not None else 1
-        today = date.today()
-        # Check if the reset day has already passed this month
-        if today.day >= day:
-            last_reset = date(today.year, today.month, day)
-        else:
-            # If not, go to the previous month
-            last_month = today.replace(day=1) - timedelta(days=1)
-            # Handle February and other months with fewer days
-            try:
-                last_reset = last_month.replace(day=day)
-            except ValueError:
-                # If the day is out of range for the month, set to the last day of the month
-                last_reset = last_month
-        return last_reset
+        return reset_window(self.traffic_reset_day, date.today())[0]
 
     def next_reset_day(self) -> date:
-        day = self.traffic_reset_day if self.traffic_reset_day is not None else 1
-        today = date.today()
-        # Check if the reset day is yet to come this month
-        if today.day < day:
-            next_reset = date(today.year, today.month, day)
-        else:
-            # If the reset day has already passed, go to the next month
-            next_month = (today.replace(day=28) + timedelta(days=4)).replace(day=1)
-            # Handle months with fewer days
-            try:
-                next_reset = next_month.replace(day=day)
-            except ValueError:
-                # If the day is out of range for the month, set to the last day of the month
-                next_reset = next_month.replace(day=1) - timedelta(days=1)
-        return next_reset
-
-
-def link_relays(nodes: List[Node], relays: List[Relay]):
-    uuid2node: Dict[int, Node] = {n.uuid: n for n in nodes}
+        return reset_window(self.traffic_reset_day, date.today())[1]
+
+
+@lru_cache(maxsize=256)
+def reset_window(reset_day: Optional[int], today: date) -> Tuple[date, date]:
+    """
+    The last and the next traffic reset day of a node that resets on the `reset_day` of every month
+    (the 1st if None), seen from `today`. There are at most 31 distinct reset days, so the windows of a
+    day are computed once and cached.
+    """
+    day = reset_day if reset_day is not None else 1
+    # Check if the reset day has already passed this month
+    if today.day >= day:
+        last_reset = date(today.year, today.month, day)
+    else:
+        # If not, go to the previous month
+        last_month = today.replace(day=1) - timedelta(days=1)
+        # Handle February and other months with fewer days
+        try:
+            last_reset = last_month.replace(day=day)
+        except ValueError:
+            # If the day is out of range for the month, set to the last day of the month
+            last_reset = last_month
+
+    # Check if the reset day is yet to come this month
+    if today.day < day:
+        next_reset = date(today.year, today.month, day)
+    else:
+        # If the reset day has already passed, go to the next month
+        next_month = (today.replace(day=28) + timedelta(days=4)).replace(day=1)
+        # Handle months with fewer days
+        try:
+            next_reset = next_month.replace(day=day)
+        except ValueError:
+            # If the day is out of range for the month, set to the last day of the month
+            next_reset = next_month.replace(day=1) - timedelta(days=1)
+    return last_reset, next_reset
+
+
+def link_relays(nodes: List[Node], relays: List[Relay], uuid2node: Optional[Dict[str, Node]] = None):
+    if uuid2node is None:
+        uuid2node = {n.uuid: n for n in nodes}
     for relay in relays:
         if relay.source_id in uuid2node and relay.target_id in uuid2node:
-            relay.source, relay.target = uuid2node[relay.source_id], uuid2node[relay.target_id]
+            _set(relay, 'source', uuid2node[relay.source_id])
+            _set(relay, 'target', uuid2node[relay.target_id])
             relay.source.relay_out.append(relay)
             relay.target.relay_in.append(relay)
 
 
+def unlink_relay(relay: Relay):
+    # compare by identity, as the dataclass __eq__ would recurse into the node graph
+    if relay.source is not None:
+        _set(relay.source, 'relay_out', [r for r in relay.source.relay_out if r is not relay])
+    if relay.target is not None:
+        _set(relay.target, 'relay_in', [r for r in relay.target.relay_in if r is not relay])
+    _set(relay, 'source', None)
+    _set(relay, 'target', None)
+
+
+def freeze_links(nodes: List[Node]):
+    # turn the relays and mixes of the nodes into tuples, so a published graph cannot be changed through them
+    for node in nodes:
+        _set(node, 'relay_in', tuple(node.relay_in))
+        _set(node, 'relay_out', tuple(node.relay_out))
+        _set(node, 'mix', {scope: tuple(targets) for scope, targets in node.mix.items()})
+
+
+
 @dataclass
 class Mix:
     source_uuid: str
@@ -181,8 +239,9 @@ class Mix:
         return cls(*li)
 
 
-def link_mixes(nodes: List[Node], mixes: List[Mix]):
-    uuid2nodes = {n.uuid: n for n in nodes}
+def link_mixes(nodes: List[Node], mixes: List[Mix], uuid2nodes: Optional[Dict[str, Node]] = None):
+    if uuid2nodes is None:
+        uuid2nodes = {n.uuid: n for n in nodes}
     for mix in mixes:
         if mix.source_uuid in uuid2nodes and mix.target_uuid in uuid2nodes:
             uuid2nodes[mix.source_uuid].mix[mix.scope].append(uuid2nodes[mix.target_uuid])
@@ -0,0 +1,46 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from .node import Node
+
+
+class NodeIndex:
+    """
+    Secondary indexes over a list of nodes: by node id, uuid, IP (v4 and v6), IDC and tag.
+    Several nodes may share an IP, e.g. a deleted node and the one replacing it, so IP, IDC and tag
+    lookups map to lists in the original order.
+    """
+    def __init__(self, nodes: Iterable[Node] = ()):
+        self.id2node: Dict[int, Node] = dict()
+        self.uuid2node: Dict[str, Node] = dict()
+        self.ip2nodes: Dict[str, List[Node]] = defaultdict(list)
+        self.idc2nodes: Dict[str, List[Node]] = defaultdict(list)
+        self.tag2nodes: Dict[str, List[Node]] = defaultdict(list)
+        for node in nodes:
+            self.id2node[node.node_id] = node
+            self.uuid2node[node.uuid] = node
+            for ip in (node.ipv4, node.ipv6):
+                if ip is not None:
+                    self.ip2nodes[ip].append(node)
+            if node.idc is not None:
+                self.idc2nodes[node.idc].append(node)
+            for tag in node.tag:
+                self.tag2nodes[tag].append(node)
+
+    def by_id(self, node_id: int) -> Optional[Node]:
+        return self.id2node.get(node_id)
+
+    def by_uuid(self, uuid: str) -> Optional[Node]:
+        return self.uuid2node.get(uuid)
+
+    def by_ip(self, ip: str, include_deleted: bool = False) -> Optional[Node]:
+        for node in self.ip2nodes.get(ip, []):
+            if include_deleted or not node.deleted:
+                return node
+        return None
+
+    def by_idc(self, idc: str) -> List[Node]:
+        return self.idc2nodes.get(idc, [])
+
+    def by_tag(self, tag: str) -> List[Node]:
+        return self.tag2nodes.get(tag, [])
@@ -0,0 +1,87 @@
+from dataclasses import dataclass, field
+from datetime import date
+from threading import Lock
+from typing import Dict, Optional, Sequence, Set
+
+from ..utils import lazy_numpy
+from .node import Node, reset_window
+
+
+@dataclass
+class LimitReport:
+    day: date
+    # uuids of the nodes whose upload + download exceed their traffic limit
+    over: Set[str] = field(default_factory=set)
+    # uuids of the nodes within `near_ratio` of their limit, or on pace to exceed it before the next reset
+    near: Set[str] = field(default_factory=set)
+    # uuids of the nodes whose counters are reset today
+    reset_today: Set[str] = field(default_factory=set)
+    # uuid -> fraction of the limit used, for nodes with a limit
+    ratio: Dict[str, float] = field(default_factory=dict)
+
+
+class NodeLimitEvaluator:
+    """
+    Checks the traffic of all nodes against their `traffic_limit` in one vectorized pass.
+    Reset windows are computed once per day for each distinct `traffic_reset_day` (see reset_window);
+    the columns of the nodes are kept until the snapshot version passed to `evaluate` changes.
+    `unit` is the number of bytes in a unit of `traffic_limit`, e.g. 2**30 if limits are in GiB.
+    """
+    def __init__(self, near_ratio: float = 0.9, unit: int = 1):
+        self.np = lazy_numpy()
+        self.lock = Lock()
+        self.near_ratio = near_ratio
+        self.unit = unit
+        self.version: Optional[int] = None
+        self.columns = None
+        self._windows = None
+
+    def _columns(self, nodes: Sequence[Node]):
+        np = self.np
+        n = len(nodes)
+        uuids = np.array([node.uuid for node in nodes], dtype=object)
+        used = np.fromiter(((node.upload or 0) + (node.download or 0) for node in nodes), np.float64, n)
+        # nodes without a limit get an infinite one
+        limit = np.fromiter(
+            (np.inf if node.traffic_limit is None or node.traffic_limit <= 0 else node.traffic_limit * self.unit
+             for node in nodes), np.float64, n,
+        )
+        reset_day = np.clip(np.fromiter((node.traffic_reset_day or 1 for node in nodes), np.int64, n), 1, 31)
+        return uuids, used, limit, reset_day
+
+    def windows(self, day: date):
+        # elapsed days (today included), length of the cycle, and reset-today flag, indexed by reset day 1..31
+        if self._windows is not None and self._windows[0] == day:
+            return self._windows[1]
+        np = self.np
+        elapsed, length, today = np.ones(32), np.ones(32), np.zeros(32, bool)
+        for reset_day in range(1, 32):
+            last, nxt = reset_window(reset_day, day)
+            elapsed[reset_day] = (day - last).days + 1
+            length[reset_day] = max((nxt - last).days, 1)
+            today[reset_day] = last == day
+        self._windows = day, (elapsed, length, today)
+        return elapsed, length, today
+
+    def evaluate(self, nodes: Sequence[Node], version: Optional[int] = None, day: Optional[date] = None) -> LimitReport:
+        # pass NodePool.all_nodes() and its version, so the columns are only rebuilt when the nodes change
+        day = day or date.today()
+        with self.lock:
+            if version is None or version != self.version or self.columns is None:
+                self.columns = self._columns(nodes)
+                self.version = version
+            uuids, used, limit, reset_day = self.columns
+        elapsed, length, today = self.windows(day)
+        ratio = used / limit
+        # usage at the end of the cycle, if the node keeps its average daily usage so far
+        projected = ratio * length[reset_day] / elapsed[reset_day]
+        over = ratio > 1
+        near = ~over & ((ratio >= self.near_ratio) | (projected > 1))
+        limited = limit < self.np.inf
+        return LimitReport(
+            day=day,
+            over=set(uuids[over].tolist()),
+            near=set(uuids[near].tolist()),
+            reset_today=set(uuids[today[reset_day]].tolist()),
+            ratio=dict(zip(uuids[limited].tolist(), ratio[limited].tolist())),
+        )
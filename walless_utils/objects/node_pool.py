@@ -1,40 +1,339 @@
 import time
 from threading import Lock, Thread
-from typing import List
-from copy import deepcopy
+from typing import List, Dict, Set, Tuple, Optional
+from collections import defaultdict
+from copy import copy
 import logging
 
 from ..database import DBCommunicator
-from .node import Node
+from .node import Node, Relay, Mix, link_relays, unlink_relay, link_mixes, freeze_links
+from .snapshot import Snapshot
+from .eligibility import EligibilityIndex
+from .node_index import NodeIndex
+from .routing import RelayGraph
+from .pool_cache import save_cache, load_cache
+from .shared_table import TableSchema, SharedPublisher, SharedSubscriber
 
 logger = logging.getLogger('walless')
 
 
+# in the order of Node.columns() and Relay.columns(), which tests/test_schemas.py checks
+NODE_SCHEMA = TableSchema((
+    ('node_id', 'int'), ('uuid', 'str'), ('deleted', 'bool'), ('hidden', 'bool'), ('name', 'str'),
+    ('weight', 'float'), ('tag', 'tags'), ('ipv4', 'str'), ('ipv6', 'str'), ('port', 'int'),
+    ('properties', 'tags'), ('remarks', 'str'), ('idc', 'str'), ('upload', 'int'), ('download', 'int'),
+    ('traffic_reset_day', 'int'), ('traffic_limit', 'int'),
+))
+RELAY_SCHEMA = TableSchema((
+    ('relay_id', 'int'), ('name', 'str'), ('tunnel', 'str'), ('tag', 'tags'), ('properties', 'tags'),
+    ('hidden', 'bool'), ('source_id', 'str'), ('target_id', 'str'), ('port', 'int'),
+))
+MIX_SCHEMA = TableSchema((('source_uuid', 'str'), ('target_uuid', 'str'), ('scope', 'str')))
+
+
 class NodePool:
     """
     It fetches node list from the database and save it as a local cache.
     It updates the list on-demand (instead of pulling everything every time).
+    In delta mode, only nodes and relays changed since the last pull are fetched (the node and relay
+    tables need a `last_change` column, see DBCommunicator.migrate('node_last_change')), and they are
+    patched into the existing graph. Relays that are gone are found by their ids; nodes deleted from the
+    table, and rows changed by writers that do not move `last_change`, are only seen by the full pull that
+    replaces a delta pull every `full_gap` seconds.
+    Readers get the latest published Snapshot of the graph. A published graph is never modified:
+    nodes and relays are frozen and their links are tuples, and a delta pull patches a shallow copy of the
+    graph and publishes that instead.
+    If `cache_path` is set, the nodes, relays, mixes and the watermark are saved there after pulls (at most
+    every `cache_gap` seconds) and loaded on the first pull. In delta mode, a restarted process then only
+    pulls what changed since the cache was saved; otherwise the cache is replaced by a full pull.
+    If `shared` is set, only the process with `shared_owner=True` pulls from the database. It publishes
+    the nodes, relays and mixes to shared memory, and the other processes on the host build their graph
+    from the latest published tables instead.
     """
-    def __init__(self, db=None, relay: bool = True, min_gap=60):
+    def __init__(
+        self, db=None, relay: bool = True, min_gap=60, delta: bool = False, full_gap=3600,
+        cache_path: Optional[str] = None, cache_gap=300, cache_max_age: Optional[float] = None,
+        shared: Optional[str] = None, shared_owner: bool = False,
+    ):
         self.nodes = []
+        self.snapshot: Snapshot[Node] = Snapshot()
+        # lookups into the current snapshot
+        self.index = NodeIndex()
+        self.eligibility = EligibilityIndex()
+        # built on the first call of routing(), then kept up to date on every publish
+        self._routing: Optional[RelayGraph] = None
+        # seconds spent in the DB and in Python by the last pull, see DBCommunicator.servers_timing
+        self.pull_timing: Dict[str, float] = dict()
         self.last_update = 100
         self.min_gap = min_gap
         self.relay = relay
+        self.delta = delta
+        # watermark of the last delta pull, compared with `last_change` in the DB
+        self.last_change = 100
+        self.full_gap = full_gap
+        self.last_full = 0
+        # raw relays (including the unlinked ones) and mixes, used to patch the graph in delta mode
+        self.relays: Dict[int, Relay] = dict()
+        self.mixes: Set[Tuple[str, str, str]] = set()
         self.db: DBCommunicator = db
         self.pool_lock = Lock()
         self.pull_lock = Lock()
-    
+        self.cache_path = cache_path
+        self.cache_gap = cache_gap
+        self.cache_max_age = cache_max_age
+        self.cache_loaded = False
+        self.cache_saved = 0
+        self.cache_version = 0
+        self.shared = shared
+        self.shared_owner = shared_owner
+        self.shared_version = 0
+        # set when a RefreshScheduler keeps the pool up to date
+        self.scheduled = False
+        self.publisher: Optional[SharedPublisher] = None
+        self.subscriber: Optional[SharedSubscriber] = None
+
+    @property
+    def shared_reader(self) -> bool:
+        return self.shared is not None and not self.shared_owner
+
     def _pull(self, blocking):
         if not self.pull_lock.acquire(blocking=blocking):
             return
         try:
             logger.debug(f'Pulling nodes with {blocking=}')
-            all_nodes = self.db.all_servers(self.relay)
-            self.nodes = all_nodes
+            if self.cache_path and not self.cache_loaded:
+                self._load_cache()
+            self._pull_any()
+            if self.cache_path and time.time() - self.cache_saved >= self.cache_gap:
+                self._save_cache()
+            if self.shared is not None:
+                self._share()
         finally:
             self.pull_lock.release()
 
+    def _share(self):
+        # owner side; the caller must hold self.pull_lock
+        if self.snapshot.version == self.shared_version:
+            return
+        if self.publisher is None:
+            self.publisher = SharedPublisher(f'{self.shared}-node')
+        self.publisher.publish(self.snapshot.version, {
+            'node': (NODE_SCHEMA, [n.to_list() for n in self.nodes]),
+            'relay': (RELAY_SCHEMA, [r.to_list() for r in self.relays.values()]),
+            'mix': (MIX_SCHEMA, sorted(self.mixes)),
+        })
+        self.shared_version = self.snapshot.version
+
+    def _attach(self):
+        # reader side: rebuild the graph if the owner has published a new version
+        with self.pull_lock:
+            if self.subscriber is None:
+                self.subscriber = SharedSubscriber(f'{self.shared}-node')
+            segment = self.subscriber.latest()
+            if segment is None:
+                logger.warning(f'No nodes are shared as {self.shared} yet.')
+                return
+            if self.subscriber.version == self.shared_version:
+                return
+            since = time.time()
+            self._link(
+                list(segment.table('node', NODE_SCHEMA, Node.from_list)),
+                list(segment.table('relay', RELAY_SCHEMA, Relay.from_list)),
+                list(segment.table('mix', MIX_SCHEMA, Mix.from_list)),
+            )
+            self.pull_timing = {'link': time.time() - since}
+            self._publish()
+            self.shared_version = self.subscriber.version
+            self.last_update = self.subscriber.published
+
+    def _pull_any(self):
+        if self.delta and len(self.nodes) > 0 and time.time() - self.last_full < self.full_gap:
+            try:
+                self._pull_delta()
+                return
+            except Exception as e:
+                if DBCommunicator.is_disconnect(e):
+                    raise
+                logger.warning(f'Delta pull of nodes failed ({e}). Falling back to full pulls.')
+                self.delta = False
+        self._pull_full()
+
+    def _pull_full(self):
+        since = int(time.time())
+        nodes, relays, mixes = self.db.load_servers(self.relay)
+        link_since = time.time()
+        self._link(nodes, relays, mixes)
+        self.pull_timing = dict(self.db.servers_timing, link=time.time() - link_since)
+        # leave a margin for clock skew between hosts
+        self.last_change = since - 30
+        self.last_full = since
+        self._publish()
+
+    def _link(self, nodes: List[Node], relays: List[Relay], mixes: List[Mix]):
+        # build the graph from scratch
+        uuid2node = {n.uuid: n for n in nodes}
+        if self.relay:
+            link_relays(nodes, relays, uuid2node)
+        link_mixes(nodes, mixes, uuid2node)
+        nodes.sort(key=lambda x: x.node_id)
+        self.relays = {r.relay_id: r for r in relays}
+        self.mixes = {(m.source_uuid, m.target_uuid, m.scope) for m in mixes}
+        self.nodes = nodes
+
+    def _load_cache(self):
+        # warm start; the caller must hold self.pull_lock
+        self.cache_loaded = True
+        if len(self.nodes) > 0:
+            return
+        payload = load_cache(self.cache_path, b'node', {
+            'node': NODE_SCHEMA, 'relay': RELAY_SCHEMA, 'mix': MIX_SCHEMA,
+        }, self.cache_max_age)
+        if payload is None:
+            return
+        self._link(
+            [Node.from_list(row) for row in payload['node']],
+            [Relay.from_list(row) for row in payload['relay']],
+            [Mix.from_list(row) for row in payload['mix']],
+        )
+        self.last_change = payload['watermark']
+        self.last_full = payload.get('last_full', 0)
+        self._publish()
+        self.cache_saved = time.time()
+        self.cache_version = self.snapshot.version
+        logger.info(f'Loaded {len(self.nodes)} nodes and {len(self.relays)} relays from {self.cache_path}.')
+
+    def _save_cache(self):
+        # the graph is only changed by pulls, which hold self.pull_lock
+        if self.snapshot.version == self.cache_version:
+            return
+        save_cache(self.cache_path, b'node', {
+            'node': (NODE_SCHEMA, [n.to_list() for n in self.nodes]),
+            'relay': (RELAY_SCHEMA, [r.to_list() for r in self.relays.values()]),
+            'mix': (MIX_SCHEMA, sorted(self.mixes)),
+        }, {'watermark': self.last_change, 'last_full': self.last_full})
+        self.cache_saved = time.time()
+        self.cache_version = self.snapshot.version
+
+    def _publish(
+        self, changed: Optional[List[Node]] = None, touched: Optional[Set[str]] = None, relays_changed: bool = True,
+    ):
+        # `changed` are the nodes changed by a delta pull and `touched` the uuids of the nodes whose
+        # columns, relays or mixes changed; the indexes are rebuilt from scratch if they are None
+        since = time.time()
+        with self.eligibility.lock:
+            if changed is None:
+                self.eligibility.rebuild(self.nodes)
+            else:
+                self.eligibility.update(changed)
+            self.index = NodeIndex(self.nodes)
+            freeze_links(self.nodes)
+            self.snapshot = Snapshot(self.nodes, self.snapshot.version + 1)
+        if self._routing is not None:
+            self._routing.rebuild(self.nodes, touched, relays_changed)
+        self.pull_timing['publish'] = time.time() - since
+
+    def _clone(self) -> Tuple[List[Node], Dict[int, Relay]]:
+        # copy the node and relay objects of the graph, sharing their column values; the copies are not
+        # published yet, so their fields are set in place
+        set_ = object.__setattr__
+        node_map = {id(n): copy(n) for n in self.nodes}
+        for node in node_map.values():
+            set_(node, 'relay_in', [])
+            set_(node, 'relay_out', [])
+            set_(node, 'mix', defaultdict(list, {
+                scope: [node_map[id(t)] for t in targets] for scope, targets in node.mix.items()
+            }))
+        relays = dict()
+        for relay_id, relay in self.relays.items():
+            relay = copy(relay)
+            if relay.source is not None:
+                set_(relay, 'source', node_map[id(relay.source)])
+                set_(relay, 'target', node_map[id(relay.target)])
+                relay.source.relay_out.append(relay)
+                relay.target.relay_in.append(relay)
+            relays[relay_id] = relay
+        return [node_map[id(n)] for n in self.nodes], relays
+
+    def _pull_delta(self):
+        since = int(time.time())
+        nodes, relays, mixes = self.db.load_servers(self.relay, after=self.last_change)
+        relay_ids = set(self.db.all_relay_ids()) if self.relay else set()
+        self.pull_timing = dict(self.db.servers_timing)
+        new_mixes = {(m.source_uuid, m.target_uuid, m.scope) for m in mixes}
+        relays_changed = bool(relays) or relay_ids != set(self.relays)
+        if nodes or relays_changed or new_mixes != self.mixes:
+            patch_since = time.time()
+            self.nodes, self.relays = self._clone()
+            touched = self._patch(nodes, relays, relay_ids, mixes)
+            self.pull_timing['link'] = time.time() - patch_since
+            self._publish(changed=nodes, touched=touched, relays_changed=relays_changed)
+        self.last_change = since - 30
+
+    def _patch(self, nodes: List[Node], relays: List[Relay], relay_ids: Set[int], mixes: List[Mix]) -> Set[str]:
+        # returns the uuids of the nodes whose columns, relays or mixes changed
+        uuid2node = {n.uuid: n for n in self.nodes}
+        new_uuids = set()
+        for node in nodes:
+            if node.uuid in uuid2node:
+                uuid2node[node.uuid].update_from(node)
+            else:
+                uuid2node[node.uuid] = node
+                new_uuids.add(node.uuid)
+                self.nodes.append(node)
+
+        # relays that are changed or gone are unlinked first
+        changed = {r.relay_id: r for r in relays}
+        touched = {n.uuid for n in nodes}
+        for relay_id in [rid for rid in self.relays if rid in changed or rid not in relay_ids]:
+            relay = self.relays.pop(relay_id)
+            touched |= {relay.source_id, relay.target_id}
+            unlink_relay(relay)
+        self.relays.update(changed)
+        to_link = list(changed.values())
+        if new_uuids:
+            # relays that were waiting for a node that is new in this pull
+            to_link += [
+                r for r in self.relays.values()
+                if r.source is None and r.relay_id not in changed
+                and (r.source_id in new_uuids or r.target_id in new_uuids)
+            ]
+        link_relays(self.nodes, to_link, uuid2node)
+        touched |= {r.source_id for r in to_link} | {r.target_id for r in to_link}
+
+        # mixes are relinked for sources whose mix rows changed or whose targets are new
+        new_mixes = {(m.source_uuid, m.target_uuid, m.scope) for m in mixes}
+        affected = {s for s, _, _ in new_mixes ^ self.mixes} | new_uuids
+        affected |= {s for s, t, _ in new_mixes if t in new_uuids}
+        affected_nodes = [uuid2node[u] for u in affected if u in uuid2node]
+        for node in affected_nodes:
+            object.__setattr__(node, 'mix', defaultdict(list))
+        link_mixes(affected_nodes, [m for m in mixes if m.source_uuid in affected], uuid2node)
+        self.mixes = new_mixes
+        touched |= affected
+
+        if new_uuids:
+            self.nodes.sort(key=lambda x: x.node_id)
+        logger.debug(
+            f'Node delta pull: {len(nodes)} nodes ({len(new_uuids)} new), {len(changed)} relays changed, '
+            f'{len(affected_nodes)} nodes with mixes relinked.'
+        )
+        return touched
+
+    def refresh(self):
+        # blocking pull, run by the scheduler
+        if self.shared_reader:
+            self._attach()
+            return
+        self._pull(blocking=True)
+        self.last_update = time.time()
+
     def pull(self, force=False):
+        # pools refreshed by a scheduler (see global_obj.refresh_setup) only pull here while empty
+        if self.scheduled and not force and len(self.nodes) > 0:
+            return
+        if self.shared_reader:
+            self._attach()
+            return
         with self.pool_lock:
             if len(self.nodes) == 0 or force:
                 # if the list is empty, pull it immediately and block the main thread
@@ -49,8 +348,46 @@ class NodePool:
             th.start()
             self.last_update = time.time()
 
-    def all_nodes(self, pull=True) -> List[Node]:
+    def all_nodes(self, pull=True) -> Snapshot[Node]:
+        if pull or len(self.nodes) == 0:
+            self.pull()
+        # shared by all readers and frozen; use dataclasses.replace to get modified nodes
+        return self.snapshot
+
+    def nodes_for(self, user_tag, protocol: Optional[int] = None, pull=True) -> Tuple[Node, ...]:
+        # same as filtering all_nodes() with Node.can_be_used_by, but cached per user tags
         if pull or len(self.nodes) == 0:
             self.pull()
-        # return a duplicate to prevent in-place modification
-        return deepcopy(self.nodes)
+        with self.eligibility.lock:
+            uuids = self.eligibility.lookup(user_tag, protocol)
+            return tuple(self.index.uuid2node[u] for u in uuids)
+
+    def routing(self) -> RelayGraph:
+        # multi-hop reachability over the relays of the current snapshot
+        if len(self.nodes) == 0:
+            self.pull()
+        with self.pull_lock:
+            if self._routing is None:
+                self._routing = RelayGraph(self.nodes)
+        return self._routing
+
+    def _index(self) -> NodeIndex:
+        # lookups never trigger a refresh, unless the pool is still empty
+        if len(self.nodes) == 0:
+            self.pull()
+        return self.index
+
+    def by_id(self, node_id: int) -> Optional[Node]:
+        return self._index().by_id(node_id)
+
+    def by_uuid(self, uuid: str) -> Optional[Node]:
+        return self._index().by_uuid(uuid)
+
+    def by_ip(self, ip: str, include_deleted: bool = False) -> Optional[Node]:
+        return self._index().by_ip(ip, include_deleted)
+
+    def by_idc(self, idc: str) -> List[Node]:
+        return self._index().by_idc(idc)
+
+    def by_tag(self, tag: str) -> List[Node]:
+        return self._index().by_tag(tag)
@@ -0,0 +1,92 @@
+import os
+import mmap
+import json
+import struct
+import time
+import logging
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from .shared_table import TableSchema, SharedSegment, pack_tables
+
+logger = logging.getLogger('walless')
+
+MAGIC = b'WLPC'
+FORMAT_VERSION = 2
+# magic, format version, kind of the pool (b'user' or b'node'), time of saving, length of the json metadata
+_HEADER = struct.Struct('<4sB4sdI')
+
+
+class _MappedFile:
+    # the tables of a cache file, mapped read-only, in the shape of SharedMemory for SharedSegment
+    def __init__(self, path: str, fp, offset: int):
+        self.name = path
+        self.mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buf = memoryview(self.mm)[offset:]
+
+    def close(self):
+        self.buf.release()
+        self.mm.close()
+
+
+def save_cache(
+    path: str, kind: bytes, tables: Dict[str, Tuple[TableSchema, Sequence[Sequence[Any]]]], meta: Dict[str, Any],
+):
+    """
+    Save a pool to `path`: a fixed header, the json `meta` (watermarks and the schemas of the tables),
+    then the tables in the column layout of shared_table.build_segment. Loading the file only decodes
+    typed columns, so a tampered cache can at worst hold wrong rows, not run code.
+    The file is replaced atomically, so a reader never sees a partial file.
+    """
+    since = time.time()
+    path = os.path.expanduser(path)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    meta = json.dumps(dict(meta, schemas={name: schema.columns for name, (schema, _) in tables.items()})).encode()
+    # align the tables to 8 bytes, as in a shared memory segment
+    meta += b' ' * (-(_HEADER.size + len(meta)) % 8)
+    try:
+        with open(tmp, 'wb') as fp:
+            fp.write(_HEADER.pack(MAGIC, FORMAT_VERSION, kind, time.time(), len(meta)))
+            fp.write(meta)
+            fp.write(pack_tables(tables))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning(f'Failed to save the {kind.decode()} pool cache to {path}: {e}')
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return
+    logger.debug(f'Saved the {kind.decode()} pool cache to {path} in {time.time() - since:.2f}s.')
+
+
+def load_cache(
+    path: str, kind: bytes, schemas: Dict[str, TableSchema], max_age: Optional[float] = None,
+) -> Optional[Dict[str, Any]]:
+    # the meta data plus the rows of every table under its name; None if the file is missing, corrupted,
+    # too old or written with other schemas
+    path = os.path.expanduser(path)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as fp:
+            magic, version, file_kind, saved, meta_len = _HEADER.unpack(fp.read(_HEADER.size))
+            if magic != MAGIC or version != FORMAT_VERSION or file_kind != kind:
+                logger.warning(f'Ignoring the pool cache at {path}: unknown format.')
+                return None
+            if max_age is not None and time.time() - saved > max_age:
+                logger.info(f'Ignoring the pool cache at {path}: saved {time.time() - saved:.0f}s ago.')
+                return None
+            payload = json.loads(fp.read(meta_len))
+            if payload.pop('schemas') != {name: [list(c) for c in s.columns] for name, s in schemas.items()}:
+                logger.info(f'Ignoring the pool cache at {path}: the columns have changed.')
+                return None
+            segment = SharedSegment(_MappedFile(path, fp, _HEADER.size + meta_len))
+            try:
+                for name, schema in schemas.items():
+                    payload[name] = list(segment.table(name, schema))
+            finally:
+                segment.close()
+    except Exception as e:
+        logger.warning(f'Ignoring the pool cache at {path}: {e}')
+        return None
+    return payload
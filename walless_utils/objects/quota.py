@@ -0,0 +1,152 @@
+from datetime import date
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from ..utils import lazy_numpy, today
+from .user import User
+
+
+class QuotaEngine:
+    """
+    In-memory per-user data quotas, on top of User.daily_data and User.total_data (a limit of 0 means
+    no limit).
+    Usage is kept in a ring of per-day counters (`window` days) and in a counter of the usage since the
+    users were loaded, in NumPy arrays indexed by a slot per user_id. The counters are fed with `add`,
+    or by subscribing `observe` to the EditReservior of DBCommunicator.update_user_sql, so they see the
+    same updates as the DB. `over_quota` is O(1), and `sweep` checks all users in one vectorized pass.
+    Reloading users resets their total usage to the counters in the DB, so updates that are not
+    committed yet at that time are not counted towards the total quota.
+    """
+    def __init__(self, window: int = 7):
+        self.np = lazy_numpy()
+        self.lock = Lock()
+        self.window = window
+        self.slots: Dict[int, int] = dict()
+        self.day: date = today()
+        # row of `usage` that counts today
+        self.day_row = 0
+        self._allocate(0)
+
+    def _allocate(self, capacity: int):
+        np, old = self.np, getattr(self, 'user_ids', None)
+        arrays = {
+            'user_ids': np.zeros(capacity, np.int64),
+            'daily_limit': np.zeros(capacity, np.int64),
+            'total_limit': np.zeros(capacity, np.int64),
+            # upload + download in the DB when the user was loaded, and usage added since then
+            'base_total': np.zeros(capacity, np.int64),
+            'added_total': np.zeros(capacity, np.int64),
+            'enabled': np.zeros(capacity, bool),
+            # disabled by a sweep, and not enabled again yet
+            'blocked': np.zeros(capacity, bool),
+        }
+        usage = np.zeros((self.window, capacity), np.int64)
+        if old is not None:
+            n = len(old)
+            for name, arr in arrays.items():
+                arr[:n] = getattr(self, name)
+            usage[:, :n] = self.usage
+        for name, arr in arrays.items():
+            setattr(self, name, arr)
+        self.usage = usage
+
+    def _slot(self, user_id: int) -> int:
+        # the caller must hold self.lock
+        slot = self.slots.get(user_id)
+        if slot is None:
+            slot = self.slots[user_id] = len(self.slots)
+            if slot >= len(self.user_ids):
+                self._allocate(max(1024, 2 * len(self.user_ids)))
+            self.user_ids[slot] = user_id
+            self.enabled[slot] = True
+        return slot
+
+    def _roll(self, day: date):
+        # the caller must hold self.lock; starts the counters of the days that began since the last call
+        days = (day - self.day).days
+        if days <= 0:
+            return
+        for _ in range(min(days, self.window)):
+            self.day_row = (self.day_row + 1) % self.window
+            self.usage[self.day_row] = 0
+        self.day = day
+
+    def load(self, users: Iterable[User]):
+        # set limits, totals and states, e.g. from UserPool.all_users()
+        rows = [(u.user_id, u.daily_data, u.total_data, u.upload + u.download, u.valid) for u in users]
+        with self.lock:
+            slots = [self._slot(row[0]) for row in rows]
+            if not slots:
+                return
+            _, daily, total, used, valid = zip(*rows)
+            self.daily_limit[slots] = daily
+            self.total_limit[slots] = total
+            self.base_total[slots] = used
+            self.added_total[slots] = 0
+            self.enabled[slots] = valid
+
+    def seed_today(self, rows: Iterable[Tuple[int, int]]):
+        # (user_id, bytes) already used today, e.g. from DBCommunicator.user_traffic_on
+        with self.lock:
+            self._roll(today())
+            for user_id, used in rows:
+                self.usage[self.day_row, self._slot(user_id)] = used
+
+    def add(self, user_id: int, used: int, day: Optional[date] = None):
+        with self.lock:
+            self._roll(day or today())
+            slot = self._slot(user_id)
+            self.usage[self.day_row, slot] += used
+            self.added_total[slot] += used
+
+    def observe(self, row: Sequence):
+        # rows of DBCommunicator.update_user_sql: (balance, upload, download, last_change, last_activity, user_id)
+        self.add(row[-1], row[1] + row[2])
+
+    def usage_of(self, user_id: int, days: int = 1) -> int:
+        # usage of the last `days` days, today included
+        with self.lock:
+            self._roll(today())
+            slot = self.slots.get(user_id)
+            if slot is None:
+                return 0
+            rows = [(self.day_row - i) % self.window for i in range(min(days, self.window))]
+            return int(self.usage[rows, slot].sum())
+
+    def over_quota(self, user_id: int) -> bool:
+        with self.lock:
+            self._roll(today())
+            slot = self.slots.get(user_id)
+            if slot is None:
+                return False
+            daily, total = self.daily_limit[slot], self.total_limit[slot]
+            if 0 < daily < self.usage[self.day_row, slot]:
+                return True
+            return bool(0 < total < self.base_total[slot] + self.added_total[slot])
+
+    def _over(self, n: int):
+        daily, total = self.daily_limit[:n], self.total_limit[:n]
+        over_daily = (daily > 0) & (self.usage[self.day_row, :n] > daily)
+        over_total = (total > 0) & (self.base_total[:n] + self.added_total[:n] > total)
+        return over_daily | over_total
+
+    def sweep(self) -> Tuple[List[int], List[int]]:
+        """
+        Users to disable (enabled, and over their quota) and users to enable again (disabled by a previous
+        sweep, and within their quota now, e.g. on a new day). The engine assumes the caller applies them.
+        """
+        with self.lock:
+            self._roll(today())
+            n = len(self.slots)
+            over = self._over(n)
+            blocked = self.blocked[:n]
+            disable = over & self.enabled[:n] & ~blocked
+            enable = ~over & blocked
+            self.blocked[:n] = (blocked | disable) & ~enable
+            self.enabled[:n] = (self.enabled[:n] & ~disable) | enable
+            return self.user_ids[:n][disable].tolist(), self.user_ids[:n][enable].tolist()
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            n = len(self.slots)
+            return {'users': n, 'over_quota': int(self._over(n).sum()), 'blocked': int(self.blocked[:n].sum())}
@@ -0,0 +1,183 @@
+from threading import RLock
+from collections import OrderedDict, deque
+from typing import Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple
+
+from .node import Node, Relay
+
+# uuid of a reached node -> (hops, relay id of the last hop, or None for an entry node)
+SearchResult = Dict[str, Tuple[int, Optional[int]]]
+
+
+class RelayGraph:
+    """
+    Multi-hop reachability over relays, on top of the graph built by link_relays and link_mixes.
+    Nodes are numbered and relays are kept as adjacency arrays (offsets, targets, tag masks), and tags are
+    interned to bits as in EligibilityIndex. A search starts from the mix targets of the entry node in the
+    given scope (see Node.mix), follows the relays the user can use, and only visits usable nodes that are
+    not deleted.
+    Searches are cached per (entry, scope, user tags). When the graph is rebuilt with the uuids of the
+    touched nodes, only the cached searches that examined one of them are dropped, and the adjacency
+    arrays are kept unless the relays changed or nodes were added or reordered.
+    """
+    def __init__(self, nodes: Sequence[Node] = (), max_cache: int = 4096):
+        self.lock = RLock()
+        self.bits: Dict[str, int] = dict()
+        self.max_cache = max_cache
+        self.cache: "OrderedDict[Tuple[str, str, int], Tuple[SearchResult, FrozenSet[str]]]" = OrderedDict()
+        self.rebuild(nodes)
+
+    def _mask(self, tags: Iterable[str]) -> int:
+        mask = 0
+        for tag in tags:
+            if tag not in self.bits:
+                self.bits[tag] = 1 << len(self.bits)
+            mask |= self.bits[tag]
+        return mask
+
+    def user_mask(self, tags: Iterable[str]) -> int:
+        mask = 0
+        for tag in tags:
+            mask |= self.bits.get(tag, 0)
+        return mask
+
+    def rebuild(self, nodes: Sequence[Node], touched: Optional[Set[str]] = None, relays_changed: bool = True):
+        # `touched` are the uuids of nodes whose columns, relays or mixes changed; None drops the whole cache
+        nodes = list(nodes)
+        if touched is not None and not relays_changed and self._same_positions(nodes):
+            self._update(nodes, touched)
+            return
+        pos = {n.uuid: i for i, n in enumerate(nodes)}
+        node_masks = [self._mask(n.tag) for n in nodes]
+        alive = [not n.deleted for n in nodes]
+        offsets, targets, edge_masks, relay_ids, relay_sources = [0], [], [], [], dict()
+        for s, node in enumerate(nodes):
+            for relay in node.relay_out:
+                t = pos.get(relay.target_id)
+                if t is None:
+                    continue
+                targets.append(t)
+                edge_masks.append(self._mask(relay.tag))
+                relay_ids.append(relay.relay_id)
+                relay_sources[relay.relay_id] = s
+            offsets.append(len(targets))
+        with self.lock:
+            self.nodes, self.pos, self.node_masks, self.alive = nodes, pos, node_masks, alive
+            self.offsets, self.targets, self.edge_masks = offsets, targets, edge_masks
+            self.edge_relay_ids, self.relay_sources = relay_ids, relay_sources
+            self._drop(touched)
+
+    def _same_positions(self, nodes: List[Node]) -> bool:
+        old = getattr(self, 'nodes', None)
+        if old is None or len(old) != len(nodes):
+            return False
+        pos = self.pos
+        return all(pos.get(n.uuid) == i for i, n in enumerate(nodes))
+
+    def _update(self, nodes: List[Node], touched: Set[str]):
+        # the relays and node positions are unchanged, so only the masks of the touched nodes are redone
+        with self.lock:
+            self.nodes = nodes
+            for uuid in touched:
+                i = self.pos.get(uuid)
+                if i is None:
+                    continue
+                self.node_masks[i] = self._mask(nodes[i].tag)
+                self.alive[i] = not nodes[i].deleted
+            self._drop(touched)
+
+    def _drop(self, touched: Optional[Set[str]]):
+        # the caller must hold self.lock
+        if touched is None:
+            self.cache.clear()
+        else:
+            for key in [k for k, (_, examined) in self.cache.items() if not examined.isdisjoint(touched)]:
+                del self.cache[key]
+
+    def _starts(self, entry: Node, scope: str) -> List[Node]:
+        return entry.mix.get(scope) or entry.mix.get('default_view') or [entry]
+
+    def _search(self, entry: Node, scope: str, user_mask: int) -> Tuple[SearchResult, FrozenSet[str]]:
+        # breadth-first search; the caller must hold self.lock
+        node_masks, alive = self.node_masks, self.alive
+        offsets, targets, edge_masks = self.offsets, self.targets, self.edge_masks
+        found: Dict[int, Tuple[int, int]] = dict()
+        examined: Set[int] = set()
+        queue = deque()
+        # the entry is examined as well, since its mixes decide where the search starts
+        examined.add(self.pos[entry.uuid])
+        for start in self._starts(entry, scope):
+            s = self.pos.get(start.uuid)
+            if s is None:
+                continue
+            examined.add(s)
+            if s not in found and alive[s] and node_masks[s] & ~user_mask == 0:
+                found[s] = (0, -1)
+                queue.append(s)
+        while queue:
+            u = queue.popleft()
+            hops = found[u][0] + 1
+            for e in range(offsets[u], offsets[u + 1]):
+                if edge_masks[e] & ~user_mask:
+                    continue
+                v = targets[e]
+                examined.add(v)
+                if v in found or not alive[v] or node_masks[v] & ~user_mask:
+                    continue
+                found[v] = (hops, e)
+                queue.append(v)
+        result = {
+            self.nodes[i].uuid: (hops, None if e < 0 else self.edge_relay_ids[e])
+            for i, (hops, e) in found.items()
+        }
+        return result, frozenset(self.nodes[i].uuid for i in examined)
+
+    def search(self, entry: str, user_tag: Iterable[str], scope: str = 'default_view') -> SearchResult:
+        # all nodes reachable from the entry node (by uuid), with their hop counts
+        with self.lock:
+            key = (entry, scope, self.user_mask(user_tag))
+            cached = self.cache.get(key)
+            if cached is not None:
+                self.cache.move_to_end(key)
+                return cached[0]
+            i = self.pos.get(entry)
+            if i is None:
+                return dict()
+            cached = self.cache[key] = self._search(self.nodes[i], scope, key[2])
+            if len(self.cache) > self.max_cache:
+                self.cache.popitem(last=False)
+            return cached[0]
+
+    def reachable(
+        self, entry: str, user_tag: Iterable[str], max_hops: Optional[int] = None, scope: str = 'default_view',
+    ) -> List[Tuple[Node, int]]:
+        # (exit node, hops) pairs, nearest first
+        with self.lock:
+            result = self.search(entry, user_tag, scope)
+            ret = [
+                (self.nodes[self.pos[uuid]], hops) for uuid, (hops, _) in result.items()
+                if max_hops is None or hops <= max_hops
+            ]
+        ret.sort(key=lambda x: (x[1], x[0].node_id))
+        return ret
+
+    def shortest_path(
+        self, entry: str, exit: str, user_tag: Iterable[str], scope: str = 'default_view',
+    ) -> Optional[List[Relay]]:
+        # relays on a shortest path from the entry to the exit node, or None if unreachable
+        with self.lock:
+            result = self.search(entry, user_tag, scope)
+            if exit not in result:
+                return None
+            path = list()
+            uuid = exit
+            while True:
+                relay_id = result[uuid][1]
+                if relay_id is None:
+                    break
+                # the relay object of the current node, as relays are replaced by every publish
+                source = self.nodes[self.relay_sources[relay_id]]
+                relay = next(r for r in source.relay_out if r.relay_id == relay_id)
+                path.append(relay)
+                uuid = relay.source_id
+        path.reverse()
+        return path
@@ -0,0 +1,329 @@
+import os
+import math
+import struct
+import time
+import logging
+from array import array
+from dataclasses import dataclass
+from datetime import date
+from multiprocessing import shared_memory, resource_tracker
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .user import intern_tag
+
+logger = logging.getLogger('walless')
+
+MAGIC = b'WLST'
+FORMAT_VERSION = 1
+# magic, format version, number of sections
+_HEADER = struct.Struct('<4sII')
+# section name, offset, length in bytes, number of rows
+_SECTION = struct.Struct('<48sqqq')
+# sequence number (odd while the owner is writing), version, time of publishing, segment name
+_CONTROL = struct.Struct('<qqd64s')
+INT_NULL = -2**63
+# kind of a column -> typecode of its values; str and tags columns hold offsets into an arena of utf-8 bytes
+_TYPECODES = {'int': 'q', 'float': 'd', 'bool': 'b', 'date': 'q', 'str': 'q', 'tags': 'q'}
+
+
+@dataclass(frozen=True)
+class TableSchema:
+    # (name, kind) of the columns, in the order of the rows; `indexes` are columns that can be looked up
+    columns: Tuple[Tuple[str, str], ...]
+    indexes: Tuple[str, ...] = ()
+
+    @property
+    def names(self) -> List[str]:
+        return [name for name, _ in self.columns]
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # attach without letting the resource tracker of this process unlink the segment on exit
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # before python 3.13
+        shm = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+def _encode_column(kind: str, values: List[Any]) -> Dict[str, bytes]:
+    # section suffix -> content
+    if kind in ('str', 'tags'):
+        arena, offsets, nulls = bytearray(), array('q', [0]), array('b')
+        for v in values:
+            nulls.append(v is None)
+            if v is not None:
+                arena += (':'.join(v) if kind == 'tags' else v).encode()
+            offsets.append(len(arena))
+        return {'': offsets.tobytes(), '.arena': bytes(arena), '.null': nulls.tobytes()}
+    if kind == 'float':
+        return {'': array('d', [math.nan if v is None else float(v) for v in values]).tobytes()}
+    if kind == 'bool':
+        return {'': array('b', [-1 if v is None else bool(v) for v in values]).tobytes()}
+    if kind == 'date':
+        return {'': array('q', [INT_NULL if v is None else v.toordinal() for v in values]).tobytes()}
+    return {'': array('q', [INT_NULL if v is None else int(v) for v in values]).tobytes()}
+
+
+def _sort_key(kind: str, value: Any):
+    # the order of the index sections, which is the order of the encoded values
+    if value is None:
+        return False, b''
+    if kind in ('str', 'tags'):
+        return True, (':'.join(value) if kind == 'tags' else value).encode()
+    return True, value
+
+
+def _layout(tables: Dict[str, Tuple[TableSchema, Sequence[Sequence[Any]]]]) -> Tuple[List[tuple], int]:
+    # (section name, offset, content, rows) of every section, and the total size
+    sections: List[Tuple[str, bytes, int]] = list()
+    for table, (schema, rows) in tables.items():
+        for i, (column, kind) in enumerate(schema.columns):
+            values = [row[i] for row in rows]
+            for suffix, content in _encode_column(kind, values).items():
+                sections.append((f'{table}.{column}{suffix}', content, len(rows)))
+            if column in schema.indexes:
+                order = sorted(range(len(values)), key=lambda j: _sort_key(kind, values[j]))
+                sections.append((f'{table}.{column}.index', array('q', order).tobytes(), len(rows)))
+
+    offset = _HEADER.size + _SECTION.size * len(sections)
+    layout = list()
+    for section, content, rows in sections:
+        # align every section to 8 bytes, so it can be cast in place
+        offset += -offset % 8
+        layout.append((section, offset, content, rows))
+        offset += len(content)
+    return layout, offset
+
+
+def _write(buf, layout: List[tuple]):
+    _HEADER.pack_into(buf, 0, MAGIC, FORMAT_VERSION, len(layout))
+    for i, (section, start, content, rows) in enumerate(layout):
+        _SECTION.pack_into(buf, _HEADER.size + _SECTION.size * i, section.encode(), start, len(content), rows)
+        buf[start:start + len(content)] = content
+
+
+def build_segment(name: str, tables: Dict[str, Tuple[TableSchema, Sequence[Sequence[Any]]]]) -> shared_memory.SharedMemory:
+    """
+    Write the tables into a new shared memory segment called `name`.
+    Every column is a section of fixed-size values; strings are kept in an arena per column, addressed by
+    offsets. An indexed column gets an extra section with the row numbers sorted by its value.
+    """
+    layout, size = _layout(tables)
+    shm = shared_memory.SharedMemory(name, create=True, size=max(size, 1))
+    _write(shm.buf, layout)
+    return shm
+
+
+def pack_tables(tables: Dict[str, Tuple[TableSchema, Sequence[Sequence[Any]]]]) -> bytearray:
+    # the content of a segment of build_segment, e.g. to save it to a file
+    layout, size = _layout(tables)
+    buf = bytearray(size)
+    _write(buf, layout)
+    return buf
+
+
+class SharedSegment:
+    """
+    Read-only view of a segment written by build_segment. Columns are accessed in place, without copying.
+    `shm` is a SharedMemory, or any object with its `name`, `buf` and `close()`, e.g. over a mapped file.
+    """
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self.shm = shm
+        # section name -> (offset, length, rows)
+        self.sections: Dict[str, Tuple[int, int, int]] = dict()
+        self.views: Dict[Tuple[str, str], memoryview] = dict()
+        # every view of the buffer has to be released before the segment can be closed
+        self.exported: List[memoryview] = list()
+        magic, version, n_sections = _HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f'Unknown format of shared memory segment {shm.name}.')
+        for i in range(n_sections):
+            section, start, length, rows = _SECTION.unpack_from(shm.buf, _HEADER.size + _SECTION.size * i)
+            self.sections[section.rstrip(b'\0').decode()] = start, length, rows
+
+    def section(self, name: str, typecode: str = 'B') -> memoryview:
+        view = self.views.get((name, typecode))
+        if view is None:
+            start, length, _ = self.sections[name]
+            view = self.shm.buf[start:start + length]
+            self.exported.append(view)
+            if typecode != 'B':
+                view = view.cast(typecode)
+                self.exported.append(view)
+            self.views[name, typecode] = view
+        return view
+
+    def rows(self, table: str) -> int:
+        for name, (_, _, rows) in self.sections.items():
+            if name.startswith(table + '.'):
+                return rows
+        return 0
+
+    def table(self, name: str, schema: TableSchema, factory: Callable = tuple) -> "SharedTable":
+        return SharedTable(self, name, schema, factory)
+
+    def close(self):
+        # only call this when no table of the segment is in use
+        for view in reversed(self.exported):
+            view.release()
+        self.views, self.exported = dict(), list()
+        self.shm.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class SharedTable(Sequence):
+    """
+    Rows of a table in a SharedSegment, decoded on access. `factory` turns the tuple of column values
+    into the object returned for a row, e.g. User.from_list.
+    """
+    def __init__(self, segment: SharedSegment, name: str, schema: TableSchema, factory: Callable = tuple):
+        self.segment = segment
+        self.name = name
+        self.schema = schema
+        self.factory = factory
+        self.n_rows = segment.rows(name)
+        self.columns = [
+            (kind, segment.section(f'{name}.{column}', _TYPECODES[kind])) + (
+                (segment.section(f'{name}.{column}.arena'), segment.section(f'{name}.{column}.null', 'b'))
+                if kind in ('str', 'tags') else (None, None)
+            )
+            for column, kind in schema.columns
+        ]
+        self.positions = {column: i for i, (column, _) in enumerate(schema.columns)}
+
+    def __len__(self) -> int:
+        return self.n_rows
+
+    def value(self, row: int, column: int) -> Any:
+        kind, values, arena, nulls = self.columns[column]
+        if arena is not None:
+            if nulls[row]:
+                return None
+            text = str(arena[values[row]:values[row + 1]], 'utf-8')
+            return intern_tag(text) if kind == 'tags' else text
+        v = values[row]
+        if kind == 'float':
+            return None if math.isnan(v) else v
+        if kind == 'bool':
+            return None if v < 0 else v == 1
+        if v == INT_NULL:
+            return None
+        return date.fromordinal(v) if kind == 'date' else v
+
+    def row(self, row: int) -> tuple:
+        return tuple(self.value(row, i) for i in range(len(self.columns)))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.n_rows))]
+        if idx < 0:
+            idx += self.n_rows
+        if not 0 <= idx < self.n_rows:
+            raise IndexError(idx)
+        return self.factory(self.row(idx))
+
+    def __iter__(self) -> Iterator:
+        for i in range(self.n_rows):
+            yield self.factory(self.row(i))
+
+    def find(self, column: str, value: Any) -> Optional[Any]:
+        # binary search over the index section of an indexed column
+        col = self.positions[column]
+        kind = self.schema.columns[col][1]
+        order = self.segment.section(f'{self.name}.{column}.index', 'q')
+        key = _sort_key(kind, value)
+        lo, hi = 0, self.n_rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _sort_key(kind, self.value(order[mid], col)) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.n_rows and self.value(order[lo], col) == value:
+            return self[order[lo]]
+        return None
+
+
+class SharedPublisher:
+    """
+    Owner side of a shared pool: every publish writes a new segment and points the control segment
+    `name` to it. The previous segment is kept for readers that are about to attach to it, and older
+    ones are unlinked; readers that still map them keep them alive until they let go.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.seq = 0
+        self.segments: List[shared_memory.SharedMemory] = list()
+        try:
+            self.control = shared_memory.SharedMemory(name, create=True, size=_CONTROL.size)
+        except FileExistsError:
+            # left over by a previous owner
+            self.control = _attach(name)
+            self.seq = _CONTROL.unpack_from(self.control.buf, 0)[0] + 1 & ~1
+
+    def publish(self, version: int, tables: Dict[str, Tuple[TableSchema, Sequence[Sequence[Any]]]]):
+        since = time.time()
+        segment = build_segment(f'{self.name}-{os.getpid()}-{version}', tables)
+        # seqlock: readers retry while the sequence number is odd or changes under them
+        self.seq += 1
+        _CONTROL.pack_into(self.control.buf, 0, self.seq, 0, 0, b'')
+        self.seq += 1
+        _CONTROL.pack_into(self.control.buf, 0, self.seq, version, time.time(), segment.name.lstrip('/').encode())
+        self.segments.append(segment)
+        while len(self.segments) > 2:
+            old = self.segments.pop(0)
+            old.close()
+            old.unlink()
+        logger.debug(f'Published {self.name} v{version} ({segment.size} bytes) in {time.time() - since:.2f}s.')
+
+    def close(self):
+        for segment in self.segments + [self.control]:
+            segment.close()
+            segment.unlink()
+        self.segments = list()
+
+
+class SharedSubscriber:
+    """
+    Reader side of a shared pool: attaches to the latest segment published under `name`.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.control: Optional[shared_memory.SharedMemory] = None
+        self.version = 0
+        self.published = 0.
+        self.segment: Optional[SharedSegment] = None
+
+    def _read_control(self) -> Tuple[int, float, str]:
+        while True:
+            seq, version, published, segment = _CONTROL.unpack_from(self.control.buf, 0)
+            if seq % 2 == 0 and _CONTROL.unpack_from(self.control.buf, 0)[0] == seq:
+                return version, published, segment.rstrip(b'\0').decode()
+            time.sleep(0.001)
+
+    def latest(self) -> Optional[SharedSegment]:
+        # the current segment, or None if nothing was published yet; attaches only if the version changed
+        for _ in range(3):
+            try:
+                if self.control is None:
+                    self.control = _attach(self.name)
+                version, published, name = self._read_control()
+                if version == 0 or version == self.version:
+                    return self.segment
+                self.segment = SharedSegment(_attach(name))
+                self.version, self.published = version, published
+                return self.segment
+            except FileNotFoundError:
+                # the owner has not started yet, or unlinked the segment before we attached
+                if self.control is not None:
+                    self.control.close()
+                    self.control = None
+        return self.segment
@@ -0,0 +1,45 @@
+import time
+from copy import deepcopy
+from typing import Generic, Iterable, Iterator, List, MutableSequence, Sequence, TypeVar, overload
+
+T = TypeVar('T')
+
+
+class Snapshot(Sequence, Generic[T]):
+    """
+    A read-only, versioned view of the content of a pool.
+    A pool publishes a new snapshot whenever its content changes, and never modifies a published one,
+    so the same snapshot is shared by all readers without copying.
+    The items are shared as well: callers that need to modify them should use `mutable_copy`.
+    Immutable sequences, such as the tables shared by other processes, are kept without copying.
+    """
+    __slots__ = ('_items', 'version', 'created')
+
+    def __init__(self, items: Iterable[T] = (), version: int = 0):
+        if isinstance(items, Sequence) and not isinstance(items, MutableSequence):
+            self._items = items
+        else:
+            self._items = tuple(items)
+        self.version = version
+        self.created = time.time()
+
+    @overload
+    def __getitem__(self, idx: int) -> T: ...
+
+    @overload
+    def __getitem__(self, idx: slice) -> Sequence[T]: ...
+
+    def __getitem__(self, idx):
+        return self._items[idx]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[T]:
+        return iter(self._items)
+
+    def __repr__(self):
+        return f'<Snapshot v{self.version}: {len(self._items)} items>'
+
+    def mutable_copy(self) -> List[T]:
+        return deepcopy(list(self._items))
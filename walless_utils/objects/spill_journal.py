@@ -0,0 +1,130 @@
+import os
+import time
+import zlib
+import pickle
+import struct
+import logging
+from pathlib import Path
+from threading import Lock
+from typing import Any, Iterator, List, Tuple
+
+logger = logging.getLogger('walless')
+
+
+class SpillJournal:
+    """
+    Append-only on-disk journal of batches that are not committed to the DB yet.
+    Each record is a pickled batch prefixed by its length and CRC32; a torn record at the tail
+    (e.g. after a crash) is dropped on open. Writes are flushed to the OS at once but fsync-ed at most
+    every `fsync_interval` seconds.
+    Offsets are logical: they keep increasing when the journal is truncated, so an offset handed out
+    before a truncation is never mistaken for a later record. The replay progress is kept in
+    `<path>.done` so that a partially replayed journal is not applied twice.
+    """
+    header = struct.Struct('<II')
+
+    def __init__(self, path: str, fsync_interval: float = 1.0):
+        self.path = Path(path).expanduser()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.done_path = self.path.with_name(self.path.name + '.done')
+        self.fsync_interval = fsync_interval
+        self.lock = Lock()
+        self.fp = open(self.path, 'ab')
+        # logical offset of the start of the file
+        self.base = 0
+        self.size = self._recover()
+        self.done = self._read_done()
+        self.last_fsync = time.time()
+
+    def _scan(self, start: int = 0) -> Iterator[Tuple[int, bytes]]:
+        # yield the physical end offset and payload of every intact record after `start`
+        with open(self.path, 'rb') as fp:
+            fp.seek(start)
+            offset = start
+            while True:
+                head = fp.read(self.header.size)
+                if len(head) < self.header.size:
+                    return
+                length, crc = self.header.unpack(head)
+                payload = fp.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return
+                offset += self.header.size + length
+                yield offset, payload
+
+    def _recover(self) -> int:
+        end = 0
+        for end, _ in self._scan():
+            pass
+        if os.path.getsize(self.path) > end:
+            logger.warning(f'Dropping the torn tail of the journal {self.path}.')
+            self.fp.truncate(end)
+        return end
+
+    def _read_done(self) -> int:
+        try:
+            return min(int(self.done_path.read_text()), self.size)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    @property
+    def end(self) -> int:
+        return self.base + self.size
+
+    @property
+    def done_offset(self) -> int:
+        return self.base + self.done
+
+    @property
+    def pending(self) -> bool:
+        return self.done < self.size
+
+    def append(self, rows: List[Tuple[Any, ...]]) -> int:
+        # returns the logical end offset of the record
+        payload = pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.fp.write(self.header.pack(len(payload), zlib.crc32(payload)))
+            self.fp.write(payload)
+            self.fp.flush()
+            if time.time() - self.last_fsync >= self.fsync_interval:
+                os.fsync(self.fp.fileno())
+                self.last_fsync = time.time()
+            self.size += self.header.size + len(payload)
+            return self.end
+
+    def records(self) -> Iterator[Tuple[int, List[Tuple[Any, ...]]]]:
+        # yield the logical end offset and rows of every record that is not done yet
+        with self.lock:
+            base, start, stop = self.base, self.done, self.size
+        for end, payload in self._scan(start):
+            if end > stop:
+                return
+            yield base + end, pickle.loads(payload)
+
+    def mark_done(self, offset: int):
+        # every record up to the logical `offset` is committed
+        with self.lock:
+            offset -= self.base
+            if offset <= self.done:
+                return
+            if offset >= self.size:
+                # everything is committed; start over with an empty file
+                self.fp.truncate(0)
+                self.base += self.size
+                self.size = self.done = 0
+                self.done_path.unlink(missing_ok=True)
+                return
+            self.done = offset
+            tmp = self.done_path.with_name(self.done_path.name + '.tmp')
+            tmp.write_text(str(offset))
+            os.replace(tmp, self.done_path)
+
+    def sync(self):
+        with self.lock:
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+            self.last_fsync = time.time()
+
+    def close(self):
+        self.sync()
+        self.fp.close()
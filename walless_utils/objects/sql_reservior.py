@@ -1,21 +1,68 @@
-from typing import List, Tuple, Any
+from typing import List, Tuple, Any, Dict, Optional, Callable, Sequence, Union
+import atexit
 import time
 import logging
+import weakref
+from queue import Queue, Empty, Full
 
 from threading import Lock, Thread
 from walless_utils.database import DBCommunicator
+from .spill_journal import SpillJournal
 
 logger = logging.getLogger('walless')
 
+# put into the queue to stop the writer
+_STOP = None
+# seconds to wait for the writer of each reservoir on interpreter exit, e.g. while the DB is unreachable
+EXIT_TIMEOUT = 10.0
+# open reservoirs, closed on interpreter exit; weak, so a reservoir can still be garbage-collected
+_reservoirs: "weakref.WeakSet[EditReservior]" = weakref.WeakSet()
+
+
+@atexit.register
+def _close_all():
+    for reservoir in list(_reservoirs):
+        reservoir.close(EXIT_TIMEOUT)
+
+COMBINE_FUNCS: Dict[str, Callable[[Any, Any], Any]] = {
+    'sum': lambda old, new: old + new,
+    'max': max,
+    'min': min,
+    'first': lambda old, new: old,
+    'last': lambda old, new: new,
+}
+# combine functions for DBCommunicator.update_user_sql and update_node_sql, keyed by the last column
+UPDATE_USER_COMBINE = ('sum', 'sum', 'sum', 'max', 'max', 'last')
+UPDATE_NODE_COMBINE = ('sum', 'sum', 'max', 'last')
+
 
 class EditReservior:
     """
     Cache for SQL edit operations.
+    With `block` or `cursor`, flushed batches are committed in the caller's thread (through its cursor,
+    as part of its transaction, if `cursor` is set), and a failed commit raises to the caller.
+    Otherwise, flushed batches are handed to a single long-lived writer thread through a bounded queue;
+    the writer logs failed commits and counts their rows as dropped. It coalesces all pending batches
+    into one `executemany`. When the queue is full, `add` and `flush` wait for the writer (backpressure)
+    instead of discarding the batch.
+    Pending batches are written on interpreter exit, waiting at most EXIT_TIMEOUT seconds per reservoir.
+    If `key` is set, rows with the same key are merged in memory with the per-column `combine` functions
+    (names in COMBINE_FUNCS or callables taking the old and the new value), e.g.
+    `EditReservior(db.update_user_sql, key=lambda row: row[-1], combine=UPDATE_USER_COMBINE)`.
+    In this mode, `cache_size` counts distinct keys.
+    If `journal_path` is set (only with the writer thread), every batch is appended to a SpillJournal
+    before it is committed. When a commit fails, the reservoir keeps accepting batches into the journal
+    only, and the writer replays the journal with exponential backoff until the DB is back. A journal
+    left over by a previous process is replayed on startup.
+    Functions added with `subscribe` see every row passed to `add`, e.g. QuotaEngine.observe.
     """
     def __init__(
         self, sql: str, db: DBCommunicator = None,
         cache_size: int = 128, cache_time: int = 300, disabled=False,
-        block: bool = False, cursor=None,
+        block: bool = False, cursor=None, max_pending: int = 64, max_coalesce: int = 100000,
+        key: Optional[Callable[[Tuple[Any, ...]], Any]] = None,
+        combine: Optional[Sequence[Union[str, Callable[[Any, Any], Any]]]] = None,
+        journal_path: Optional[str] = None,
     ):
         # time unit: seconds
         self.cache_lock = Lock()
@@ -25,22 +72,69 @@ class EditReservior:
         # if cursor is set, will use this connection to commit
         self.db = db
         self.cursor = cursor
-        # if set as True, will wait for the previous commit to finish
-        # otherwise will discard the commit
+        # if set as True, will commit in the caller's thread
+        # otherwise will hand the batch to the writer thread
         self.block = block
+        if journal_path is not None and (block or cursor is not None):
+            # the rows would be marked done before the caller's transaction commits
+            raise ValueError('journal_path needs the writer thread; it cannot be used with block or cursor')
         self.last_commit = time.time()
-        self.cache: List[Tuple[Any, ...]] = list()
+        self.key = key
+        self.combine: List[Callable[[Any, Any], Any]] = [
+            COMBINE_FUNCS[f] if isinstance(f, str) else f for f in (combine or [])
+        ]
+        if key is not None and not self.combine:
+            raise ValueError('combine functions are required when key is set')
+        # one combine function per parameter of the statement
+        if key is not None and sql.count('?') and len(self.combine) != sql.count('?'):
+            raise ValueError(f'{len(self.combine)} combine functions for {sql.count("?")} parameters of "{sql}"')
+        # a list of rows, or a dict from key to the merged row if key is set
+        self.cache: Union[List[Tuple[Any, ...]], Dict[Any, List[Any]]] = self._new_cache()
         self.disabled = disabled
-    
+        # max number of batches waiting for the writer, and max number of rows in one commit
+        self.queue: Queue = Queue(maxsize=max_pending)
+        self.max_coalesce = max_coalesce
+        self.writer: Optional[Thread] = None
+        self.closed = False
+        # metrics
+        self.committed_rows = self.dropped_rows = self.commits = 0
+        # rows merged into another row with the same key
+        self.coalesced_rows = 0
+        self.backpressure_time = 0.0
+        self.subscribers: List[Callable[[Tuple[Any, ...]], None]] = list()
+        self.journal: Optional[SpillJournal] = None
+        self.journal_lock = Lock()
+        # set while commits fail; batches then only go to the journal
+        self.outage = False
+        if journal_path is not None:
+            self.journal = SpillJournal(journal_path)
+            if self.journal.pending:
+                logger.warning(f'Replaying the journal of "{sql}" at {journal_path}.')
+                self.outage = True
+                self._start_writer()
+        _reservoirs.add(self)
+
+    def _new_cache(self):
+        return list() if self.key is None else dict()
+
+    def _merge(self, cache: Dict[Any, List[Any]], row):
+        k = self.key(row)
+        old = cache.get(k)
+        if old is None:
+            cache[k] = list(row)
+            return
+        for i, func in enumerate(self.combine):
+            old[i] = func(old[i], row[i])
+        self.coalesced_rows += 1
+
+    def _rows(self, cache) -> List[Tuple[Any, ...]]:
+        if self.key is None:
+            return cache
+        return [tuple(row) for row in cache.values()]
+
     def _commit(self, args: List[Tuple[Any, ...]]):
         if len(args) == 0:
             return
-        if self.commit_lock.locked() and not self.block:
-            logger.warning(
-                f'Last commit of "{self.sql}" is not done yet. '
-                'Discard this commit.'
-            )
-            return
         with self.commit_lock:
             if self.cursor is not None:
                 DBCommunicator.execute_cursor(
@@ -48,24 +142,188 @@ class EditReservior:
                 )
             else:
                 self.db.execute(sql=self.sql, args=args, bulk=True, query=False)
-    
+        self.committed_rows += len(args)
+        self.commits += 1
+
+    def _coalesce(self, args: List[Tuple[Any, ...]]) -> List[Tuple[Any, ...]]:
+        if self.key is None:
+            return args
+        # rows of different batches may share keys as well
+        merged = dict()
+        for row in args:
+            self._merge(merged, row)
+        return self._rows(merged)
+
+    def _try_commit(self, args: List[Tuple[Any, ...]], end: Optional[int] = None) -> bool:
+        # `end` is the journal offset up to which the rows are journaled
+        try:
+            self._commit(args)
+        except Exception as e:
+            if self.journal is None:
+                self.dropped_rows += len(args)
+                logger.error(f'Fail to commit {len(args)} rows of "{self.sql}": {e}')
+            else:
+                logger.error(f'Fail to commit {len(args)} rows of "{self.sql}": {e}. Kept in the journal.')
+                self.outage = True
+            return False
+        if end is not None:
+            self.journal.mark_done(end)
+        return True
+
+    def _replay(self) -> bool:
+        # commit the journaled batches; returns False if a commit fails
+        args, end = list(), None
+        for end, rows in self.journal.records():
+            args.extend(rows)
+            if len(args) >= self.max_coalesce:
+                if not self._try_commit(self._coalesce(args), end):
+                    return False
+                args = list()
+        if args and not self._try_commit(self._coalesce(args), end):
+            return False
+        with self.journal_lock:
+            # batches journaled during the replay are picked up by the next one
+            if not self.journal.pending:
+                logger.warning(f'Journal of "{self.sql}" is replayed.')
+                self.outage = False
+        return True
+
+    def _write_loop(self):
+        backoff = 1.0
+        while True:
+            timeout = None
+            if self.outage:
+                if self._replay():
+                    backoff = 1.0
+                    if self.outage:
+                        continue
+                else:
+                    # keep consuming the queue while waiting to retry; its batches are journaled
+                    timeout, backoff = backoff, min(backoff * 2, 300.0)
+            try:
+                batch = self.queue.get(timeout=timeout)
+            except Empty:
+                continue
+            if batch is _STOP:
+                return
+            args, end = batch
+            if self.outage or (end is not None and end <= self.journal.done_offset):
+                # left to (or already done by) the journal replay
+                continue
+            args, stop = list(args), False
+            # coalesce the batches that are already waiting
+            while len(args) < self.max_coalesce:
+                try:
+                    more = self.queue.get_nowait()
+                except Empty:
+                    break
+                if more is _STOP:
+                    stop = True
+                    break
+                args.extend(more[0])
+                end = more[1]
+            self._try_commit(self._coalesce(args), end)
+            if stop:
+                return
+
+    def _start_writer(self):
+        if self.writer is None and not self.closed:
+            with self.commit_lock:
+                if self.writer is None:
+                    self.writer = Thread(target=self._write_loop, daemon=True)
+                    self.writer.start()
+
+    def _submit(self, args: List[Tuple[Any, ...]]):
+        if len(args) == 0:
+            return
+        end = None
+        if self.journal is not None:
+            # write ahead; during an outage the batch is only kept on disk
+            with self.journal_lock:
+                end = self.journal.append(args)
+                if self.outage:
+                    self._start_writer()
+                    return
+        if self.block or self.cursor is not None:
+            # errors go to the caller, e.g. to roll back its transaction
+            self._commit(args)
+            return
+        if self.closed:
+            if not self._try_commit(args, end) and self.outage:
+                self._start_writer()
+            return
+        self._start_writer()
+        if self.queue.full():
+            logger.warning(f'Writer of "{self.sql}" is falling behind. Waiting.')
+            since = time.time()
+            self.queue.put((args, end))
+            self.backpressure_time += time.time() - since
+        else:
+            self.queue.put((args, end))
+
     def flush(self):
         if self.disabled:
             return
-        if self.block:
-            self._commit(self.cache)
-        else:
-            th = Thread(target=self._commit, args=(self.cache,))
-            th.start()
-        self.cache = list()
-        self.last_commit = time.time()
-    
+        # batches are submitted under the cache lock, so they reach the DB in the order they were cached
+        with self.cache_lock:
+            self._submit(self._rows(self.cache))
+            self.cache = self._new_cache()
+            self.last_commit = time.time()
+
+    def subscribe(self, func: Callable[[Tuple[Any, ...]], None]):
+        self.subscribers.append(func)
+
     def add(self, args):
         if self.disabled:
             return
+        # validate before the subscribers count the row
+        if self.key is not None and len(args) != len(self.combine):
+            raise ValueError(f'Row of {len(args)} columns for {len(self.combine)} combine functions')
+        for func in self.subscribers:
+            func(args)
         with self.cache_lock:
-            self.cache.append(args)
+            if self.key is None:
+                self.cache.append(args)
+            else:
+                self._merge(self.cache, args)
             oversized = (self.cache_size <= len(self.cache))
             time_passed = (self.cache_time <= time.time() - self.last_commit)
             if oversized or time_passed:
-                self.flush()
+                self._submit(self._rows(self.cache))
+                self.cache = self._new_cache()
+                self.last_commit = time.time()
+
+    def close(self, timeout: Optional[float] = None):
+        # flush the cache and wait for the writer to finish the pending batches
+        if self.closed:
+            return
+        self.flush()
+        self.closed = True
+        _reservoirs.discard(self)
+        if self.writer is not None:
+            try:
+                self.queue.put(_STOP, timeout=timeout)
+            except Full:
+                pass
+            self.writer.join(timeout)
+            if self.writer.is_alive():
+                kept = 'kept in the journal' if self.journal is not None else 'lost'
+                logger.error(
+                    f'Writer of "{self.sql}" did not finish in {timeout}s; '
+                    f'the batch being committed and {self.queue.qsize()} queued batches are {kept}.'
+                )
+        if self.journal is not None:
+            self.journal.sync()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self.queue.qsize(),
+            'cached_rows': len(self.cache),
+            'committed_rows': self.committed_rows,
+            'dropped_rows': self.dropped_rows,
+            'coalesced_rows': self.coalesced_rows,
+            'commits': self.commits,
+            'backpressure_time': self.backpressure_time,
+            'outage': self.outage,
+            'journal_bytes': 0 if self.journal is None else self.journal.size - self.journal.done,
+        }
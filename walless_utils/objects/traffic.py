@@ -23,5 +23,5 @@ class Traffic:
         return Traffic(lst[0], lst[1], None, lst[2], lst[3])
 
     def __repr__(self):
-        return f'<Traffic {self.traffic_id}: Node {self.node_id}, User {self.user_id}>'
+        return f'<Traffic {self.date}: Node {self.node_uuid}, User {self.user_id}>'
 
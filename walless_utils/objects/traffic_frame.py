@@ -0,0 +1,209 @@
+from datetime import date
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from ..utils import lazy_numpy
+
+# columns summed by group_sum by default
+VALUE_COLUMNS = ('upload', 'download')
+# kind of the columns of the traffic tables; other columns take the kind of their type in the cursor
+# description, or of their first value
+COLUMN_KINDS = {'ut_date': 'date', 'user_id': 'int', 'node_id': 'object', 'upload': 'int', 'download': 'int'}
+_DTYPES = {'date': 'datetime64[D]', 'int': 'int64', 'float': 'float64', 'object': 'object'}
+_EPOCH = date(1970, 1, 1).toordinal()
+# NaT as int64
+_NAT = -2**63
+
+
+class TrafficFrame:
+    """
+    Traffic rows (of main_traffic, main_usertraffic or main_nodetraffic) as one NumPy array per column.
+    Every column has a fixed dtype by its kind (see COLUMN_KINDS): dates are datetime64[D] with NaT for
+    NULL, numbers int64 (or float64) with NULL stored as 0 and flagged in `nulls`, and strings (node uuids)
+    object arrays that keep None. `total` is available as a column as well (upload + download).
+    Sums treat NULL as 0, as SQL SUM does.
+    Operations return new frames: `group_sum` sums the values per key, `top` keeps the k largest groups,
+    and `bucket` groups by day, week (starting on Monday), month or year.
+    """
+    def __init__(self, columns: Dict[str, Any], nulls: Optional[Dict[str, Any]] = None):
+        self.np = lazy_numpy()
+        self.columns = columns
+        # column -> mask of its NULL values, for the int and float columns that have any
+        self.nulls = nulls or dict()
+
+    @classmethod
+    def from_rows(
+        cls, rows: Iterable[Sequence], names: Sequence[str], kinds: Optional[Dict[str, str]] = None,
+    ) -> "TrafficFrame":
+        np = lazy_numpy()
+        rows = list(rows)
+        columns = list(zip(*rows)) if rows else [()] * len(names)
+        kinds = kinds or dict()
+        frame, nulls = dict(), dict()
+        for name, values in zip(names, columns):
+            kind = kinds.get(name) or COLUMN_KINDS.get(name) or _kind(next((v for v in values if v is not None), None))
+            frame[name], mask = _to_array(np, kind, values)
+            if mask is not None:
+                nulls[name] = mask
+        return cls(frame, nulls)
+
+    @classmethod
+    def from_cursor(cls, cursor, names: Optional[Sequence[str]] = None, fetch_size: int = 50000) -> "TrafficFrame":
+        # stream an executed query with fetchmany; only one chunk of rows is held as Python objects at a time
+        if names is None:
+            names = [d[0].lower() for d in cursor.description]
+        # the kinds are fixed up front, so every chunk gets the same dtype whatever its values
+        kinds = [COLUMN_KINDS.get(name) or _kind(d[1]) for name, d in zip(names, cursor.description)]
+        np = lazy_numpy()
+        chunks: Dict[str, list] = {name: [] for name in names}
+        masks: Dict[str, list] = {name: [] for name in names}
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for name, kind, values in zip(names, kinds, zip(*rows)):
+                arr, mask = _to_array(np, kind, values)
+                chunks[name].append(arr)
+                masks[name].append(mask)
+        frame, nulls = dict(), dict()
+        for name, kind in zip(names, kinds):
+            arrays = chunks[name]
+            frame[name] = np.concatenate(arrays) if arrays else np.zeros(0, _DTYPES[kind])
+            if any(m is not None for m in masks[name]):
+                nulls[name] = np.concatenate([
+                    np.zeros(len(a), bool) if m is None else m for a, m in zip(arrays, masks[name])
+                ])
+        return cls(frame, nulls)
+
+    def __len__(self) -> int:
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def __getitem__(self, name: str):
+        if name == 'total' and 'total' not in self.columns:
+            return self.columns['upload'] + self.columns['download']
+        return self.columns[name]
+
+    def __repr__(self):
+        return f'<TrafficFrame {len(self)} rows: {", ".join(self.columns)}>'
+
+    def isnull(self, name: str):
+        col = self.columns[name]
+        if name in self.nulls:
+            return self.nulls[name]
+        if col.dtype.kind == 'M':
+            return self.np.isnat(col)
+        if col.dtype.kind == 'O':
+            return self.np.fromiter((v is None for v in col), bool, len(col))
+        return self.np.zeros(len(col), bool)
+
+    def filter(self, mask) -> "TrafficFrame":
+        return TrafficFrame(
+            {name: col[mask] for name, col in self.columns.items()},
+            {name: nulls[mask] for name, nulls in self.nulls.items()},
+        )
+
+    def between(self, start: date, end: date) -> "TrafficFrame":
+        # rows with start <= ut_date < end
+        d = self.columns['ut_date']
+        return self.filter((d >= self.np.datetime64(start, 'D')) & (d < self.np.datetime64(end, 'D')))
+
+    def _group(self, by: Sequence[str]) -> Tuple[Dict[str, Any], Any]:
+        # distinct keys, and the group of every row
+        np = self.np
+        uniques, codes, dims = list(), list(), list()
+        for name in by:
+            u, inv = np.unique(self.columns[name], return_inverse=True)
+            uniques.append(u)
+            codes.append(inv.reshape(-1))
+            dims.append(len(u))
+        if len(by) == 1:
+            return {by[0]: uniques[0]}, codes[0]
+        code = np.ravel_multi_index(codes, dims)
+        groups, inv = np.unique(code, return_inverse=True)
+        parts = np.unravel_index(groups, dims)
+        return {name: u[p] for name, u, p in zip(by, uniques, parts)}, inv.reshape(-1)
+
+    def group_sum(self, by: Union[str, Sequence[str]], values: Sequence[str] = VALUE_COLUMNS) -> "TrafficFrame":
+        np = self.np
+        by = [by] if isinstance(by, str) else list(by)
+        if len(self) == 0:
+            return TrafficFrame({name: self.columns[name][:0] for name in by + list(values)})
+        keys, inv = self._group(by)
+        # sum in int64 over the rows sorted by group, which is exact, unlike bincount with weights
+        order = np.argsort(inv, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(inv[order]) != 0])
+        sums = {name: np.add.reduceat(self[name][order], starts) for name in values}
+        return TrafficFrame({**keys, **sums})
+
+    def top(self, k: int, by: Union[str, Sequence[str]] = 'user_id', value: str = 'total') -> "TrafficFrame":
+        # the k groups with the largest value, largest first
+        np = self.np
+        values = VALUE_COLUMNS if value in VALUE_COLUMNS + ('total',) else VALUE_COLUMNS + (value,)
+        grouped = self.group_sum(by, values)
+        v = grouped[value]
+        if k < len(v):
+            idx = np.argpartition(-v, k - 1)[:k]
+        else:
+            idx = np.arange(len(v))
+        idx = idx[np.argsort(-v[idx], kind='stable')]
+        return grouped.filter(idx)
+
+    def bucket(self, freq: str = 'day', by: Union[str, Sequence[str], None] = None) -> "TrafficFrame":
+        # sums per period (in ut_date, the first day of the period) and per `by`
+        np = self.np
+        d = self.columns['ut_date']
+        if freq == 'day':
+            period = d
+        elif freq == 'week':
+            # 1970-01-01 is a Thursday
+            period = d - ((d.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+        elif freq in ('month', 'year'):
+            period = d.astype('datetime64[M]' if freq == 'month' else 'datetime64[Y]').astype('datetime64[D]')
+        else:
+            raise ValueError(f'Unknown frequency: {freq}')
+        by = [] if by is None else [by] if isinstance(by, str) else list(by)
+        frame = TrafficFrame(dict(self.columns, ut_date=period), self.nulls)
+        return frame.group_sum(['ut_date'] + by)
+
+    def rows(self, names: Optional[Sequence[str]] = None) -> List[tuple]:
+        names = list(self.columns) if names is None else names
+        return list(zip(*(_to_python(self[name], self.nulls.get(name)) for name in names)))
+
+
+def _kind(t) -> str:
+    # kind of a column from a type (as in a cursor description) or a value
+    if not isinstance(t, type):
+        t = type(t)
+    if issubclass(t, date):
+        return 'date'
+    if issubclass(t, int):
+        return 'int'
+    if issubclass(t, float):
+        return 'float'
+    return 'object'
+
+
+def _to_array(np, kind: str, values: Sequence) -> Tuple[Any, Optional[Any]]:
+    # typed column from a sequence of DB values, and the mask of its NULLs for number columns that have any
+    n = len(values)
+    if kind == 'date':
+        # through ordinals, which is much faster than letting NumPy parse date objects
+        days = np.fromiter((_NAT if v is None else v.toordinal() - _EPOCH for v in values), np.int64, n)
+        return days.view('datetime64[D]'), None
+    if kind in ('int', 'float'):
+        arr = np.fromiter((0 if v is None else v for v in values), _DTYPES[kind], n)
+        if None not in values:
+            return arr, None
+        return arr, np.fromiter((v is None for v in values), bool, n)
+    arr = np.empty(n, object)
+    arr[:] = values
+    return arr, None
+
+
+def _to_python(col, nulls=None) -> list:
+    if col.dtype.kind == 'M':
+        values = col.astype(object).tolist()
+    else:
+        values = col.tolist()
+    if nulls is not None:
+        values = [None if null else v for v, null in zip(values, nulls.tolist())]
+    return values
@@ -1,12 +1,26 @@
-from typing import Tuple, Optional
+import sys
+from typing import Tuple, Optional, Dict
 from datetime import datetime, date
 from dataclasses import dataclass
 
 from ..utils import tz
 from ..global_obj.config_setup import DOMAINS, BALANCE_CONFIG
 
+# raw tag string -> tag tuple; there are only a handful of distinct tags, shared by all users
+_tag_cache: Dict[str, Tuple[str, ...]] = dict()
 
-@dataclass()
+
+def intern_tag(tag: Optional[str]) -> Tuple[str, ...]:
+    if not tag:
+        return tuple()
+    ret = _tag_cache.get(tag)
+    if ret is None:
+        ret = _tag_cache[tag] = tuple(sys.intern(t) for t in tag.split(':'))
+    return ret
+
+
+# users are immutable and have no per-instance __dict__; use dataclasses.replace to modify them
+@dataclass(frozen=True, slots=True)
 class User:
     user_id: int
     enabled: bool
@@ -25,13 +39,16 @@ class User:
     remarks: Optional[str] = None
 
     def __post_init__(self):
-        self.enabled = (self.enabled != 0)
-        self.blocked = (self.blocked != 0)
+        # the class is frozen, so fields are set through object.__setattr__
+        set_ = object.__setattr__
+        set_(self, 'enabled', self.enabled != 0)
+        set_(self, 'blocked', self.blocked != 0)
         if isinstance(self.register_day, int):
-            self.register_day = datetime.fromtimestamp(self.register_day, tz=tz).date()
+            set_(self, 'register_day', datetime.fromtimestamp(self.register_day, tz=tz).date())
         if isinstance(self.last_active_day, int):
-            self.last_active_day = datetime.fromtimestamp(self.last_active_day, tz=tz).date()
-        self.tag = tuple(self.tag.split(':')) if self.tag else tuple()
+            set_(self, 'last_active_day', datetime.fromtimestamp(self.last_active_day, tz=tz).date())
+        if not isinstance(self.tag, tuple):
+            set_(self, 'tag', intern_tag(self.tag))
 
     @property
     def valid(self):
@@ -60,8 +77,9 @@ class User:
         return f'https://{DOMAINS["provider"]}/clash/{self.email}/{self.password}' + args
 
     @property
-    def grade(self):
-        return min(tag.lower() for tag in self.tag if len(tag) == 1)
+    def grade(self) -> Optional[str]:
+        # the best single-letter tag; None for users without one, whose quotas are then unlimited
+        return min((tag.lower() for tag in self.tag if len(tag) == 1), default=None)
 
     @property
     def total_data(self) -> int:
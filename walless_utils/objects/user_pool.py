@@ -1,9 +1,26 @@
 import time
 from threading import Lock, Thread
+from dataclasses import fields
+from typing import List, Optional
 import logging
-from copy import deepcopy
 
 from ..database import DBCommunicator
+from .snapshot import Snapshot
+from .user import User
+from .pool_cache import save_cache, load_cache
+from .shared_table import TableSchema, SharedTable, SharedPublisher, SharedSubscriber
+
+USER_COLUMNS = [f.name for f in fields(User)]
+# in the order of USER_COLUMNS, which tests/test_schemas.py checks
+USER_SCHEMA = TableSchema(
+    (
+        ('user_id', 'int'), ('enabled', 'bool'), ('blocked', 'bool'), ('username', 'str'), ('password', 'str'),
+        ('email', 'str'), ('tag', 'tags'), ('register_day', 'date'), ('last_active_day', 'date'),
+        ('upload', 'int'), ('download', 'int'), ('balance', 'int'), ('uuid', 'str'), ('last_change', 'int'),
+        ('remarks', 'str'),
+    ),
+    indexes=('user_id', 'email'),
+)
 
 logger = logging.getLogger('walless')
 
@@ -12,10 +29,27 @@ class UserPool:
     """
     It fetches user list from the database and save it as a local cache.
     It updates the list on-demand (instead of pulling everything every time).
+    Readers get the latest published Snapshot of the users, which is shared instead of copied.
+    If `cache_path` is set, the users and the watermark are saved there after pulls (at most every
+    `cache_gap` seconds) and loaded on the first pull, so a restarted process only pulls the users
+    changed since the cache was saved.
+    If `shared` is set, the pools of the processes on a host share one copy of the users in shared memory,
+    named after `shared`: the process with `shared_owner=True` pulls from the database and publishes every
+    snapshot, and the other processes never touch the database; they read the latest published users in
+    place. Use `by_email` and `by_id` rather than `email2user` and `id2user`, which are empty in readers.
+    With `change_feed=True`, pulls consume DBCommunicator.changes_since instead of polling `last_change`
+    with a safety margin, so every change is applied exactly once.
     """
-    def __init__(self, enable_only=True, db=None, min_gap=60):
+    def __init__(
+        self, enable_only=True, db=None, min_gap=60,
+        cache_path: Optional[str] = None, cache_gap=300, cache_max_age: Optional[float] = None,
+        shared: Optional[str] = None, shared_owner: bool = False, change_feed: bool = False, feed_batch=50000,
+    ):
         self.id2user = dict()
         self.email2user = dict()
+        self.snapshot: Snapshot[User] = Snapshot()
+        # set if users are added or updated after the last snapshot was published
+        self.dirty = False
         self.last_update = 100
         self.last_pull = 100
         self.min_gap = min_gap
@@ -23,21 +57,136 @@ class UserPool:
         self.db: DBCommunicator = db
         self.pool_lock = Lock()
         self.pull_lock = Lock()
+        self.snapshot_lock = Lock()
+        self.change_feed = change_feed
+        self.feed_batch = feed_batch
+        # position in the change feed, see DBCommunicator.changes_since
+        self.feed_version = 0
+        self.cache_path = cache_path
+        self.cache_gap = cache_gap
+        self.cache_max_age = cache_max_age
+        self.cache_loaded = False
+        self.cache_saved = 0
+        self.cache_version = 0
+        self.shared = shared
+        self.shared_owner = shared_owner
+        self.shared_version = 0
+        # set when a RefreshScheduler keeps the pool up to date
+        self.scheduled = False
+        self.publisher: Optional[SharedPublisher] = None
+        self.subscriber: Optional[SharedSubscriber] = None
+        # the users of the latest shared snapshot, in readers
+        self.shared_users: Optional[SharedTable] = None
+
+    @property
+    def shared_reader(self) -> bool:
+        return self.shared is not None and not self.shared_owner
     
     def _pull(self, blocking):
         if not self.pull_lock.acquire(blocking=blocking):
             return
         try:
             logger.debug(f'Pulling users with {blocking=}')
+            if self.cache_path and not self.cache_loaded:
+                self._load_cache()
             since = time.time()
-            for u in self.db.all_users(self.enable_only, int(self.last_update)):
-                self.add_or_update_user(u)
-            self.last_update = time.time() - 30
+            if self.change_feed:
+                self._pull_feed()
+            else:
+                self._apply(self.db.all_users(self.enable_only, int(self.last_update)))
+                self.last_update = time.time() - 30
+            self._publish()
             logger.debug(f'User pull done. Time cose: {time.time() - since:.2f}s.')
+            if self.cache_path and time.time() - self.cache_saved >= self.cache_gap:
+                self._save_cache()
+            if self.shared is not None:
+                self._share()
         finally:
             self.pull_lock.release()
 
+    def _pull_feed(self):
+        # the caller must hold self.pull_lock
+        while True:
+            users, version = self.db.changes_since(self.feed_version, self.feed_batch)
+            self._apply(users)
+            self.feed_version = version
+            if len(users) < self.feed_batch:
+                break
+        self.last_update = time.time()
+
+    def _rows(self, snapshot: Snapshot[User]) -> list:
+        return [tuple(getattr(u, name) for name in USER_COLUMNS) for u in snapshot]
+
+    def _share(self):
+        # owner side; the caller must hold self.pull_lock
+        snapshot = self.snapshot
+        if snapshot.version == self.shared_version:
+            return
+        if self.publisher is None:
+            self.publisher = SharedPublisher(f'{self.shared}-user')
+        self.publisher.publish(snapshot.version, {'user': (USER_SCHEMA, self._rows(snapshot))})
+        self.shared_version = snapshot.version
+
+    def _attach(self):
+        # reader side: switch to the latest users published by the owner
+        with self.pull_lock:
+            if self.subscriber is None:
+                self.subscriber = SharedSubscriber(f'{self.shared}-user')
+            segment = self.subscriber.latest()
+            if segment is None:
+                logger.warning(f'No users are shared as {self.shared} yet.')
+                return
+            if self.subscriber.version == self.shared_version:
+                return
+            users = segment.table('user', USER_SCHEMA, User.from_list)
+            with self.snapshot_lock:
+                self.snapshot = Snapshot(users, self.subscriber.version)
+            self.shared_users = users
+            self.shared_version = self.subscriber.version
+            self.last_pull = self.subscriber.published
+
+    def _load_cache(self):
+        # warm start; the caller must hold self.pull_lock
+        self.cache_loaded = True
+        if len(self.id2user) > 0:
+            return
+        payload = load_cache(self.cache_path, b'user', {'user': USER_SCHEMA}, self.cache_max_age)
+        if payload is None:
+            return
+        self._apply([User.from_list(row) for row in payload['user']])
+        self.last_update = payload['watermark']
+        self.feed_version = payload.get('version', 0)
+        self._publish()
+        self.cache_saved = time.time()
+        self.cache_version = self.snapshot.version
+        logger.info(f'Loaded {len(self.id2user)} users from {self.cache_path}.')
+
+    def _save_cache(self):
+        # the snapshot is immutable, and pulls (which move the watermark) hold self.pull_lock
+        snapshot = self.snapshot
+        if snapshot.version == self.cache_version:
+            return
+        save_cache(self.cache_path, b'user', {'user': (USER_SCHEMA, self._rows(snapshot))}, {
+            'watermark': self.last_update, 'version': self.feed_version,
+        })
+        self.cache_saved = time.time()
+        self.cache_version = snapshot.version
+
+    def refresh(self):
+        # blocking pull, run by the scheduler
+        if self.shared_reader:
+            self._attach()
+            return
+        self._pull(blocking=True)
+        self.last_pull = time.time()
+
     def pull(self, force=False):
+        # pools refreshed by a scheduler (see global_obj.refresh_setup) only pull here while empty
+        if self.scheduled and not force and len(self.snapshot) > 0:
+            return
+        if self.shared_reader:
+            self._attach()
+            return
         with self.pool_lock:
             if len(self.email2user) == 0 or force:
                 # pull with blocking
@@ -45,7 +194,7 @@ class UserPool:
                 self.last_pull = time.time()
                 return
 
-            if time.time() - self.last_update < self.min_gap:
+            if time.time() - self.last_pull < self.min_gap:
                 return
 
             # pull without blocking
@@ -53,17 +202,38 @@ class UserPool:
             th = Thread(target=self._pull, args=(False,))
             th.start()
 
+    def _publish(self):
+        # id2user and email2user are only changed under self.snapshot_lock, so they can be iterated here
+        with self.snapshot_lock:
+            if self.dirty or self.snapshot.version == 0:
+                self.dirty = False
+                self.snapshot = Snapshot(self.id2user.values(), self.snapshot.version + 1)
+
+    def _apply(self, users: List[User]):
+        # users are replaced instead of modified, so published snapshots are left intact; the changes are
+        # only seen by all_users() once the caller publishes them
+        with self.snapshot_lock:
+            for user in users:
+                self.dirty = True
+                if user.user_id in self.id2user:
+                    self.id2user.pop(user.user_id)
+                if user.email in self.email2user:
+                    self.email2user.pop(user.email)
+                if not user.enabled and self.enable_only:
+                    continue
+                self.id2user[user.user_id] = user
+                self.email2user[user.email] = user
+
     def add_or_update_user(self, user):
-        if user.user_id in self.id2user:
-            self.id2user.pop(user.user_id)
-        if user.email in self.email2user:
-            self.email2user.pop(user.email)
-        if not user.enabled and self.enable_only:
-            return
-        self.id2user[user.user_id] = user
-        self.email2user[user.email] = user
+        # waits for a running pull, so a snapshot never holds half of its changes
+        with self.pull_lock:
+            self._apply([user])
+            self._publish()
 
     def pull_one_user(self, email, force=False):
+        if self.shared_reader:
+            # the owner pulls the user with its next pull
+            return
         if email in self.email2user and not force and (time.time() - self.email2user[email].last_change) < self.min_gap:
             return
         with self.pool_lock:
@@ -72,8 +242,42 @@ class UserPool:
                 return
             self.add_or_update_user(user)
 
-    def all_users(self, pull=True):
-        if pull or len(self.id2user) == 0:
+    def pull_many(self, emails, force=False) -> List[User]:
+        # pull_one_user for many users, with a few round trips and a single update of the pool
+        if self.shared_reader:
+            return []
+        now = time.time()
+        emails = [
+            email for email in emails
+            if force or email not in self.email2user or now - self.email2user[email].last_change >= self.min_gap
+        ]
+        if len(emails) == 0:
+            return []
+        users = self.db.get_users_by_emails(emails)
+        with self.pool_lock:
+            for user in users:
+                self.add_or_update_user(user)
+        return users
+
+    def all_users(self, pull=True) -> Snapshot[User]:
+        if pull or len(self.snapshot) == 0:
             self.pull()
-        # return a copy to prevent in-place modification
-        return deepcopy(list(self.id2user.values()))
+        # shared by all readers; use `mutable_copy()` to get users that can be modified
+        return self.snapshot
+
+    def by_email(self, email: str) -> Optional[User]:
+        if self.shared_reader:
+            return self._find_shared('email', email)
+        return self.email2user.get(email)
+
+    def by_id(self, user_id: int) -> Optional[User]:
+        if self.shared_reader:
+            return self._find_shared('user_id', user_id)
+        return self.id2user.get(user_id)
+
+    def _find_shared(self, column: str, value) -> Optional[User]:
+        if self.shared_users is None:
+            self._attach()
+        if self.shared_users is None:
+            return None
+        return self.shared_users.find(column, value)
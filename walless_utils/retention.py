@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import logging
+from threading import Event, Lock
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Any, Callable, Dict, Optional
+
+from .database import DBCommunicator
+from .utils import tn
+
+logger = logging.getLogger('walless')
+
+
+@dataclass(frozen=True)
+class RetentionTable:
+    table: str
+    # rows with `column` < cutoff are deleted
+    column: str
+    # an increasing integer key; if set, rows are deleted in ranges of it, else with DELETE TOP / LIMIT
+    key: Optional[str] = None
+
+
+# the tables of DBCommunicator.delete_*_sql
+RETENTION_TABLES: Dict[str, RetentionTable] = {
+    'probe': RetentionTable(tn.probe, 'ts'),
+    'sublog': RetentionTable(tn.sublog, 'ts', key='sub_id'),
+    'traffic': RetentionTable(tn.traffic, 'ut_date'),
+    'registration': RetentionTable(tn.reg, 'ts', key='reg_id'),
+}
+
+
+@dataclass
+class RetentionProgress:
+    name: str
+    cutoff: str
+    deleted: int = 0
+    batches: int = 0
+    # last key deleted up to (inclusive) and the last key to delete, for tables with a key
+    last_key: Optional[int] = None
+    max_key: Optional[int] = None
+    done: bool = False
+    elapsed: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.deleted / self.elapsed if self.elapsed else 0.0
+
+
+class RetentionEngine:
+    """
+    Deletes old rows in small batches, so no statement holds its locks or grows the transaction log for
+    long. Every batch deletes at most `batch_size` rows (or a `batch_size` wide range of the key) in its own
+    transaction, followed by `pause` seconds to let the writers of the table through. Tables are cleaned up
+    in parallel, one thread each.
+    With `state_path`, the position in the key range of every table is saved after each batch, so a stopped
+    or failed run resumes where it left off, as long as the cutoff is the same.
+    """
+    delete_top_sql = {
+        'mssql': 'DELETE TOP (?) FROM {table} WHERE {column} < ?',
+        'mysql': 'DELETE FROM {table} WHERE {column} < ? LIMIT ?',
+    }
+    key_range_sql = 'SELECT MIN({key}), MAX({key}) FROM {table} WHERE {column} < ?'
+    delete_range_sql = 'DELETE FROM {table} WHERE {key} >= ? AND {key} < ? AND {column} < ?'
+
+    def __init__(
+        self, db: DBCommunicator, batch_size: int = 5000, pause: float = 0.1, state_path: Optional[str] = None,
+        tables: Optional[Dict[str, RetentionTable]] = None, report_gap: float = 30,
+        on_progress: Optional[Callable[[RetentionProgress], Any]] = None,
+    ):
+        self.db = db
+        self.batch_size, self.pause = batch_size, pause
+        self.state_path = os.path.expanduser(state_path) if state_path else None
+        self.tables = tables or RETENTION_TABLES
+        self.report_gap = report_gap
+        self.on_progress = on_progress
+        self.progress: Dict[str, RetentionProgress] = dict()
+        self.lock = Lock()
+        self.stopped = Event()
+
+    def _load_state(self) -> Dict[str, dict]:
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return dict()
+        try:
+            with open(self.state_path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError) as e:
+            logger.warning(f'Ignoring the retention state at {self.state_path}: {e}')
+            return dict()
+
+    def _save_state(self):
+        # the caller must hold self.lock
+        if self.state_path is None:
+            return
+        tmp = f'{self.state_path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump({name: asdict(p) for name, p in self.progress.items()}, fp)
+        os.replace(tmp, self.state_path)
+
+    def _delete_top(self, spec: RetentionTable, cutoff) -> int:
+        sql = self.delete_top_sql[self.db.dialect].format(table=spec.table, column=spec.column)
+        args = [self.batch_size, cutoff] if self.db.dialect == 'mssql' else [cutoff, self.batch_size]
+        with self.db.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, args)
+                deleted = cur.rowcount
+            conn.commit()
+        return deleted
+
+    def _delete_range(self, spec: RetentionTable, cutoff, lo: int, hi: int) -> int:
+        sql = self.delete_range_sql.format(table=spec.table, key=spec.key, column=spec.column)
+        with self.db.pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, [lo, hi, cutoff])
+                deleted = cur.rowcount
+            conn.commit()
+        return deleted
+
+    def _batch(self, spec: RetentionTable, progress: RetentionProgress, cutoff) -> bool:
+        # deletes one batch; returns False when there is nothing left to delete
+        if spec.key is None:
+            deleted = self._delete_top(spec, cutoff)
+            more = deleted >= self.batch_size
+        else:
+            if progress.max_key is None:
+                lo, hi = self.db.execute(self.key_range_sql.format(**asdict(spec)), args=[cutoff])[0]
+                if lo is None:
+                    return False
+                progress.last_key, progress.max_key = lo - 1, hi
+            if progress.last_key >= progress.max_key:
+                return False
+            lo = progress.last_key + 1
+            hi = min(lo + self.batch_size, progress.max_key + 1)
+            deleted = self._delete_range(spec, cutoff, lo, hi)
+            progress.last_key = hi - 1
+            more = progress.last_key < progress.max_key
+        with self.lock:
+            progress.deleted += deleted
+            progress.batches += 1
+            self._save_state()
+        return more
+
+    def _run_table(self, name: str, cutoff) -> RetentionProgress:
+        spec = self.tables[name]
+        progress = self.progress[name]
+        since, reported = time.time() - progress.elapsed, time.time()
+        try:
+            while not self.stopped.is_set():
+                more = self._batch(spec, progress, cutoff)
+                progress.elapsed = time.time() - since
+                if not more:
+                    progress.done = True
+                    break
+                if time.time() - reported > self.report_gap:
+                    reported = time.time()
+                    self._report(progress)
+                self.stopped.wait(self.pause)
+        except Exception as e:
+            progress.error = repr(e)
+            logger.exception(f'Retention of {spec.table} failed after {progress.deleted} rows.')
+        progress.elapsed = time.time() - since
+        with self.lock:
+            self._save_state()
+        self._report(progress)
+        return progress
+
+    def _report(self, progress: RetentionProgress):
+        keys = f', key {progress.last_key}/{progress.max_key}' if progress.max_key is not None else ''
+        logger.info(
+            f'Retention of {progress.name}: {progress.deleted} rows in {progress.batches} batches{keys}, '
+            f'{progress.rows_per_second:.0f} rows/s{", done" if progress.done else ""}.'
+        )
+        if self.on_progress is not None:
+            self.on_progress(progress)
+
+    def run(self, cutoffs: Dict[str, Any]) -> Dict[str, RetentionProgress]:
+        """
+        Delete the rows older than the cutoff of every table, e.g. {'probe': ts, 'traffic': ut_date};
+        returns when all tables are done, or when `stop` was called.
+        """
+        state = self._load_state()
+        with self.lock:
+            for name, cutoff in cutoffs.items():
+                saved = state.get(name)
+                if saved is not None and saved['cutoff'] == str(cutoff) and not saved['done']:
+                    self.progress[name] = RetentionProgress(**dict(saved, error=None))
+                    logger.info(f'Resuming the retention of {name} after {saved["deleted"]} rows.')
+                else:
+                    self.progress[name] = RetentionProgress(name=name, cutoff=str(cutoff))
+        self.stopped.clear()
+        with ThreadPoolExecutor(max_workers=max(len(cutoffs), 1), thread_name_prefix='retention') as executor:
+            futures = {name: executor.submit(self._run_table, name, cutoff) for name, cutoff in cutoffs.items()}
+            return {name: future.result() for name, future in futures.items()}
+
+    def stop(self):
+        # the running batches finish, and run returns with the progress saved
+        self.stopped.set()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            return {
+                name: dict(asdict(p), rows_per_second=p.rows_per_second) for name, p in self.progress.items()
+            }
@@ -0,0 +1,175 @@
+from dataclasses import dataclass
+from threading import Lock
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .utils import USER_COLUMNS, NODE_COLUMNS, TRAFFIC_COLUMNS, USER_TRAFFIC_COLUMNS, NODE_TRAFFIC_COLUMNS, tn
+
+# number of parameters of the `IN (...)` statements; chunks are padded to it, so one prepared statement serves all
+IN_CHUNK = 200
+
+
+@dataclass(frozen=True)
+class Statement:
+    name: str
+    sql: str
+    # the projection of a query, in the order expected by the function applied to its rows
+    columns: Tuple[str, ...] = ()
+
+    def projector(self, description) -> Optional[List[int]]:
+        # positions of the projected columns in a result set; None if they are already in order
+        names = [d[0].lower() for d in description]
+        if not self.columns or names == [c.lower() for c in self.columns]:
+            return None
+        missing = [c for c in self.columns if c.lower() not in names]
+        if missing:
+            raise ValueError(f'Columns {missing} are missing from the result of statement {self.name}.')
+        return [names.index(c.lower()) for c in self.columns]
+
+
+class StatementRegistry:
+    """
+    SQL statements by name, built once per dialect.
+    A statement is registered with a default SQL and optional versions per dialect (`mssql=...`,
+    `mysql=...`). `{columns}` in the SQL is replaced by the projection.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.templates: Dict[str, Tuple[Tuple[str, ...], Dict[str, str]]] = dict()
+        self.built: Dict[Tuple[str, str], Statement] = dict()
+
+    def register(self, name: str, sql: Optional[str] = None, columns: Sequence[str] = (), **dialects: str):
+        if sql is not None:
+            dialects['default'] = sql
+        with self.lock:
+            self.templates[name] = tuple(columns), dialects
+            self.built = {key: st for key, st in self.built.items() if key[0] != name}
+
+    def get(self, name: str, dialect: str) -> Statement:
+        st = self.built.get((name, dialect))
+        if st is not None:
+            return st
+        columns, dialects = self.templates[name]
+        sql = dialects.get(dialect, dialects.get('default'))
+        if sql is None:
+            raise ValueError(f'Statement {name} is not available for {dialect}.')
+        st = Statement(name, sql.replace('{columns}', ','.join(columns)), columns)
+        with self.lock:
+            self.built[name, dialect] = st
+        return st
+
+
+statements = StatementRegistry()
+
+# users
+statements.register(
+    'all_users', f'SELECT {{columns}} FROM {tn.user} WHERE last_change > ?', USER_COLUMNS,
+)
+statements.register(
+    'all_enabled_users', f'SELECT {{columns}} FROM {tn.user} WHERE last_change > ? AND enabled != 0', USER_COLUMNS,
+)
+statements.register('user_by_email', f'SELECT {{columns}} FROM {tn.user} WHERE email = ?', USER_COLUMNS)
+statements.register(
+    'users_by_emails', f'SELECT {{columns}} FROM {tn.user} WHERE email IN ({", ".join(["?"] * IN_CHUNK)})',
+    USER_COLUMNS,
+)
+statements.register(
+    'users_by_ids', f'SELECT {{columns}} FROM {tn.user} WHERE user_id IN ({", ".join(["?"] * IN_CHUNK)})',
+    USER_COLUMNS,
+)
+statements.register(
+    'user_changes', columns=list(USER_COLUMNS) + ['row_version'],
+    mssql=f'SELECT TOP (?) {",".join(USER_COLUMNS)}, CAST(row_version AS BIGINT) AS row_version FROM {tn.user} '
+          'WHERE row_version > CAST(CAST(? AS BIGINT) AS BINARY(8)) '
+          'AND row_version < CAST(CAST(? AS BIGINT) AS BINARY(8)) ORDER BY row_version',
+    mysql=f'SELECT {{columns}} FROM {tn.user} WHERE row_version > ? ORDER BY row_version LIMIT ?',
+)
+statements.register('min_active_rowversion', mssql='SELECT CAST(MIN_ACTIVE_ROWVERSION() AS BIGINT)')
+
+# schema migrations: name -> statements run in order by DBCommunicator.migrate; a step without SQL for the
+# dialect is skipped
+MIGRATIONS: Dict[str, List[str]] = dict()
+
+# `row_version` of the user table, read by DBCommunicator.changes_since.
+# MSSQL fills a ROWVERSION column itself, existing rows included. MySQL has no such type, so the insert and
+# update triggers take the next value of a counter row, whose row lock orders the versions by commit; the
+# last step gives the existing rows a version by touching them, which takes a while on a large table.
+MIGRATIONS['user_row_version'] = [
+    'user_row_version_counter', 'user_row_version_counter_row', 'user_row_version_column',
+    'user_row_version_index', 'user_row_version_insert_trigger', 'user_row_version_update_trigger',
+    'user_row_version_backfill',
+]
+statements.register(
+    'user_row_version_counter', mysql=f'CREATE TABLE {tn.user}_version (id TINYINT PRIMARY KEY, v BIGINT NOT NULL)',
+)
+statements.register('user_row_version_counter_row', mysql=f'INSERT INTO {tn.user}_version (id, v) VALUES (1, 0)')
+statements.register(
+    'user_row_version_column',
+    mssql=f'ALTER TABLE {tn.user} ADD row_version ROWVERSION NOT NULL',
+    mysql=f'ALTER TABLE {tn.user} ADD COLUMN row_version BIGINT NOT NULL DEFAULT 0',
+)
+statements.register(
+    'user_row_version_index', f'CREATE INDEX ix_{tn.user}_row_version ON {tn.user} (row_version)',
+)
+statements.register(
+    'user_row_version_insert_trigger',
+    mysql=f'CREATE TRIGGER {tn.user}_row_version_insert BEFORE INSERT ON {tn.user} FOR EACH ROW BEGIN '
+          f'UPDATE {tn.user}_version SET v = LAST_INSERT_ID(v + 1) WHERE id = 1; '
+          'SET NEW.row_version = LAST_INSERT_ID(); END',
+)
+statements.register(
+    'user_row_version_update_trigger',
+    mysql=f'CREATE TRIGGER {tn.user}_row_version_update BEFORE UPDATE ON {tn.user} FOR EACH ROW BEGIN '
+          f'UPDATE {tn.user}_version SET v = LAST_INSERT_ID(v + 1) WHERE id = 1; '
+          'SET NEW.row_version = LAST_INSERT_ID(); END',
+)
+statements.register('user_row_version_backfill', mysql=f'UPDATE {tn.user} SET row_version = 0 WHERE row_version = 0')
+
+# `last_change` of the node and relay tables, read by the delta pulls of NodePool (see load_servers).
+# Existing rows start at 0, which a full pull reads anyway.
+MIGRATIONS['node_last_change'] = [
+    'node_last_change_column', 'node_last_change_index', 'relay_last_change_column', 'relay_last_change_index',
+]
+statements.register(
+    'node_last_change_column',
+    mssql=f'ALTER TABLE {tn.node} ADD last_change BIGINT NOT NULL DEFAULT 0',
+    mysql=f'ALTER TABLE {tn.node} ADD COLUMN last_change BIGINT NOT NULL DEFAULT 0',
+)
+statements.register('node_last_change_index', f'CREATE INDEX ix_{tn.node}_last_change ON {tn.node} (last_change)')
+statements.register(
+    'relay_last_change_column',
+    mssql=f'ALTER TABLE {tn.relay} ADD last_change BIGINT NOT NULL DEFAULT 0',
+    mysql=f'ALTER TABLE {tn.relay} ADD COLUMN last_change BIGINT NOT NULL DEFAULT 0',
+)
+statements.register('relay_last_change_index', f'CREATE INDEX ix_{tn.relay}_last_change ON {tn.relay} (last_change)')
+
+# nodes
+statements.register(
+    'node_by_ip', f'SELECT {{columns}} FROM {tn.node} WHERE ipv4 = ? AND deleted = 0', NODE_COLUMNS,
+)
+statements.register('node_by_uuid', f'SELECT {{columns}} FROM {tn.node} WHERE uuid = ?', NODE_COLUMNS)
+statements.register('node_port', f'SELECT {{columns}} FROM {tn.node} WHERE uuid = ?', ['port'])
+statements.register('all_relay_ids', f'SELECT {{columns}} FROM {tn.relay}', ['relay_id'])
+
+# traffic and probes
+statements.register(
+    'user_traffic_after', f'SELECT {{columns}} FROM {tn.user_traffic} WHERE ut_date > ? AND user_id = ?',
+    USER_TRAFFIC_COLUMNS,
+)
+statements.register(
+    'user_traffic_on', f'SELECT {{columns}} FROM {tn.user_traffic} WHERE ut_date = ?', ['user_id', 'upload', 'download'],
+)
+# ranges of days for TrafficFrame, start included and end excluded
+statements.register(
+    'traffic_between', f'SELECT {{columns}} FROM {tn.traffic} WHERE ut_date >= ? AND ut_date < ?', TRAFFIC_COLUMNS,
+)
+statements.register(
+    'user_traffic_between', f'SELECT {{columns}} FROM {tn.user_traffic} WHERE ut_date >= ? AND ut_date < ?',
+    USER_TRAFFIC_COLUMNS,
+)
+statements.register(
+    'node_traffic_between', f'SELECT {{columns}} FROM {tn.node_traffic} WHERE ut_date >= ? AND ut_date < ?',
+    NODE_TRAFFIC_COLUMNS,
+)
+statements.register(
+    'probe_after', f'SELECT {{columns}} FROM {tn.probe} WHERE ts > ?', ['ip', 'port', 'probe_result', 'ts'],
+)
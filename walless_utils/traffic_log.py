@@ -0,0 +1,144 @@
+import time
+import logging
+from datetime import datetime, date
+from dataclasses import dataclass, field
+from typing import Dict, Tuple, List, Iterator, Optional, Any
+
+from .database import DBCommunicator, UpsertResult
+from .utils import tn, tz
+
+logger = logging.getLogger('walless')
+
+
+def ts2date(ts) -> date:
+    if isinstance(ts, datetime):
+        return ts.astimezone(tz).date()
+    return datetime.fromtimestamp(ts, tz=tz).date()
+
+
+@dataclass
+class LogBatch:
+    # log ids in (first_id, last_id] are folded into this batch
+    first_id: int
+    last_id: int
+    rows: int = 0
+    # user_id -> [upload, download]
+    users: Dict[int, List[int]] = field(default_factory=dict)
+    # node_id -> [upload, download]
+    nodes: Dict[Any, List[int]] = field(default_factory=dict)
+    # (ut_date, user_id, node_id) -> [upload, download]
+    traffic: Dict[Tuple, List[int]] = field(default_factory=dict)
+    upsert: Optional[UpsertResult] = None
+    elapsed: float = 0.0
+
+    def add(self, log_id, user_id, node_id, upload, download, ts):
+        self.rows += 1
+        self.last_id = max(self.last_id, log_id)
+        for acc, key in ((self.users, user_id), (self.nodes, node_id), (self.traffic, (ts2date(ts), user_id, node_id))):
+            if key in acc:
+                acc[key][0] += upload
+                acc[key][1] += download
+            else:
+                acc[key] = [upload, download]
+
+
+class TrafficLogDrain:
+    """
+    Fold the traffic log into the traffic table batch by batch.
+    Log rows are read with keyset pagination (`log_id > last`) and streamed with `fetchmany`, so at most
+    one batch of aggregates is held in memory. The aggregated updates and the deletion of the folded logs
+    of each batch are committed in one transaction.
+    """
+    select_sql = {
+        'mssql': f'SELECT TOP (?) log_id, user_id, node_id, upload, download, ts FROM {tn.traffic_log} '
+                 'WHERE log_id > ? ORDER BY log_id ASC',
+        'mysql': f'SELECT log_id, user_id, node_id, upload, download, ts FROM {tn.traffic_log} '
+                 'WHERE log_id > ? ORDER BY log_id ASC LIMIT ?',
+    }
+    delete_sql = f'DELETE FROM {tn.traffic_log} WHERE log_id > ? AND log_id <= ?'
+    # moves last_change as DBCommunicator.update_user_sql does, so pools pulling by last_change see the counters
+    update_user_traffic_sql = (
+        f'UPDATE {tn.user} SET upload = upload + (?), download = download + (?), last_change = ? WHERE user_id = ?'
+    )
+
+    def __init__(
+        self, db: DBCommunicator, batch_size: int = 20000, fetch_size: int = 2000,
+        update_users: bool = False, update_nodes: bool = False,
+    ):
+        self.db = db
+        self.batch_size, self.fetch_size = batch_size, fetch_size
+        # also add the traffic to the counters in the user and node tables
+        self.update_users, self.update_nodes = update_users, update_nodes
+        self.last_id = 0
+        # metrics
+        self.total_rows = self.total_batches = 0
+        self.total_time = 0.0
+
+    def _select(self, cursor, last_id):
+        if self.db.dialect == 'mssql':
+            cursor.execute(self.select_sql['mssql'], self.batch_size, last_id)
+        else:
+            cursor.execute(self.select_sql['mysql'], last_id, self.batch_size)
+
+    def _drain_one(self) -> Optional[LogBatch]:
+        since = time.time()
+        batch = LogBatch(first_id=self.last_id, last_id=self.last_id)
+        with self.db.pool.connection() as conn:
+            with conn.cursor() as cur:
+                self._select(cur, self.last_id)
+                while True:
+                    rows = cur.fetchmany(self.fetch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        batch.add(*row)
+                if batch.rows == 0:
+                    return None
+                batch.upsert = DBCommunicator.upsert_traffic_cursor(
+                    cur, ((*k, *v) for k, v in batch.traffic.items()), self.db.dialect,
+                )
+                change = int(time.time())
+                if self.update_users:
+                    cur.fast_executemany = True
+                    cur.executemany(
+                        self.update_user_traffic_sql, [(*v, change, k) for k, v in batch.users.items()],
+                    )
+                if self.update_nodes:
+                    cur.fast_executemany = True
+                    cur.executemany(DBCommunicator.update_node_sql, [(*v, change, k) for k, v in batch.nodes.items()])
+                cur.execute(self.delete_sql, batch.first_id, batch.last_id)
+            conn.commit()
+        self.last_id = batch.last_id
+        batch.elapsed = time.time() - since
+        self.total_rows += batch.rows
+        self.total_batches += 1
+        self.total_time += batch.elapsed
+        return batch
+
+    def batches(self, max_batches: Optional[int] = None) -> Iterator[LogBatch]:
+        # stops when the log is drained or after `max_batches` batches
+        n = 0
+        while max_batches is None or n < max_batches:
+            batch = self._drain_one()
+            if batch is None:
+                return
+            logger.debug(
+                f'Drained logs ({batch.first_id}, {batch.last_id}]: {batch.rows} rows, {len(batch.users)} users, '
+                f'{len(batch.nodes)} nodes in {batch.elapsed:.2f}s.'
+            )
+            yield batch
+            n += 1
+
+    def drain(self, max_batches: Optional[int] = None) -> Dict[str, Any]:
+        for _ in self.batches(max_batches):
+            pass
+        return self.stats()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'rows': self.total_rows,
+            'batches': self.total_batches,
+            'elapsed': self.total_time,
+            'rows_per_second': self.total_rows / self.total_time if self.total_time else 0.0,
+            'last_id': self.last_id,
+        }
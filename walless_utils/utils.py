@@ -110,6 +110,15 @@ def url2ip(url):
         return 'error'
 
 
+def lazy_numpy():
+    # numpy is optional; only the vectorized helpers (quota, traffic limits, traffic frames) need it
+    try:
+        import numpy
+    except ImportError as e:
+        raise ImportError('numpy is required by this feature: `pip install numpy`') from e
+    return numpy
+
+
 def current_time():
     return datetime.now(tz=tz)
 
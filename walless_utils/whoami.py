@@ -5,6 +5,8 @@ import logging
 
 from .global_obj.db_setup import db
 from .global_obj.config_setup import cfg
+from .global_obj.pool_setup import pool_setup, node_pool
+from .objects.node_index import NodeIndex
 from .network_status import NetworkStatus
 
 logger = logging.getLogger('walless')
@@ -27,7 +29,13 @@ def whoami(ns: Optional[NetworkStatus] = None, debug: bool = False):
     retries = 20
     while retries > 0:
         try:
-            nodes = db.all_servers(get_mix=False, get_relays=True)
+            if pool_setup.setup_done:
+                # reuse the node pool and its indexes if it is set up
+                node_pool.pull()
+                nodes, index = node_pool.all_nodes(pull=False), node_pool.index
+            else:
+                nodes = db.all_servers(get_mix=False, get_relays=True)
+                index = NodeIndex(nodes)
             break
         except:
             retries -= 1
@@ -35,13 +43,14 @@ def whoami(ns: Optional[NetworkStatus] = None, debug: bool = False):
 
     # uuid is priority 1
     if my_uuid is not None:
-        for node in nodes:
-            if node.uuid == my_uuid:
-                return node
+        node = index.by_uuid(my_uuid)
+        if node is not None:
+            return node
 
     # ipv4 is priority 2
-    for node in nodes:
-        if node.ip(4) is not None and node.ip(4) == ns.ipv4:
+    if ns.ipv4 is not None:
+        node = index.by_ip(ns.ipv4, include_deleted=True)
+        if node is not None:
             return node
 
     if debug: